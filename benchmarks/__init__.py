@@ -0,0 +1,39 @@
+import argparse
+
+from benchmarks.synthetic import SyntheticReportsGenerator
+
+
+def parse_args(raw_args=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the tix-time-processor pipeline. Synthetic measures '
+                                                 'messages are processed stage by stage, posting the results to a '
+                                                 'local stub API, and the time and memory of each stage, along with '
+                                                 'the messages per second, are written as JSON.')
+    parser.add_argument('--messages', '-m', action='store', default=20, type=int,
+                        help='The amount of messages measured. By default 20.')
+    parser.add_argument('--reports-per-message', action='store', default=20, type=int,
+                        help='The amount of reports of each message. By default 20.')
+    parser.add_argument('--observations-per-report', action='store', default=60, type=int,
+                        help='The amount of observations of each report. By default 60.')
+    parser.add_argument('--rtt-distribution', action='store', default='lognormal',
+                        choices=SyntheticReportsGenerator.RTT_DISTRIBUTIONS,
+                        help='The distribution of the round trip times. By default "lognormal".')
+    parser.add_argument('--rtt-median', action='store', default=50000, type=float,
+                        help='The median round trip time, in nanoseconds. By default 50000.')
+    parser.add_argument('--rtt-spread', action='store', default=0.5, type=float,
+                        help='The relative spread of the round trip times. By default 0.5.')
+    parser.add_argument('--clock-drift', action='store', default=1e-7, type=float,
+                        help='Nanoseconds the server clock drifts per nanosecond. By default 1e-7.')
+    parser.add_argument('--gap-probability', action='store', default=0.0, type=float,
+                        help='Probability of a gap after each report. By default 0.')
+    parser.add_argument('--gap-length', action='store', default=600, type=int,
+                        help='Seconds without observations of each gap. By default 600.')
+    parser.add_argument('--seed', action='store', default=0, type=int,
+                        help='Seed of the synthetic reports. By default 0.')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not measure the memory of each stage.')
+    parser.add_argument('--output', '-o', action='store', default=None, type=str,
+                        help='The name of the output JSON file. By default the standard output.')
+    parser.add_argument('--baseline', '-b', action='store', default=None, type=str,
+                        help='The output JSON file of a previous run, to compare against.')
+    args = parser.parse_args(raw_args)
+    return args
@@ -0,0 +1,29 @@
+import json
+import logging
+
+from benchmarks import parse_args
+from benchmarks import suite
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logger.debug(args)
+    # The posts of each message are logged at INFO level
+    logging.getLogger('processor.api_communication').setLevel(logging.WARNING)
+    results = suite.run_benchmark(messages=args.messages,
+                                  reports_per_message=args.reports_per_message,
+                                  trace_memory=not args.no_memory,
+                                  seed=args.seed,
+                                  observations_per_report=args.observations_per_report,
+                                  rtt_distribution=args.rtt_distribution,
+                                  rtt_median=args.rtt_median,
+                                  rtt_spread=args.rtt_spread,
+                                  clock_drift=args.clock_drift,
+                                  gap_probability=args.gap_probability,
+                                  gap_length=args.gap_length)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            results['comparison'] = suite.compare_results(json.load(baseline_file), results)
+    suite.dump_results(results, args.output)
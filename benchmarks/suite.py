@@ -0,0 +1,235 @@
+import json
+import platform
+import subprocess
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import mock
+
+import numpy
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from benchmarks.synthetic import SyntheticReportsGenerator
+from processor import analysis
+from processor import api_communication
+from processor import consumer
+from processor import metrics
+
+# The stages timed by metrics.STAGE_SECONDS, in the order a message goes through them
+STAGES = ('decode', 'group', 'histogram', 'clock_fixer', 'usage', 'hurst', 'quality', 'post')
+
+
+class StubApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubApiServer(ThreadingMixIn, HTTPServer):
+    """
+    Local API that accepts every post, so posting can be measured without the real API.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubApiHandler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}/api/reports'.format(port=self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+class StageTimer:
+    """
+    Collects the durations of each stage, as recorded by metrics.STAGE_SECONDS, and optionally the peak of memory
+    allocated during them.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.durations = {stage: [] for stage in STAGES}
+        self.peak_memory = dict.fromkeys(STAGES, 0)
+
+    def record_durations(self):
+        """
+        Takes the seconds of each stage recorded in metrics.STAGE_SECONDS since the last call, where each stage of a
+        message is observed once.
+        """
+        for (stage,), (buckets_counts, seconds, count) in metrics.STAGE_SECONDS.drain().items():
+            if stage in self.durations:
+                self.durations[stage].append(seconds)
+
+    @staticmethod
+    def reset_memory_peak():
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # Python < 3.9, restarting also forgets the memory allocated before
+            tracemalloc.stop()
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Replaces metrics.STAGE_SECONDS.time while tracing memory, measuring the peak of memory of each stage.
+        """
+        self.reset_memory_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        yield
+        peak = tracemalloc.get_traced_memory()[1] - memory_before
+        self.peak_memory[name] = max(self.peak_memory[name], peak)
+
+    @contextmanager
+    def measure(self):
+        """
+        Measures the stages of the messages processed in the block. When the minute usage cache is enabled, a new one
+        is used, so the minutes analyzed before are not taken from it.
+        """
+        metrics.STAGE_SECONDS.drain()
+        minute_usage_cache = analysis.MinuteUsageCache(max_size=consumer.minute_usage_cache.max_size) \
+            if consumer.minute_usage_cache is not None else None
+        with mock.patch.object(consumer, 'minute_usage_cache', minute_usage_cache):
+            if self.trace_memory:
+                with mock.patch.object(metrics.STAGE_SECONDS, 'time', self.stage):
+                    yield
+            else:
+                yield
+
+
+def process_message(body, timer, api_url):
+    """
+    Processes a measures message with the same functions the consumer uses, recording the durations of its stages.
+    """
+    user_id, installation_id, observations_per_ip = consumer.parse_measures(body)
+    ip, observations = observations_per_ip[0]
+    results = consumer.analyze_observations(observations)
+    with mock.patch.object(api_communication, 'prepare_url', return_value=api_url):
+        posted = api_communication.post_results(ip, results, user_id, installation_id)
+    if not posted:
+        raise RuntimeError('Could not post the results to the stub API')
+    timer.record_durations()
+    return results
+
+
+def summarize_durations(durations):
+    durations = numpy.array(durations)
+    return {
+        'calls': len(durations),
+        'total_seconds': float(durations.sum()),
+        'mean_seconds': float(durations.mean()),
+        'min_seconds': float(durations.min()),
+        'median_seconds': float(numpy.median(durations)),
+        'max_seconds': float(durations.max())
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(messages=20, reports_per_message=20, warmup_messages=1, trace_memory=True, **generator_options):
+    """
+    Generates synthetic messages and processes them, first timing each stage and then measuring its memory.
+
+    :param generator_options: The options of the SyntheticReportsGenerator
+    :return: A JSON serializable dict with the configuration, the environment and the measurements
+    """
+    generator = SyntheticReportsGenerator(**generator_options)
+    bodies = [generator.generate_message(reports_per_message) for _ in range(warmup_messages + messages)]
+    timer = StageTimer()
+    with StubApiServer() as api_server, timer.measure():
+        for body in bodies[:warmup_messages]:
+            process_message(body, StageTimer(), api_server.url)
+        started = time.perf_counter()
+        for body in bodies[warmup_messages:]:
+            process_message(body, timer, api_server.url)
+        elapsed = time.perf_counter() - started
+    memory_timer = StageTimer(trace_memory=True)
+    if trace_memory:
+        # Tracing memory slows the stages down, so it is measured apart from the durations
+        tracemalloc.start()
+        try:
+            with StubApiServer() as api_server, memory_timer.measure():
+                for body in bodies[warmup_messages:]:
+                    process_message(body, memory_timer, api_server.url)
+        finally:
+            tracemalloc.stop()
+    stages = {}
+    for stage in STAGES:
+        stages[stage] = summarize_durations(timer.durations[stage])
+        if trace_memory:
+            stages[stage]['peak_memory_bytes'] = memory_timer.peak_memory[stage]
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'machine': platform.machine()
+        },
+        'configuration': dict(generator_options, messages=messages, reports_per_message=reports_per_message,
+                              warmup_messages=warmup_messages),
+        'observations_per_message': reports_per_message * generator.observations_per_report,
+        'elapsed_seconds': elapsed,
+        'messages_per_second': messages / elapsed,
+        'max_rss_kilobytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None,
+        'stages': stages
+    }
+
+
+def compare_results(baseline, current):
+    """
+    :return: For each stage, and for the whole throughput, the ratio between the current and the baseline measure
+    """
+    comparison = {
+        'baseline_commit': baseline.get('commit'),
+        'messages_per_second_ratio': current['messages_per_second'] / baseline['messages_per_second'],
+        'stages': {}
+    }
+    for stage, measures in current['stages'].items():
+        baseline_measures = baseline['stages'].get(stage)
+        if baseline_measures is None:
+            continue
+        comparison['stages'][stage] = {
+            'median_seconds_ratio': measures['median_seconds'] / baseline_measures['median_seconds']
+        }
+        if 'peak_memory_bytes' in measures and baseline_measures.get('peak_memory_bytes'):
+            comparison['stages'][stage]['peak_memory_ratio'] = \
+                measures['peak_memory_bytes'] / baseline_measures['peak_memory_bytes']
+    return comparison
+
+
+def dump_results(results, file_path=None):
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if file_path is None:
+        print(output)
+    else:
+        with open(file_path, 'w') as output_file:
+            output_file.write(output + '\n')
@@ -0,0 +1,96 @@
+import json
+
+import numpy
+
+from processor.report_parser import ObservationBatch, Report, ReportJSONEncoder
+
+NANOS_IN_A_SECOND = 10 ** 9
+NANOS_IN_A_DAY = 24 * 60 * 60 * NANOS_IN_A_SECOND
+
+
+class SyntheticReportsGenerator:
+    """
+    Generates consecutive TIX reports of an installation, with observations like the ones of a real client.
+
+    Every observations_interval seconds the client sends a packet of one of packet_sizes bytes. Its round trip time is
+    drawn from the rtt_distribution, with median rtt_median nanoseconds and relative spread rtt_spread, plus the time
+    to serialize the packet, and upstream_ratio of it is spent going to the server. The server clock is ahead of the
+    client one by clock_offset nanoseconds, which grows clock_drift nanoseconds per nanosecond. After each report,
+    with probability gap_probability, the client stops sending packets for gap_length seconds.
+    """
+    RTT_DISTRIBUTIONS = ('lognormal', 'exponential', 'uniform')
+
+    def __init__(self, seed=None, start_timestamp=1500000000, observations_interval=1, observations_per_report=60,
+                 rtt_distribution='lognormal', rtt_median=50000, rtt_spread=0.5, serialization_time_per_byte=8,
+                 upstream_ratio=0.5, processing_time=(50, 100), clock_offset=-160 * 10 ** 6, clock_drift=1e-7,
+                 gap_probability=0.0, gap_length=600, packet_sizes=(75, 4475),
+                 from_dir='10.0.0.1:4500', to_dir='8.8.8.8:4500', user_id=1, installation_id=1):
+        if rtt_distribution not in self.RTT_DISTRIBUTIONS:
+            raise ValueError('Unknown RTT distribution {}, expected one of {}'.format(rtt_distribution,
+                                                                                    self.RTT_DISTRIBUTIONS))
+        self.random = numpy.random.RandomState(seed)
+        self.start_timestamp = start_timestamp
+        self.next_timestamp = start_timestamp
+        self.observations_interval = observations_interval
+        self.observations_per_report = observations_per_report
+        self.rtt_distribution = rtt_distribution
+        self.rtt_median = rtt_median
+        self.rtt_spread = rtt_spread
+        self.serialization_time_per_byte = serialization_time_per_byte
+        self.upstream_ratio = upstream_ratio
+        self.processing_time = processing_time
+        self.clock_offset = clock_offset
+        self.clock_drift = clock_drift
+        self.gap_probability = gap_probability
+        self.gap_length = gap_length
+        self.packet_sizes = packet_sizes
+        self.from_dir = from_dir
+        self.to_dir = to_dir
+        self.user_id = user_id
+        self.installation_id = installation_id
+
+    def sample_rtts(self, size):
+        if self.rtt_distribution == 'lognormal':
+            return self.rtt_median * numpy.exp(self.rtt_spread * self.random.standard_normal(size))
+        if self.rtt_distribution == 'exponential':
+            return self.rtt_median / numpy.log(2) * self.random.standard_exponential(size)
+        return self.rtt_median * self.random.uniform(1 - self.rtt_spread, 1 + self.rtt_spread, size)
+
+    def generate_observations(self, size):
+        day_timestamps = self.next_timestamp + self.observations_interval * numpy.arange(size, dtype=numpy.int64)
+        self.next_timestamp = int(day_timestamps[-1]) + self.observations_interval
+        sent_by_client = day_timestamps * NANOS_IN_A_SECOND + self.random.randint(0, NANOS_IN_A_SECOND // 2, size)
+        packet_sizes = self.random.choice(self.packet_sizes, size)
+        rtts = self.sample_rtts(size) + packet_sizes * self.serialization_time_per_byte
+        processing_times = self.random.randint(self.processing_time[0], self.processing_time[1] + 1, size)
+        elapsed = (sent_by_client - self.start_timestamp * NANOS_IN_A_SECOND).astype(numpy.float64)
+        clocks_offsets = self.clock_offset + self.clock_drift * elapsed
+        observations = numpy.empty(size, dtype=ObservationBatch.dtype)
+        observations['day_timestamp'] = day_timestamps
+        observations['type_identifier'] = b'S'
+        observations['packet_size'] = packet_sizes
+        observations['initial_timestamp'] = sent_by_client % NANOS_IN_A_DAY
+        received_by_server = sent_by_client + (rtts * self.upstream_ratio + clocks_offsets).astype(numpy.int64)
+        observations['reception_timestamp'] = received_by_server % NANOS_IN_A_DAY
+        observations['sent_timestamp'] = (received_by_server + processing_times) % NANOS_IN_A_DAY
+        received_by_client = sent_by_client + rtts.astype(numpy.int64) + processing_times
+        observations['final_timestamp'] = received_by_client % NANOS_IN_A_DAY
+        return ObservationBatch(observations)
+
+    def generate_report(self):
+        observations = self.generate_observations(self.observations_per_report)
+        if self.random.random_sample() < self.gap_probability:
+            self.next_timestamp += self.gap_length
+        return Report(from_dir=self.from_dir, to_dir=self.to_dir, packet_type='LONG',
+                      initial_timestamp=0, reception_timestamp=0, sent_timestamp=0, final_timestamp=0,
+                      public_key='a', observations=observations, signature='a',
+                      user_id=self.user_id, installation_id=self.installation_id)
+
+    def generate_reports(self, reports_qty):
+        return [self.generate_report() for _ in range(reports_qty)]
+
+    def generate_message(self, reports_qty):
+        """
+        :return: A measures message, as the ones of the processor queue, with the next reports_qty reports
+        """
+        return json.dumps(self.generate_reports(reports_qty), cls=ReportJSONEncoder).encode()
@@ -2,39 +2,38 @@ import traceback
 import logging
 import pika
 
-from processor import reports
-from processor import report_parser
-from processor import api_communication
-from processor import analysis
+from processor import consumer
+from processor import metrics
+from processor import pipeline
+from processor import results_cache
+from processor import spool
 from processor import RABBITMQ_USER, RABBITMQ_PASS, RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_INCOMING_QUEUE
+from processor import RABBITMQ_PREFETCH_COUNT, PROCESSOR_WORKERS, PROCESSOR_RUNTIME, PIPELINE_QUEUE_SIZE
 
 tasks_logger = logging.getLogger(__name__)
+# Spool of the results that could not be posted, when TIX_RESULTS_SPOOL_PATH is set
+results_spool = None
+# Results of the last messages analyzed, so redelivered messages are only posted again
+measures_results_cache = None
 
 def process_measures(channel, method, properties, body):
     logger = tasks_logger.getChild('process_measures')
-    current_reports = report_parser.Report.loads(body)
-    ip, observations = reports.ReportHandler.collect_observations(current_reports)
     delivery_tag = method.delivery_tag
-    if ip is None and observations is None:
-        logger.error('Rejecting tag {} with no requeue, message {}', delivery_tag, body)
+    analyzed_measures = consumer.analyze_measures(body, results_cache=measures_results_cache)
+    if analyzed_measures is None:
+        logger.error('Rejecting tag {} with no requeue, message {}'.format(delivery_tag, body))
         channel.basic_reject(delivery_tag, requeue=False)
+        metrics.MESSAGES.inc('rejected')
         return
 
-    user_id = current_reports[0].user_id
-    installation_id = current_reports[0].installation_id
-    logger.info('Analyzing tag {} with {} observations for IP {}, user {}, installation {}'.format(delivery_tag,
-                                                                                                   len(observations),
-                                                                                                   ip,
-                                                                                                   user_id,
-                                                                                                   installation_id))
-    analyzer = analysis.Analyzer(observations)
-    results = analyzer.get_results()
-    if api_communication.post_results(ip, results, user_id, installation_id):
+    if consumer.post_analyzed_measures(analyzed_measures, results_spool):
         channel.basic_ack(delivery_tag)
+        metrics.MESSAGES.inc('acked')
     else:
-        logger.error('Could not post tag {} results to API, rejecting with requeue', delivery_tag)
+        logger.error('Could not post tag {} results to API, rejecting with requeue'.format(delivery_tag))
         channel.basic_reject(delivery_tag, requeue=True)
-        
+        metrics.MESSAGES.inc('requeued')
+
 
 if __name__ == '__main__':
     credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
@@ -45,13 +44,56 @@ if __name__ == '__main__':
     )
     connection = pika.BlockingConnection(parameters=parameters)
     channel = connection.channel()
+    results_spool_sender = None
+    if spool.RESULTS_SPOOL_PATH:
+        results_spool = spool.ResultsSpool(spool.RESULTS_SPOOL_PATH)
+        results_spool_sender = spool.ResultsSpoolSender(results_spool)
+        results_spool_sender.start()
+        metrics.registry.callback('tix_processor_results_spool_entries', 'Results waiting in the spool to be posted.',
+                                  lambda: results_spool.stats()['pending_entries'])
+    if results_cache.RESULTS_CACHE_SIZE > 0:
+        measures_results_cache = results_cache.ResultsCache(database_path=results_cache.RESULTS_CACHE_PATH)
+        metrics.registry.callback('tix_processor_results_cache_hits_total',
+                                  'Messages whose results were taken from the results cache.',
+                                  lambda: measures_results_cache.stats()['hits'], type='counter')
+        metrics.registry.callback('tix_processor_results_cache_misses_total',
+                                  'Messages whose results were not in the results cache.',
+                                  lambda: measures_results_cache.stats()['misses'], type='counter')
+    metrics_server = None
+    if metrics.METRICS_PORT > 0:
+        metrics_server = metrics.MetricsServer().start()
     try:
         channel.queue_declare(queue=RABBITMQ_INCOMING_QUEUE, durable=True)
-        channel.basic_qos(prefetch_count=1)
-        channel.basic_consume(process_measures, queue=RABBITMQ_INCOMING_QUEUE)
-        channel.start_consuming()
+        if PROCESSOR_WORKERS > 0:
+            prefetch_count = RABBITMQ_PREFETCH_COUNT or 2 * PROCESSOR_WORKERS
+            if PROCESSOR_RUNTIME == 'asyncio':
+                concurrent_consumer = pipeline.AsyncPipelineConsumer(connection, channel, RABBITMQ_INCOMING_QUEUE,
+                                                                     workers=PROCESSOR_WORKERS,
+                                                                     prefetch_count=prefetch_count,
+                                                                     queue_size=PIPELINE_QUEUE_SIZE,
+                                                                     results_spool=results_spool,
+                                                                     results_cache=measures_results_cache)
+            else:
+                concurrent_consumer = consumer.ConcurrentConsumer(connection, channel, RABBITMQ_INCOMING_QUEUE,
+                                                                  workers=PROCESSOR_WORKERS,
+                                                                  prefetch_count=prefetch_count,
+                                                                  results_spool=results_spool,
+                                                                  results_cache=measures_results_cache)
+            concurrent_consumer.start_consuming()
+        else:
+            channel.basic_qos(prefetch_count=RABBITMQ_PREFETCH_COUNT or 1)
+            channel.basic_consume(process_measures, queue=RABBITMQ_INCOMING_QUEUE)
+            channel.start_consuming()
     except:
         tasks_logger.error('Exception caught {}'.format(traceback.format_exc()))
     finally:
         channel.cancel()
         connection.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if results_spool_sender is not None:
+            results_spool_sender.stop()
+            results_spool.close()
+        if measures_results_cache is not None:
+            tasks_logger.info('Results cache stats: {}'.format(measures_results_cache.stats()))
+            measures_results_cache.close()
@@ -8,6 +8,15 @@ RABBITMQ_PORT = os.environ.get('TIX_RABBITMQ_PORT', '5672')
 
 RABBITMQ_INCOMING_QUEUE = os.environ.get('TIX_CONDENSER_PROCESSOR_QUEUE')
 
+# Amount of worker processes analyzing messages concurrently. With 0, messages are processed one at a time.
+PROCESSOR_WORKERS = int(os.environ.get('TIX_PROCESSOR_WORKERS', '0'))
+# Amount of unacked messages delivered to the processor. With 0, twice the amount of workers (or 1 without workers).
+RABBITMQ_PREFETCH_COUNT = int(os.environ.get('TIX_RABBITMQ_PREFETCH_COUNT', '0'))
+# How the workers are fed: 'pool' (processor.consumer) or 'asyncio' (processor.pipeline)
+PROCESSOR_RUNTIME = os.environ.get('TIX_PROCESSOR_RUNTIME', 'pool').lower()
+# Size of each queue between the stages of the asyncio pipeline. With 0, the amount of workers.
+PIPELINE_QUEUE_SIZE = int(os.environ.get('TIX_PIPELINE_QUEUE_SIZE', '0'))
+
 LOG_LEVEL = os.environ.get('TIX_LOG_LEVEL', 'INFO')
 log_levels = {
     'FATAL': logging.CRITICAL,
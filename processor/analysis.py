@@ -1,11 +1,30 @@
-from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from datetime import timedelta
+import hashlib
 import logging
-from functools import partial
-from operator import attrgetter
+import os
+import sys
+import time
 
 from math import floor, sqrt, log as log_function
 
+import numpy
+
 from processor import hurst
+from processor import metrics
+from processor.report_parser import ObservationBatch, as_observation_batch
+
+SECONDS_IN_A_MINUTE = 60
+
+# Maximum amount of minutes whose usage is kept by each process. With 0, the default, the usage of every minute is
+# calculated again for every message.
+MINUTE_USAGE_CACHE_SIZE = int(os.environ.get('TIX_MINUTE_USAGE_CACHE_SIZE', '0'))
+# Maximum amount of installations whose analysis state is kept between messages. With 0, the default, no state is kept.
+STATE_CACHE_SIZE = int(os.environ.get('TIX_STATE_CACHE_SIZE', '0'))
+# Seconds the analysis state of an installation is kept since its last message
+STATE_CACHE_TTL = float(os.environ.get('TIX_STATE_CACHE_TTL', '3600'))
+# Maximum megabytes used by the minute usages kept in the analysis state of all the installations
+STATE_CACHE_MEMORY_BUDGET = int(float(os.environ.get('TIX_STATE_CACHE_MEMORY_BUDGET', '256')) * 1024 * 1024)
 
 
 def observation_rtt_key_function(observation):
@@ -21,32 +40,122 @@ def downstream_time_function(observation, phi_function):
     return observation.final_timestamp - (observation.sent_timestamp + phi_function(observation.day_timestamp))
 
 
+def calculate_times(observations, phi_function):
+    """
+    Calculates the upstream and downstream times of every observation, evaluating phi only once for each of them.
+    """
+    phis = phi_function(observations.day_timestamp)
+    upstream_times = (observations.reception_timestamp + phis) - observations.initial_timestamp
+    downstream_times = observations.final_timestamp - (observations.sent_timestamp + phis)
+    return upstream_times, downstream_times
+
+
+def minutes_slices(sorted_day_timestamps):
+    """
+    Divides sorted day timestamps into minutes.
+
+    :return: list of (minute, start, end) tuples, where minute is the timestamp of the start of the minute and
+    [start, end) are the indexes of its day timestamps
+    """
+    if len(sorted_day_timestamps) == 0:
+        return []
+    minutes = sorted_day_timestamps - sorted_day_timestamps % SECONDS_IN_A_MINUTE
+    minutes_ends = numpy.flatnonzero(numpy.diff(minutes)) + 1
+    starts = numpy.concatenate(([0], minutes_ends)).tolist()
+    ends = numpy.concatenate((minutes_ends, [len(minutes)])).tolist()
+    return [(int(minutes[start]), start, end) for start, end in zip(starts, ends)]
+
+
 def divide_observations_into_minutes(observations):
-    observations_per_minute = {}
-    for observation in observations:
-        observation_datetime = datetime.fromtimestamp(observation.day_timestamp, timezone.utc)
-        observation_minute = observation_datetime.replace(second=0, microsecond=0).timestamp()
-        if observation_minute not in observations_per_minute:
-            observations_per_minute[observation_minute] = []
-        observations_per_minute[observation_minute].append(observation)
-    return observations_per_minute
+    observations = as_observation_batch(observations)
+    observations = observations.sorted_by(observations.day_timestamp)
+    return {minute: observations[start:end]
+            for minute, start, end in minutes_slices(observations.day_timestamp)}
+
+
+def calculate_usage(times, histogram=None):
+    if histogram is None:
+        histogram = FixedSizeBinHistogram(None, None, keys=times)
+    over_threshold = numpy.count_nonzero(times > histogram.threshold)
+    over_mode = numpy.count_nonzero(times > histogram.mode)
+    return over_threshold / over_mode
+
+
+class MinuteUsageCache:
+    """
+    Bounded LRU cache of the upstream and downstream usage of a minute, keyed by a digest of the observations of the
+    minute and the phi segments used to fix their clock.
+
+    Consecutive messages of an installation share most of their minutes, and the phi segments of a minute only change
+    when the observations the clock fixer is built from change around it. So the usage of those minutes is calculated
+    only once, no matter the rest of the window.
+    """
+    DEFAULT_MAX_SIZE = 10000
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.usages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.usages)
+
+    @property
+    def nbytes(self):
+        entries_nbytes = sum(sys.getsizeof(key) + sys.getsizeof(usages) + sum(map(sys.getsizeof, usages))
+                             for key, usages in self.usages.items())
+        return sys.getsizeof(self.usages) + entries_nbytes
+
+    @staticmethod
+    def minute_key(observations, clock_fixer):
+        """
+        :param observations: The observations of the minute
+        :return: A single digest for both directions, as their times are calculated from the same observations and
+        phi segments
+        """
+        segments = clock_fixer.phi_segments(observations.day_timestamp)
+        digest = hashlib.sha1(numpy.ascontiguousarray(observations.array.astype(ObservationBatch.dtype,
+                                                                                copy=False)).tobytes())
+        digest.update(clock_fixer.slopes[segments].tobytes())
+        digest.update(clock_fixer.intercepts[segments].tobytes())
+        return digest.digest()
+
+    def usage(self, key, upstream_times, downstream_times):
+        """
+        :return: The upstream and downstream usage of the times of a minute, calculated only if the key is not cached
+        """
+        if key in self.usages:
+            self.hits += 1
+            self.usages.move_to_end(key)
+            return self.usages[key]
+        self.misses += 1
+        usages = calculate_usage(upstream_times), calculate_usage(downstream_times)
+        self.usages[key] = usages
+        if len(self.usages) > self.max_size:
+            self.usages.popitem(last=False)
+        return usages
 
 
 class Bin:
-    def __init__(self, data, characterization_function):
-        self.data = list(data)
-        self.characterization_function = characterization_function
+    """
+    A bin of a FixedSizeBinHistogram, keys holds the characterization of each datapoint sorted in ascending order.
+    """
+    def __init__(self, data, keys):
+        self.data = as_observation_batch(data)
+        self.keys = keys
 
-    def update(self, new_data):
-        self.data.extend(list(new_data))
+    def update(self, new_data, new_keys):
+        self.data = ObservationBatch.concatenate([self.data, as_observation_batch(new_data)])
+        self.keys = numpy.concatenate([self.keys, new_keys])
 
     @property
     def max_value(self):
-        return self.characterization_function(max(self.data, key=self.characterization_function))
+        return self.keys[-1]
 
     @property
     def min_value(self):
-        return self.characterization_function(min(self.data, key=self.characterization_function))
+        return self.keys[0]
 
     @property
     def width(self):
@@ -60,48 +169,64 @@ class Bin:
 class FixedSizeBinHistogram:
     DEFAULT_ALPHA = 0.5
 
-    def __init__(self, data, characterization_function, alpha=DEFAULT_ALPHA):
+    def __init__(self, data, characterization_function, alpha=DEFAULT_ALPHA, keys=None):
+        """
+        :param keys: The characterization of the data, if it was already calculated. When given, data may be None
+        to build the histogram of the keys alone, without bins.
+        """
         self.characterization_function = characterization_function
         self.alpha = alpha
-        self.data = sorted(data, key=self.characterization_function)
-        self.bins = list()
-        self._generate_histogram()
+        if keys is None:
+            data = as_observation_batch(data)
+            keys = self.characterization_function(data)
+        keys = numpy.asarray(keys)
+        sorting_indexes = numpy.argsort(keys, kind='mergesort')
+        self.data = as_observation_batch(data)[sorting_indexes] if data is not None else None
+        self.keys = keys[sorting_indexes]
+        self.bins_starts, self.bins_ends = self._generate_histogram()
+        self.bins_counts = self.bins_ends - self.bins_starts
+        # The keys are sorted, so the bounds of each bin are the keys at its ends
+        self.bins_min_values = self.keys[self.bins_starts]
+        self.bins_max_values = self.keys[self.bins_ends - 1]
+        self.bins_widths = self.bins_max_values - self.bins_min_values
+        self.bins_mid_values = self.bins_min_values + self.bins_widths // 2
         self.bins_probabilities, self.mode, self.threshold = self._generate_probabilities_mode_and_threshold()
 
     def _generate_histogram(self):
-        bins_qty = int(floor(sqrt(len(self.data))))
-        datapoints_per_bin = len(self.data) // bins_qty
+        bins_qty = int(floor(sqrt(len(self.keys))))
+        datapoints_per_bin = len(self.keys) // bins_qty
         # Create a histogram with the same amount of observation in each bin
-        threshold = 0
-        for index in range(bins_qty):
-            data_index = index * datapoints_per_bin
-            threshold = data_index + datapoints_per_bin
-            bin_data = self.data[data_index:threshold]
-            bin_ = Bin(bin_data, self.characterization_function)
-            self.bins.append(bin_)
+        bins_starts = numpy.arange(bins_qty) * datapoints_per_bin
+        bins_ends = bins_starts + datapoints_per_bin
         # If there still some observations left, we add them to the last bin
-        if threshold < len(self.data):
-            self.bins[-1].update(self.data[threshold:])
+        bins_ends[-1] = len(self.keys)
+        return bins_starts, bins_ends
+
+    @property
+    def bins(self):
+        return [Bin(self.data[start:end], self.keys[start:end])
+                for start, end in zip(self.bins_starts, self.bins_ends)]
 
     def _generate_bins_probabilities(self):
-        total_datapoints = sum([len(bin_.data) for bin_ in self.bins])
-        total_width = self.bins[-1].max_value - self.bins[0].min_value
-        probabilities = [(total_datapoints * total_width) / (len(bin_.data) * bin_.width)
-                         for bin_ in self.bins]
-        return list(probabilities)
+        total_datapoints = len(self.keys)
+        total_width = self.keys[-1] - self.keys[0]
+        # A bin whose keys are all equal has no width, which the probability is not defined for
+        if not self.bins_widths.all():
+            raise ZeroDivisionError('The histogram has a bin of zero width')
+        return (total_datapoints * total_width) / (self.bins_counts * self.bins_widths)
 
     def _generate_probabilities_mode_and_threshold(self):
         probabilities = self._generate_bins_probabilities()
-        representative_bins = 2 * int(sqrt(len(self.bins)))
+        representative_bins = 2 * int(sqrt(len(probabilities)))
         representative_probabilities = probabilities[:representative_bins]
-        mode = max(representative_probabilities)
-        mode_index = representative_probabilities.index(mode)
-        mode_value = self.bins[mode_index].mid_value
+        mode_index = int(numpy.argmax(representative_probabilities))
+        mode = representative_probabilities[mode_index]
+        mode_value = self.bins_mid_values[mode_index]
         if representative_probabilities[0] == mode:
-            threshold = self.bins[1].mid_value
+            threshold = self.bins_mid_values[1]
         else:
-            threshold = mode_value + self.alpha * self.bins[0].mid_value
-        return probabilities, mode_value, threshold
+            threshold = mode_value + self.alpha * self.bins_mid_values[0]
+        return probabilities.tolist(), mode_value, threshold
 
 
 class ClockFixer:
@@ -109,21 +234,9 @@ class ClockFixer:
     DOWNSTREAM_SERIALIZATION_TIME = 15 * (10 ** 3)  # 15 micro
 
     def __init__(self, observations, tau):
-        self.observations = sorted(observations,
-                                   key=lambda o: o.day_timestamp)
-
-    def _between_obs(self, day_timestamp):
-        obs = tuple()
-        if day_timestamp < self.observations[0].day_timestamp:
-            obs = (None, self.observations[0])
-        elif self.observations[-1].day_timestamp <= day_timestamp:
-            obs = (self.observations[-1], None)
-        else:
-            for index in range(len(self.observations) - 1):
-                if self.observations[index].day_timestamp <= day_timestamp < self.observations[index + 1].day_timestamp:
-                    obs = (self.observations[index], self.observations[index + 1])
-                    break
-        return obs
+        observations = as_observation_batch(observations)
+        self.observations = observations.sorted_by(observations.day_timestamp)
+        self.breakpoints, self.slopes, self.intercepts = self._build_phi_segments()
 
     def _calculate_observation_phi(self, observation):
         if observation is None:
@@ -132,19 +245,37 @@ class ClockFixer:
                 ((observation.reception_timestamp - observation.initial_timestamp) +
                  (observation.final_timestamp - observation.sent_timestamp)) / 2)
 
+    def _build_phi_segments(self):
+        """
+        Precomputes the piecewise linear phi function defined by the observations.
+
+        The segment i + 1 joins the observations i and i + 1, while the first and the last segments
+        extend the phi of the first and the last observations as constants. So the segment of a
+        timestamp x is the amount of observations with a day_timestamp lower or equal than x.
+        """
+        breakpoints = self.observations.day_timestamp.astype(numpy.int64)
+        phis = self._calculate_observation_phi(self.observations).astype(numpy.float64)
+        timestamps_deltas = breakpoints[:-1] - breakpoints[1:]
+        # Segments between observations with the same day_timestamp are never used
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            segments_slopes = numpy.where(timestamps_deltas != 0, (phis[:-1] - phis[1:]) / timestamps_deltas, 0.0)
+        segments_intercepts = phis[:-1] - breakpoints[:-1] * segments_slopes
+        slopes = numpy.concatenate(([0.0], segments_slopes, [0.0]))
+        intercepts = numpy.concatenate((phis[:1], segments_intercepts, phis[-1:]))
+        return breakpoints, slopes, intercepts
+
+    def phi_segments(self, x):
+        """
+        :return: The segment of the phi function of a day_timestamp or an array of them
+        """
+        return numpy.searchsorted(self.breakpoints, x, side='right')
+
     def _base_phi_function(self, x):
-        obs_before, obs_after = self._between_obs(x)
-        phi_before = self._calculate_observation_phi(obs_before)
-        phi_after = self._calculate_observation_phi(obs_after)
-        slope = 0
-        if phi_before is not None and phi_after is not None:
-            slope = (phi_before - phi_after) / (obs_before.day_timestamp - obs_after.day_timestamp)
-        intercept = 0
-        if phi_before is None:
-            intercept = phi_after - obs_after.day_timestamp * slope
-        else:
-            intercept = phi_before - obs_before.day_timestamp * slope
-        return x * slope + intercept
+        """
+        Evaluates phi for a day_timestamp or an array of them.
+        """
+        segment = self.phi_segments(x)
+        return x * self.slopes[segment] + self.intercepts[segment]
 
     @property
     def phi_function(self):
@@ -153,34 +284,17 @@ class ClockFixer:
 
 class UsageCalculator:
     def __init__(self, observations, clock_fixer):
-        self.observations = observations
+        self.observations = as_observation_batch(observations)
         self.clock_fixer = clock_fixer
-        self.upstream_time_key_function = partial(upstream_time_function,
-                                                  phi_function=self.clock_fixer.phi_function)
-        self.downstream_time_key_function = partial(downstream_time_function,
-                                                    phi_function=self.clock_fixer.phi_function)
-        self.upstream_histogram = FixedSizeBinHistogram(observations, self.upstream_time_key_function)
-        self.downstream_histogram = FixedSizeBinHistogram(observations, self.downstream_time_key_function)
+        self.upstream_times, self.downstream_times = calculate_times(self.observations,
+                                                                     self.clock_fixer.phi_function)
+        self.upstream_histogram = FixedSizeBinHistogram(self.observations, None, keys=self.upstream_times)
+        self.downstream_histogram = FixedSizeBinHistogram(self.observations, None, keys=self.downstream_times)
         self.upstream_usage, self.downstream_usage = self._calculate_usage()
 
     def _calculate_usage(self):
-        upstream_over_threshold = 0
-        downstream_over_threshold = 0
-        upstream_over_mode = 0
-        downstream_over_mode = 0
-        for observation in self.observations:
-            upstream_time = self.upstream_time_key_function(observation)
-            downstream_time = self.downstream_time_key_function(observation)
-            if upstream_time > self.upstream_histogram.threshold:
-                upstream_over_threshold += 1
-            if downstream_time > self.downstream_histogram.threshold:
-                downstream_over_threshold += 1
-            if upstream_time > self.upstream_histogram.mode:
-                upstream_over_mode += 1
-            if downstream_time > self.downstream_histogram.mode:
-                downstream_over_mode += 1
-        upstream_usage = upstream_over_threshold / upstream_over_mode
-        downstream_usage = downstream_over_threshold / downstream_over_mode
+        upstream_usage = calculate_usage(self.upstream_times, self.upstream_histogram)
+        downstream_usage = calculate_usage(self.downstream_times, self.downstream_histogram)
         return upstream_usage, downstream_usage
 
 
@@ -191,20 +305,25 @@ class HurstCalculator:
 
     @staticmethod
     def hurst_values(data):
-        wavelet_hurst = hurst.wavelet(data)
-        rs_hurst = hurst.rs(data)
-        return {
-            'wavelet': wavelet_hurst,
-            'rs': rs_hurst
-        }
+        return HurstCalculator.hurst_values_batch([data])[0]
+
+    @staticmethod
+    def hurst_values_batch(series):
+        estimations = hurst.hurst_batch(series)
+        if numpy.isnan(estimations['rs']).any():
+            raise ValueError("Either the series is constant or no data was entered.")
+        return [{
+            'wavelet': float(wavelet_hurst),
+            'rs': float(rs_hurst)
+        } for wavelet_hurst, rs_hurst in zip(estimations['wavelet'], estimations['rs'])]
 
     def __init__(self, observations, clock_fixer):
-        self.observations = observations
+        self.observations = as_observation_batch(observations)
         self.capped_observations = self._cap_observations()
         self.clock_fixer = clock_fixer
         self.upstream_times, self.downstream_times = self._calculate_times()
-        self.upstream_values = self.hurst_values(self.upstream_times)
-        self.downstream_values = self.hurst_values(self.downstream_times)
+        self.upstream_values, self.downstream_values = self.hurst_values_batch([self.upstream_times,
+                                                                                self.downstream_times])
 
     def _calculate_desired_length(self):
         return int(2 ** floor(log_function(len(self.observations), 2)))
@@ -215,50 +334,57 @@ class HurstCalculator:
         return capped_observations
 
     def _calculate_times(self):
-        upstream_times = []
-        downstream_times = []
-        for observation in self.capped_observations:
-            upstream_time = upstream_time_function(observation, self.clock_fixer.phi_function)
-            downstream_time = downstream_time_function(observation, self.clock_fixer.phi_function)
-            upstream_times.append(upstream_time)
-            downstream_times.append(downstream_time)
-        return upstream_times, downstream_times
+        return calculate_times(self.capped_observations, self.clock_fixer.phi_function)
 
 
 class QualityCalculator:
     DEFAULT_CONGESTION_THRESHOLD = 0.5
     DEFAULT_HURST_CONGESTION_THRESHOLD = 0.7
+    MINIMUM_MINUTE_OBSERVATIONS = 30
 
     def __init__(self, observations, hurst_calcultor, clock_fixer,
                  congestion_threshold=DEFAULT_CONGESTION_THRESHOLD,
-                 hurst_congestion_threshold=DEFAULT_HURST_CONGESTION_THRESHOLD):
-        self.observations = observations
+                 hurst_congestion_threshold=DEFAULT_HURST_CONGESTION_THRESHOLD,
+                 minute_usage_cache=None):
+        observations = as_observation_batch(observations)
+        self.observations = observations.sorted_by(observations.day_timestamp)
         self.hurst_calculator = hurst_calcultor
         self.clock_fixer = clock_fixer
         self.congestion_threshold = congestion_threshold
         self.hurst_congestion_threshold = hurst_congestion_threshold
-        self.observations_per_minute = divide_observations_into_minutes(self.observations)
+        self.minute_usage_cache = minute_usage_cache
+        self.upstream_times, self.downstream_times = calculate_times(self.observations, self.clock_fixer.phi_function)
+        # Minutes with too few observations are left out of the quality, as they always were
+        self.minutes_slices = [(minute, start, end)
+                               for minute, start, end in minutes_slices(self.observations.day_timestamp)
+                               if end - start >= self.MINIMUM_MINUTE_OBSERVATIONS]
+        self.observations_per_minute = {minute: self.observations[start:end]
+                                        for minute, start, end in self.minutes_slices}
         self.upstream_congestion, self.downstream_congestion = self._calculate_congestion()
         self.upstream_quality = \
             (len(self.observations_per_minute) - self.upstream_congestion) / len(self.observations_per_minute)
         self.downstream_quality = \
             (len(self.observations_per_minute) - self.downstream_congestion) / len(self.observations_per_minute)
 
+    def _calculate_minute_usage(self, start, end):
+        upstream_times = self.upstream_times[start:end]
+        downstream_times = self.downstream_times[start:end]
+        if self.minute_usage_cache is None:
+            return calculate_usage(upstream_times), calculate_usage(downstream_times)
+        key = self.minute_usage_cache.minute_key(self.observations[start:end], self.clock_fixer)
+        return self.minute_usage_cache.usage(key, upstream_times, downstream_times)
+
     def _calculate_congestion(self):
         upstream_congestion = 0
         downstream_congestion = 0
         effective_upstream_hurst = HurstCalculator.calculate_effective_hurst(self.hurst_calculator.upstream_values)
         effective_downstream_hurst = HurstCalculator.calculate_effective_hurst(self.hurst_calculator.downstream_values)
-        obspm_items = list(self.observations_per_minute.items())
-        for minute, m_observations in obspm_items:
-            if len(m_observations) < 30:
-                self.observations_per_minute.pop(minute, None)
-        for minute, m_observations in self.observations_per_minute.items():
-            minute_usage_calculator = UsageCalculator(m_observations, self.clock_fixer)
-            if minute_usage_calculator.upstream_usage < self.congestion_threshold \
+        for minute, start, end in self.minutes_slices:
+            minute_upstream_usage, minute_downstream_usage = self._calculate_minute_usage(start, end)
+            if minute_upstream_usage < self.congestion_threshold \
                     and effective_upstream_hurst > self.hurst_congestion_threshold:
                 upstream_congestion += 1
-            if minute_usage_calculator.downstream_usage < self.congestion_threshold \
+            if minute_downstream_usage < self.congestion_threshold \
                     and effective_downstream_hurst > self.hurst_congestion_threshold:
                 downstream_congestion += 1
         return upstream_congestion, downstream_congestion
@@ -270,31 +396,44 @@ class Analyzer:
     CONGESTION_THRESHOLD = 0.5
     HURST_CONGESTION_THRESHOLD = 0.7
 
-    def __init__(self, observations_set):
+    def __init__(self, observations_set, minute_usage_cache=None):
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.observations = [observation for observation in observations_set if observation.type_identifier == b'S']
+        observations = as_observation_batch(observations_set)
+        observations = observations[observations.type_identifier == b'S']
+        self.observations = observations.sorted_by(observations.day_timestamp)
+        self.minute_usage_cache = minute_usage_cache
+        self.analyze()
+
+    def analyze(self):
+        """
+        Analyzes the observations, which must be sorted by day_timestamp.
+        """
         self.meaningful_observations = self.calculate_meaningful_observations()
-        self.rtt_histogram = FixedSizeBinHistogram(data=self.observations,
-                                                   characterization_function=observation_rtt_key_function)
-        self.clock_fixer = ClockFixer(self.rtt_histogram.bins[0].data, tau=self.rtt_histogram.mode)
-        self.usage_calculator = UsageCalculator(self.meaningful_observations, self.clock_fixer)
-        self.hurst_calculator = HurstCalculator(self.meaningful_observations, self.clock_fixer)
-        self.quality_calculator = QualityCalculator(self.meaningful_observations,
-                                                    self.hurst_calculator,
-                                                    self.clock_fixer)
+        with metrics.STAGE_SECONDS.time('histogram'):
+            self.rtt_histogram = FixedSizeBinHistogram(data=self.observations,
+                                                       characterization_function=observation_rtt_key_function)
+        with metrics.STAGE_SECONDS.time('clock_fixer'):
+            self.clock_fixer = ClockFixer(self.rtt_histogram.bins[0].data, tau=self.rtt_histogram.mode)
+        with metrics.STAGE_SECONDS.time('usage'):
+            self.usage_calculator = UsageCalculator(self.meaningful_observations, self.clock_fixer)
+        with metrics.STAGE_SECONDS.time('hurst'):
+            self.hurst_calculator = HurstCalculator(self.meaningful_observations, self.clock_fixer)
+        with metrics.STAGE_SECONDS.time('quality'):
+            self.quality_calculator = QualityCalculator(self.meaningful_observations,
+                                                        self.hurst_calculator,
+                                                        self.clock_fixer,
+                                                        minute_usage_cache=self.minute_usage_cache)
 
     def calculate_meaningful_observations(self):
-        sorted_observations = sorted(self.observations, key=attrgetter('day_timestamp'))
-        first_observation = sorted_observations[0]
-        last_observation = sorted_observations[-1]
+        first_observation = self.observations[0]
+        last_observation = self.observations[-1]
         observations_delta = timedelta(seconds=(last_observation.day_timestamp - first_observation.day_timestamp))
         if observations_delta < self.MEANINGFUL_OBSERVATIONS_DELTA:
             raise ValueError('Meaningful observations time delta is lower than expected. '
                              'Expected {}, got {}'.format(self.MEANINGFUL_OBSERVATIONS_DELTA, observations_delta))
         meaningful_threshold_timestamp = last_observation.day_timestamp \
                                          - self.MEANINGFUL_OBSERVATIONS_DELTA.total_seconds()
-        meaningful_observations = [observation for observation in self.observations
-                                   if observation.day_timestamp > meaningful_threshold_timestamp]
+        meaningful_observations = self.observations[self.observations.day_timestamp > meaningful_threshold_timestamp]
         return meaningful_observations
 
     def get_results(self):
@@ -314,3 +453,97 @@ class Analyzer:
         }
         logger.debug(results)
         return results
+
+
+class AnalysisStateCache:
+    """
+    Bounded cache of the MinuteUsageCache of each installation, keyed by (user_id, installation_id, ip).
+
+    Each installation keeps the usage of at most MINUTE_USAGES_PER_INSTALLATION of its last minutes, enough for the
+    minutes its next message shares with the last one. The rest of the analysis depends on the whole window and is
+    calculated again for every message. The least recently used installations are evicted when there are more than
+    max_size of them or when the memory of their minute usages exceeds memory_budget bytes, and the ones without
+    messages for ttl seconds expire. Each process keeps its own cache, which is not thread safe, so it is only hit if
+    the messages of an installation are analyzed by the same process (see consumer.AnalysisExecutors).
+    """
+    MINUTE_USAGES_PER_INSTALLATION = 32
+
+    def __init__(self, max_size=STATE_CACHE_SIZE, ttl=STATE_CACHE_TTL, memory_budget=STATE_CACHE_MEMORY_BUDGET,
+                 clock=time.monotonic):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.memory_budget = memory_budget
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.entries_nbytes = {}
+        self.memory_usage = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _remove(self, key):
+        del self.entries[key]
+        self.memory_usage -= self.entries_nbytes.pop(key)
+
+    def _expire(self, now):
+        while self.entries:
+            key, (minute_usage_cache, last_used) = next(iter(self.entries.items()))
+            if now - last_used < self.ttl:
+                break
+            self._remove(key)
+            self.expirations += 1
+
+    def _evict(self, keep_key):
+        while len(self.entries) > 1 and (len(self.entries) > self.max_size or self.memory_usage > self.memory_budget):
+            key = next(iter(self.entries))
+            if key == keep_key:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def minute_usage_cache(self, key):
+        """
+        Returns the minute usage cache of an installation, creating an empty one if it is not cached.
+        """
+        now = self.clock()
+        self._expire(now)
+        if key in self.entries:
+            self.hits += 1
+            minute_usage_cache = self.entries.pop(key)[0]
+        else:
+            self.misses += 1
+            minute_usage_cache = MinuteUsageCache(max_size=self.MINUTE_USAGES_PER_INSTALLATION)
+            self.entries_nbytes[key] = 0
+        self.entries[key] = (minute_usage_cache, now)
+        return minute_usage_cache
+
+    def analyze(self, key, observations):
+        """
+        Analyzes the observations of a message of an installation, reusing the usage of the minutes it shares with
+        its last message.
+        """
+        minute_usage_cache = self.minute_usage_cache(key)
+        try:
+            return Analyzer(observations, minute_usage_cache=minute_usage_cache).get_results()
+        finally:
+            self.memory_usage += minute_usage_cache.nbytes - self.entries_nbytes[key]
+            self.entries_nbytes[key] = minute_usage_cache.nbytes
+            self._evict(key)
+
+    def stats(self):
+        return {
+            'installations': len(self.entries),
+            'memory_usage': self.memory_usage,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
@@ -1,17 +1,86 @@
 import logging
 import os
+import threading
 
 import requests
 from requests import RequestException
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.util.retry import Retry
+
+from processor import metrics
 
 TIX_API_SSL = os.environ.get('TIX_API_SSL', 'False').lower() in ('yes', 'true')
 TIX_API_HOST = os.environ.get('TIX_API_HOST', 'localhost')
 TIX_API_PORT = os.environ.get('TIX_API_PORT', '3002')
 TIX_API_URL_TEMPLATE = '{proto}://{api_host}/api/user/{user_id}/installation/{installation_id}/reports'
+# Maximum amount of connections kept alive to the API
+TIX_API_POOL_SIZE = int(os.environ.get('TIX_API_POOL_SIZE', '10'))
+# Seconds to wait for the API to accept the connection and to answer
+TIX_API_TIMEOUT = float(os.environ.get('TIX_API_TIMEOUT', '10'))
+# Times a post is retried when the API cannot be reached
+TIX_API_RETRIES = int(os.environ.get('TIX_API_RETRIES', '3'))
+TIX_API_BACKOFF_FACTOR = float(os.environ.get('TIX_API_BACKOFF_FACTOR', '0.5'))
+# If the API accepts a list of results of an installation in a single post
+TIX_API_BULK_POST = os.environ.get('TIX_API_BULK_POST', 'False').lower() in ('yes', 'true')
+
+# Outcomes of a post: the API stored the results, the post failed but may succeed later, or the API refused the results
+# and would refuse them again
+POSTED = 'posted'
+FAILED = 'failed'
+REFUSED = 'refused'
+# Status codes, besides the 5xx ones, of the responses to a post that may be accepted later
+RETRIABLE_STATUS_CODES = (408, 429)
 
 logger = logging.getLogger(__name__)
 
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_retry(retries=TIX_API_RETRIES, backoff_factor=TIX_API_BACKOFF_FACTOR):
+    """
+    Retries a post only if the connection to the API could not be established. Once the request was sent the API may
+    have stored the results, even if it answered with an error through a gateway, so a retry could post them twice.
+    """
+    retry_arguments = {
+        'total': retries,
+        'connect': retries,
+        'read': False,
+        'status': False,
+        'redirect': False,
+        'backoff_factor': backoff_factor,
+        'respect_retry_after_header': False,
+        'raise_on_status': False
+    }
+    try:
+        return Retry(allowed_methods=frozenset(['POST']), other=False, **retry_arguments)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(['POST']), **retry_arguments)
+
+
+def create_session(pool_size=TIX_API_POOL_SIZE, retries=TIX_API_RETRIES, backoff_factor=TIX_API_BACKOFF_FACTOR):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=create_retry(retries, backoff_factor))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Returns the session shared by the process, which keeps the connections to the API alive between posts.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
 
 def prepare_results_for_api(results, ip):
     return {
@@ -49,23 +118,81 @@ def prepare_url(user_id, installation_id, tix_api_ssl=TIX_API_SSL, tix_api_host=
     return url
 
 
-def post_results(ip, results, user_id, installation_id):
-    log = logger.getChild('post_results')
-    log.info('posting results for user {user_id} installation {installation_id}'.format(user_id=user_id,
-                                                                                        installation_id=installation_id))
-    json_data = prepare_results_for_api(results, ip)
-    log.debug('json_data={json_data}'.format(json_data=json_data))
-    url = prepare_url(user_id, installation_id)
+def status_code_outcome(status_code):
+    if status_code in (200, 204):
+        return POSTED
+    if status_code >= 500 or status_code in RETRIABLE_STATUS_CODES:
+        return FAILED
+    return REFUSED
+
+
+def post_json_outcome(url, json_data):
+    """
+    :return: POSTED, FAILED if the post may succeed later or REFUSED if the API would refuse it again
+    """
+    log = logger.getChild('post_json')
     try:
-        response = requests.post(url=url,
-                                 json=json_data)
-        if response.status_code not in (200, 204):
+        with metrics.STAGE_SECONDS.time('post'):
+            response = get_session().post(url=url,
+                                          json=json_data,
+                                          timeout=TIX_API_TIMEOUT)
+        outcome = status_code_outcome(response.status_code)
+        if outcome != POSTED:
             log.error('Error while trying to post to API, got status code {status_code} for url {url}'
                       .format(status_code=response.status_code,
                               url=url))
-            return False
     except RequestException as re:
         log.error('Error while trying to post to API for url {url}'.format(url=url))
         log.error(re)
-        return False
-    return True
+        outcome = FAILED
+    metrics.API_POSTS.inc(outcome)
+    return outcome
+
+
+def post_json(url, json_data):
+    return post_json_outcome(url, json_data) == POSTED
+
+
+def post_results_outcome(ip, results, user_id, installation_id):
+    """
+    :return: POSTED, FAILED if the post may succeed later or REFUSED if the API would refuse it again
+    """
+    log = logger.getChild('post_results')
+    log.info('posting results for user {user_id} installation {installation_id}'.format(user_id=user_id,
+                                                                                        installation_id=installation_id))
+    json_data = prepare_results_for_api(results, ip)
+    log.debug('json_data={json_data}'.format(json_data=json_data))
+    url = prepare_url(user_id, installation_id)
+    return post_json_outcome(url, json_data)
+
+
+def post_results(ip, results, user_id, installation_id):
+    return post_results_outcome(ip, results, user_id, installation_id) == POSTED
+
+
+def post_results_bulk(entries, bulk_post=TIX_API_BULK_POST):
+    """
+    Posts many results, grouping them by user and installation.
+
+    :param entries: list of (ip, results, user_id, installation_id) tuples
+    :param bulk_post: if True, the results of each installation are posted together as a list in a single request,
+    otherwise they are posted one by one over the shared connections
+    :return: list with the outcome of the post of each entry
+    """
+    log = logger.getChild('post_results_bulk')
+    entries_indexes_per_installation = {}
+    for index, (ip, results, user_id, installation_id) in enumerate(entries):
+        entries_indexes_per_installation.setdefault((user_id, installation_id), []).append(index)
+    outcomes = [False] * len(entries)
+    for (user_id, installation_id), indexes in entries_indexes_per_installation.items():
+        if bulk_post:
+            log.info('posting {count} results for user {user_id} installation {installation_id}'
+                     .format(count=len(indexes), user_id=user_id, installation_id=installation_id))
+            json_data = [prepare_results_for_api(entries[index][1], entries[index][0]) for index in indexes]
+            posted = post_json(prepare_url(user_id, installation_id), json_data)
+            for index in indexes:
+                outcomes[index] = posted
+        else:
+            for index in indexes:
+                outcomes[index] = post_results(*entries[index])
+    return outcomes
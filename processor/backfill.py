@@ -0,0 +1,195 @@
+import csv
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename, exists, getsize
+
+from processor import analysis
+from processor import reports
+
+logger = logging.getLogger(__name__)
+
+RESULTS_FIELDS = ('installation_dir', 'window', 'user_id', 'installation_id', 'ip', 'timestamp',
+                  'upstream_usage', 'upstream_quality', 'upstream_hurst_wavelet', 'upstream_hurst_rs',
+                  'downstream_usage', 'downstream_quality', 'downstream_hurst_wavelet', 'downstream_hurst_rs',
+                  'error')
+
+
+def find_installation_dirs(source_dirs_paths, recursive=False):
+    """
+    Yields the directories with report files. Without recursive, the source directories themselves are yielded.
+    """
+    for source_dir_path in source_dirs_paths:
+        if not recursive:
+            yield source_dir_path
+            continue
+        for dir_path, dirs_names, files_names in os.walk(source_dir_path):
+            dirs_names[:] = sorted(dir_name for dir_name in dirs_names
+                                   if dir_name != reports.ReportHandler.FAILED_RESULTS_DIR_NAME)
+            if any(file_name.endswith('.json') for file_name in files_names):
+                yield dir_path
+
+
+def enumerate_windows(installation_dir_path):
+    """
+    Enumerates the windows of reports that the processor would analyze, one after the other, for an installation,
+    without deleting any report file.
+
+    :return: A tuple with the installation directory and the list of windows, each one a list of report files paths.
+    If the directory could not be read the error is logged and it has no windows, so the rest of the installations are
+    still analyzed.
+    """
+    windows = []
+    try:
+        # The directory is scanned once, the windows are then walked over its sorted reports summaries
+        reports_summaries = reports.ReportsIndex(installation_dir_path, read_only=True).update()
+        window_start, window, _ = reports.ReportHandler.select_reports_window(reports_summaries)
+        while len(window) > 0:
+            windows.append([report.file_path for report in window])
+            # At least a report is left out of the next window, so every window is different
+            next_start = window_start + max(1, len(window) // 2)
+            window_start, window, _ = reports.ReportHandler.select_reports_window(reports_summaries, next_start)
+    except Exception:
+        logger.exception('Skipping installation {}, its reports could not be enumerated'.format(installation_dir_path))
+        return installation_dir_path, []
+    return installation_dir_path, windows
+
+
+def window_key(installation_dir_path, window):
+    return installation_dir_path, basename(window[0])
+
+
+def analyze_window(task):
+    """
+    Analyzes a window of reports.
+
+    :param task: A tuple with the installation directory and the report files paths of the window
+    :return: A row of results, with the error instead of the results if the window could not be analyzed
+    """
+    installation_dir_path, window = task
+    row = dict.fromkeys(RESULTS_FIELDS, '')
+    row['installation_dir'], row['window'] = window_key(installation_dir_path, window)
+    try:
+        window_reports = [reports.Report.load(report_file_path) for report_file_path in window]
+        ip, observations = reports.ReportHandler.collect_observations(window_reports)
+        results = analysis.Analyzer(observations).get_results()
+    except Exception as exception:
+        row['error'] = '{}: {}'.format(exception.__class__.__name__, exception)
+        return row
+    row['user_id'] = window_reports[0].user_id
+    row['installation_id'] = window_reports[0].installation_id
+    row['ip'] = ip
+    row['timestamp'] = results['timestamp']
+    for direction in ('upstream', 'downstream'):
+        row[direction + '_usage'] = results[direction]['usage']
+        row[direction + '_quality'] = results[direction]['quality']
+        row[direction + '_hurst_wavelet'] = results[direction]['hurst']['wavelet']
+        row[direction + '_hurst_rs'] = results[direction]['hurst']['rs']
+    return row
+
+
+class BackfillCheckpoint:
+    """
+    Append only file with the windows already written to the results, one per line.
+    """
+    SEPARATOR = '\t'
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.done = set()
+        if exists(self.file_path):
+            with open(self.file_path) as checkpoint_file:
+                for line in checkpoint_file:
+                    fields = line.rstrip('\n').split(self.SEPARATOR)
+                    if len(fields) == 2:
+                        self.done.add(tuple(fields))
+        self.checkpoint_file = open(self.file_path, 'a')
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, key):
+        self.done.add(key)
+        self.checkpoint_file.write(self.SEPARATOR.join(key) + '\n')
+        self.checkpoint_file.flush()
+
+    def close(self):
+        self.checkpoint_file.close()
+
+
+class BackfillProgress:
+    """
+    Counts the analyzed windows and logs the progress every interval seconds.
+    """
+    def __init__(self, total, interval, clock=time.monotonic):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.total = total
+        self.interval = interval
+        self.clock = clock
+        self.started = self.clock()
+        self.last_report = self.started
+        self.analyzed = 0
+        self.failed = 0
+
+    def update(self, row):
+        self.analyzed += 1
+        if row['error']:
+            self.failed += 1
+        now = self.clock()
+        if now - self.last_report >= self.interval or self.analyzed == self.total:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now):
+        elapsed = max(now - self.started, 1e-9)
+        rate = self.analyzed / elapsed
+        remaining = (self.total - self.analyzed) / rate if rate > 0 else float('inf')
+        self.logger.info('Analyzed {}/{} windows ({} failed), {:.2f} windows/s, {:.0f}s remaining'.format(
+            self.analyzed, self.total, self.failed, rate, remaining))
+
+    def stats(self):
+        return {
+            'total': self.total,
+            'analyzed': self.analyzed,
+            'failed': self.failed,
+            'elapsed': self.clock() - self.started
+        }
+
+
+def run_backfill(source_dirs_paths, output_path, workers=None, recursive=False, checkpoint_path=None,
+                 progress_interval=10, chunksize=4):
+    """
+    Analyzes every window of reports of the installations, writing a row of results per window to a CSV file.
+
+    The windows already in the checkpoint are skipped, so an interrupted backfill resumes where it stopped.
+    The installations are enumerated and the windows analyzed in a pool of processes.
+    """
+    if checkpoint_path is None:
+        checkpoint_path = output_path + '.checkpoint'
+    checkpoint = BackfillCheckpoint(checkpoint_path)
+    installation_dirs_paths = list(find_installation_dirs(source_dirs_paths, recursive))
+    logger.info('Enumerating the windows of {} installations'.format(len(installation_dirs_paths)))
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor, \
+                open(output_path, 'a', newline='') as output_file:
+            writer = csv.DictWriter(output_file, fieldnames=RESULTS_FIELDS)
+            if getsize(output_path) == 0:
+                writer.writeheader()
+            tasks = []
+            for installation_dir_path, windows in executor.map(enumerate_windows, installation_dirs_paths):
+                tasks += [(installation_dir_path, window) for window in windows
+                          if window_key(installation_dir_path, window) not in checkpoint]
+            logger.info('{} windows to analyze, {} already analyzed'.format(len(tasks), len(checkpoint)))
+            progress = BackfillProgress(len(tasks), progress_interval)
+            for row in executor.map(analyze_window, tasks, chunksize=chunksize):
+                writer.writerow(row)
+                output_file.flush()
+                checkpoint.add((row['installation_dir'], row['window']))
+                progress.update(row)
+    finally:
+        checkpoint.close()
+    return progress.stats()
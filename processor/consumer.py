@@ -0,0 +1,287 @@
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+from processor import analysis
+from processor import api_communication
+from processor import metrics
+from processor import report_parser
+from processor import reports
+
+logger = logging.getLogger(__name__)
+
+# Errors of the processor itself rather than of the message, so the message can be processed again. An executor that
+# broke or was shut down raises RuntimeError, and BrokenProcessPool is one of them
+INFRASTRUCTURE_ERRORS = (OSError, RuntimeError)
+
+# Usage of the minutes already analyzed by this process, shared by the messages it analyzes
+minute_usage_cache = analysis.MinuteUsageCache(max_size=analysis.MINUTE_USAGE_CACHE_SIZE) \
+    if analysis.MINUTE_USAGE_CACHE_SIZE > 0 else None
+# Usage of the last minutes of each installation analyzed by this process, reused by their next messages
+analysis_state_cache = analysis.AnalysisStateCache() if analysis.STATE_CACHE_SIZE > 0 else None
+# The caches are kept by each process, so they are only hit if the messages of an installation are always analyzed
+# by the same worker process
+ROUTE_INSTALLATIONS = analysis.STATE_CACHE_SIZE > 0 or analysis.MINUTE_USAGE_CACHE_SIZE > 0
+
+
+def analyze_observations(observations, state_key=None):
+    """
+    Analyzes the observations of a message, reusing the usage of the last minutes of its installation when they are
+    cached.
+
+    :param state_key: The (user_id, installation_id, ip) of the message
+    """
+    if analysis_state_cache is None or state_key is None:
+        return analysis.Analyzer(observations, minute_usage_cache=minute_usage_cache).get_results()
+    return analysis_state_cache.analyze(state_key, observations)
+
+
+def parse_measures(body):
+    """
+    Parses a measures message and groups its observations by IP.
+
+    :param body: The message body, a JSON list of reports
+    :return: A tuple with the user id, the installation id and the list of (ip, observations) of the message, or None
+    if the message has no observations to analyze
+    """
+    metrics.MESSAGE_BYTES.observe(len(body))
+    with metrics.STAGE_SECONDS.time('decode'):
+        current_reports = report_parser.Report.loads(body)
+    with metrics.STAGE_SECONDS.time('group'):
+        observations_per_ip = reports.ReportHandler.group_observations_by_ip(current_reports)
+    if len(observations_per_ip) == 0:
+        return None
+    return current_reports[0].user_id, current_reports[0].installation_id, observations_per_ip
+
+
+def analyze_ip_observations(ip, observations, user_id, installation_id):
+    """
+    :return: A tuple with the ip, the results, the user id and the installation id, or None if the observations of the
+    IP are not enough to be analyzed
+    """
+    log = logger.getChild('analyze_ip_observations')
+    log.info('Analyzing {} observations for IP {}, user {}, installation {}'.format(len(observations),
+                                                                                    ip,
+                                                                                    user_id,
+                                                                                    installation_id))
+    try:
+        results = analyze_observations(observations, state_key=(user_id, installation_id, ip))
+    except ValueError as error:
+        log.warning('Skipping IP {} of user {}, installation {}: {}'.format(ip, user_id, installation_id, error))
+        return None
+    return ip, results, user_id, installation_id
+
+
+def analyze_observations_per_ip(user_id, installation_id, observations_per_ip, executor=None):
+    """
+    Analyzes the observations of each IP of a message. When an executor is given the IPs are analyzed in it, in
+    parallel.
+
+    :return: A list with the (ip, results, user_id, installation_id) of each IP that could be analyzed, or None if none
+    could be analyzed
+    """
+    ips = [ip for ip, observations in observations_per_ip]
+    ips_observations = [observations for ip, observations in observations_per_ip]
+    users_ids = [user_id] * len(ips)
+    installations_ids = [installation_id] * len(ips)
+    if executor is not None:
+        analyzed_measures = map(metrics.merge_measured,
+                                executor.map(metrics.call_measured, repeat(analyze_ip_observations),
+                                             ips, ips_observations, users_ids, installations_ids))
+    else:
+        analyzed_measures = map(analyze_ip_observations, ips, ips_observations, users_ids, installations_ids)
+    analyzed_measures = [entry for entry in analyzed_measures if entry is not None]
+    if len(analyzed_measures) == 0:
+        return None
+    return analyzed_measures
+
+
+def analyze_measures(body, executor=None, results_cache=None):
+    """
+    Parses a measures message and analyzes the observations of each of its IPs.
+
+    :param body: The message body, a JSON list of reports
+    :param results_cache: If given, the results of a message already analyzed are taken from it
+    :return: A list with the (ip, results, user_id, installation_id) of each IP that could be analyzed, or None if the
+    message has no observations to analyze
+    """
+    if results_cache is not None:
+        cache_key = results_cache.key(body)
+        analyzed_measures = results_cache.get(cache_key)
+        if analyzed_measures is not None:
+            return analyzed_measures
+    parsed_measures = parse_measures(body)
+    if parsed_measures is None:
+        return None
+    analyzed_measures = analyze_observations_per_ip(*parsed_measures, executor=executor)
+    if analyzed_measures is not None and results_cache is not None:
+        results_cache.put(cache_key, analyzed_measures)
+    return analyzed_measures
+
+
+def post_analyzed_measures(analyzed_measures, results_spool=None):
+    """
+    :param results_spool: If given, the results that could not be posted are appended to it, to be posted later
+    :return: True only if the results of every IP were posted or spooled
+    """
+    outcomes = api_communication.post_results_bulk(analyzed_measures)
+    failed_measures = [entry for entry, posted in zip(analyzed_measures, outcomes) if not posted]
+    if len(failed_measures) == 0:
+        return True
+    if results_spool is None:
+        return False
+    try:
+        results_spool.append(failed_measures)
+    except OSError:
+        logger.exception('Could not spool the results of {} IPs'.format(len(failed_measures)))
+        return False
+    return True
+
+
+class AnalysisExecutors:
+    """
+    Pools of worker processes the messages are analyzed in.
+
+    Without route_installations, every message is analyzed in a single pool of workers processes. With it, each worker
+    process has a pool of its own and the messages of an installation are always analyzed by the same one, chosen by
+    the hash of the installation, so the caches of each process are hit by every message of its installations instead
+    of by about one in workers. In exchange, the IPs of a message are analyzed one after the other, and the messages of
+    an installation wait for its worker even when others are idle.
+    """
+    def __init__(self, workers, route_installations=False):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.workers = workers
+        self.route_installations = route_installations
+        self.executors = [self.create_executor() for _ in range(workers if route_installations else 1)]
+        self.lock = threading.Lock()
+
+    def create_executor(self):
+        return ProcessPoolExecutor(max_workers=1 if self.route_installations else self.workers)
+
+    def executor(self, user_id, installation_id):
+        return self.executors[hash((user_id, installation_id)) % len(self.executors)]
+
+    def replace(self, broken_executor):
+        with self.lock:
+            # Every message analyzed in the broken pool fails, but the pool is only replaced once
+            if broken_executor not in self.executors:
+                return
+            self.logger.error('A pool of worker processes broke, starting a new one')
+            self.executors[self.executors.index(broken_executor)] = self.create_executor()
+        broken_executor.shutdown(wait=False)
+
+    def shutdown(self, wait=True):
+        for executor in self.executors:
+            executor.shutdown(wait=wait)
+
+
+class ConcurrentConsumer:
+    """
+    Consumes the measures queue analyzing many messages at the same time.
+
+    Each message is parsed in a pool of threads, from which its results are later posted to the API, and the analysis
+    of its IPs runs in a pool of worker processes, so the CPU work goes on while waiting for the API. The IPs of a
+    message with observations from many IPs are analyzed in parallel. Every channel operation is done in the thread
+    that calls start_consuming, and each delivery is acked only after the results of all its IPs were posted, or
+    spooled when a results_spool is given. With a results_cache, a redelivered message is posted again without
+    analyzing it. Only the messages that cannot be parsed or analyzed are rejected with no requeue, the ones that
+    failed because of the processor (see INFRASTRUCTURE_ERRORS) are requeued, and a broken pool of worker processes
+    is replaced by a new one. With route_installations, the messages of an installation are always analyzed by the
+    same worker process (see AnalysisExecutors).
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, connection, channel, queue, workers, prefetch_count, results_spool=None, results_cache=None,
+                 route_installations=ROUTE_INSTALLATIONS):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.connection = connection
+        self.channel = channel
+        self.queue = queue
+        self.workers = workers
+        self.prefetch_count = prefetch_count
+        self.results_spool = results_spool
+        self.results_cache = results_cache
+        self.analysis_executors = AnalysisExecutors(workers, route_installations)
+        self.post_executor = ThreadPoolExecutor(max_workers=prefetch_count)
+        self.pending_deliveries = {}
+
+    def analyze_body(self, body):
+        # Parsed here, so the observations are only sent to the workers once, with the IP they are analyzed for
+        parsed_measures = parse_measures(body)
+        if parsed_measures is None:
+            return None
+        user_id, installation_id, observations_per_ip = parsed_measures
+        analysis_executor = self.analysis_executors.executor(user_id, installation_id)
+        try:
+            return analyze_observations_per_ip(user_id, installation_id, observations_per_ip,
+                                               executor=analysis_executor)
+        except BrokenProcessPool:
+            self.analysis_executors.replace(analysis_executor)
+            raise
+
+    def process_body(self, body):
+        if self.results_cache is None:
+            analyzed_measures = self.analyze_body(body)
+        else:
+            cache_key = self.results_cache.key(body)
+            analyzed_measures = self.results_cache.get(cache_key)
+            if analyzed_measures is None:
+                analyzed_measures = self.analyze_body(body)
+                if analyzed_measures is not None:
+                    self.results_cache.put(cache_key, analyzed_measures)
+        if analyzed_measures is None:
+            return None
+        return post_analyzed_measures(analyzed_measures, self.results_spool)
+
+    def on_message(self, channel, method, properties, body):
+        future = self.post_executor.submit(self.process_body, body)
+        self.pending_deliveries[future] = method.delivery_tag
+
+    def settle_finished_deliveries(self):
+        finished_futures = [future for future in self.pending_deliveries if future.done()]
+        for future in finished_futures:
+            delivery_tag = self.pending_deliveries.pop(future)
+            try:
+                posted = future.result()
+            except INFRASTRUCTURE_ERRORS:
+                self.logger.exception('Rejecting tag {} with requeue, message could not be processed by the processor'
+                                      .format(delivery_tag))
+                self.channel.basic_reject(delivery_tag, requeue=True)
+                metrics.MESSAGES.inc('requeued')
+                continue
+            except Exception:
+                self.logger.exception('Rejecting tag {} with no requeue, message could not be processed'
+                                      .format(delivery_tag))
+                self.channel.basic_reject(delivery_tag, requeue=False)
+                metrics.MESSAGES.inc('rejected')
+                continue
+            if posted is None:
+                self.logger.error('Rejecting tag {} with no requeue, message has no observations'
+                                  .format(delivery_tag))
+                self.channel.basic_reject(delivery_tag, requeue=False)
+                metrics.MESSAGES.inc('rejected')
+            elif posted:
+                self.channel.basic_ack(delivery_tag)
+                metrics.MESSAGES.inc('acked')
+            else:
+                self.logger.error('Could not post tag {} results to API, rejecting with requeue'.format(delivery_tag))
+                self.channel.basic_reject(delivery_tag, requeue=True)
+                metrics.MESSAGES.inc('requeued')
+
+    def start_consuming(self):
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.channel.basic_consume(self.on_message, queue=self.queue)
+        self.logger.info('Consuming with {} workers and a prefetch of {} messages'.format(self.workers,
+                                                                                          self.prefetch_count))
+        try:
+            while self.channel.is_open:
+                self.connection.process_data_events(time_limit=self.POLL_INTERVAL)
+                self.settle_finished_deliveries()
+        finally:
+            self.close()
+
+    def close(self):
+        self.post_executor.shutdown(wait=False)
+        self.analysis_executors.shutdown(wait=False)
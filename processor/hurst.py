@@ -1,6 +1,7 @@
 import math
 
-import logging
+import threading
+
 import numpy
 import pywt
 
@@ -25,6 +26,11 @@ def crs(data, n, nblk, nlag, overlap, output):
 
     Python version written by Paula Verghelet
 
+    NumPy version: the computation is done by crs_batch. The cumulative sums are
+    computed once with numpy.cumsum and, for every lag, the statistics of all the
+    blocks are computed at once as array operations instead of iterating over each
+    block and each observation.
+
     :param data:
     :param n:
     :param nblk:
@@ -33,170 +39,162 @@ def crs(data, n, nblk, nlag, overlap, output):
     :param output:
     :return:
     """
-    N = n
-    NBLK = nblk
-    NLAG = nlag
-    OVERLAP = overlap
-    blksize = 0
-    # print "N NBLK NLAG OVERLAP ", N, NBLK, NLAG, OVERLAP
-    i = 0
-    j = 0
-    k = 0
-    d = 0
-    correction = 0
-    NVAL = 0
-    increment = 0.0
-    temp = 0.0
-    min_ = 0.0
-    max_ = 0.0
-    s = 0.0
-    ave = 0.0
-    secondmom = 0.0
-    xcum = [0 for _ in range(N)]
-    xsqcum = [0 for _ in range(N)]
-    # Compute xcum's and xsqcum's.
-    xcum[0] = data[0]
-    xsqcum[0] = data[0] * data[0]
-    for i in range(1, N):
-        xcum[i] = xcum[i - 1] + data[i]
-        xsqcum[i] = xsqcum[i - 1] + data[i] * data[i]
+    range_ = crs_batch(numpy.asarray(data[:n])[numpy.newaxis, :], nblk, nlag, overlap)
+    output[:2 * nblk * nlag] = range_[0].tolist()
+
+
+def crs_batch(series, nblk=NBLK, nlag=NLAG, overlap=OVERLAP):
+    """
+    Computes the r and r/s statistics of crs for several series of the same length at once.
+
+    :param series: 2-D array like, one series per row
+    :param nblk:
+    :param nlag:
+    :param overlap:
+    :return: 2-D array with the crs output vector of each series in its corresponding row
+    """
+    series = numpy.asarray(series, dtype=numpy.float64)
+    n = series.shape[1]
+    output = numpy.zeros((series.shape[0], 2 * nblk * nlag))
+    # Cumulative sums with a leading zero, so that the sum of the block
+    # [start, start + d) is xcum[start + d] - xcum[start] for every block,
+    # including the first one.
+    xcum = numpy.insert(numpy.cumsum(series, axis=1), 0, 0.0, axis=1)
+    xsqcum = numpy.insert(numpy.cumsum(series * series, axis=1), 0, 0.0, axis=1)
     # Compute r and radj.
-    blksize = int(math.floor(N / NBLK))
-    if OVERLAP != 0:
-        increment = math.log10(float(N)) / NLAG
+    blksize = int(math.floor(n / nblk))
+    if overlap != 0:
+        increment = math.log10(float(n)) / nlag
     else:
-        increment = math.log10(float(blksize)) / NLAG
-    for k in range(0, NLAG):
-        if k == NLAG - 1:
+        increment = math.log10(float(blksize)) / nlag
+    for k in range(0, nlag):
+        if k == nlag - 1:
             d = int(math.pow(10.0, float((increment * (k + 1)))))
         else:
             d = int(math.ceil(math.pow(10.0, float((increment * (k + 1))))))
-            # print "D ", d
         # d observations used to compute r and radj for lag k.
         correction = int(math.ceil(float(d - blksize) / float(blksize)))
-        if correction == NBLK:
+        if correction == nblk:
             correction -= 1
         if d > blksize:
-            NVAL = NBLK - correction
+            nval = nblk - correction
         else:
-            NVAL = NBLK
-            # print "NVAL k+1 ", NVAL, k+1
-        # NVAL is the number of r and radj values computed for lag k.
-        # i = 0 is a special case.
-        max_ = 0.0
-        min_ = 0.0
-        ave = (1.0 / d) * xcum[d - 1]
-        for j in range(0, d):
-            temp = xcum[j] - (j + 1) * ave
-            if temp > max_:
-                max_ = temp
-            elif temp < min_:
-                min_ = temp
-                # r (k, 0) = max_ - min_
-        output[k * NBLK] = max_ - min_
-        # print "OUTPUT ", output[k * NBLK]
-        secondmom = float(1.0 / d) * xsqcum[d - 1]
-        if secondmom > ave * ave:
-            s = math.sqrt(secondmom - ave * ave)
-            # radj (k, 0) = r (k, 0) / s
-            output[NBLK * NLAG + k * NBLK] = float(output[k * NBLK]) / s
-            # print output[NBLK * NLAG + k * NBLK]
-        else:
-            # radj (k, 0) = r (k, 0)
-            output[NBLK * NLAG + k * NBLK] = float(output[k * NBLK])
-            # print output[NBLK * NLAG + k * NBLK]
-        # i > 0
-        for i in range(1, NVAL):
-            max_ = 0.0
-            min_ = 0.0
-            ave = (1.0 / d) * (xcum[blksize * i - 1 + d] - xcum[blksize * i - 1])
-            # print "AVE ", ave
-            for j in range(0, d):
-                temp = xcum[blksize * i + j] - xcum[blksize * i - 1] - (j + 1) * ave
-                if temp > max_:
-                    max_ = temp
-                elif temp < min_:
-                    min_ = temp
-                    # print "TEMP ", temp
-            output[k * NBLK + i] = max_ - min_
-            secondmom = (1.0 / d) * (xsqcum[blksize * i - 1 + d] - xsqcum[blksize * i - 1])
-            # print "SECONDMON", secondmom
-            if secondmom > ave * ave:
-                s = math.sqrt(secondmom - ave * ave)
-                # print "S ", s
-                output[NBLK * NLAG + k * NBLK + i] = output[k * NBLK + i] / s
-                # print "OUTP ", output[k * NBLK + i]
-            else:
-                # radj (k, i) = r (k, i)
-                output[NBLK * NLAG + k * NBLK + i] = output[k * NBLK + i]
-                # print "OUTP ", output[k * NBLK + i]
-                # print NBLK * NLAG + k * NBLK + i
-                # print output
+            nval = nblk
+        # nval is the number of r and radj values computed for lag k, one per block.
+        starts = blksize * numpy.arange(nval)
+        steps = numpy.arange(1, d + 1)
+        # Every array below has one row per series and one column per block.
+        ave = (1.0 / d) * (xcum[:, starts + d] - xcum[:, starts])
+        temp = (xcum[:, starts[:, numpy.newaxis] + steps] - xcum[:, starts][:, :, numpy.newaxis]) \
+            - steps * ave[:, :, numpy.newaxis]
+        # r (k, i) = max(0, temp) - min(0, temp)
+        r = numpy.maximum(temp.max(axis=2), 0.0) - numpy.minimum(temp.min(axis=2), 0.0)
+        secondmom = (1.0 / d) * (xsqcum[:, starts + d] - xsqcum[:, starts])
+        deviated = secondmom > ave * ave
+        s = numpy.sqrt(numpy.where(deviated, secondmom - ave * ave, 1.0))
+        # radj (k, i) = r (k, i) / s when the block is not constant, r (k, i) otherwise
+        radj = numpy.where(deviated, r / s, r)
+        output[:, k * nblk:k * nblk + nval] = r
+        output[:, nblk * nlag + k * nblk:nblk * nlag + k * nblk + nval] = radj
+    return output
+
+
+class RSLagPlan:
+    """
+    Lags used by the least-squares fit of the R/S estimator for the series of a given length.
+
+    Which lags are fitted and which ones are only checked depend only on the length of the series, so the plan of each
+    length is built once and kept. Plans can be shared between threads.
+    """
+    plans = {}
+    plans_lock = threading.Lock()
+
+    @classmethod
+    def for_length(cls, n):
+        plan = cls.plans.get(n)
+        if plan is None:
+            with cls.plans_lock:
+                plan = cls.plans.get(n)
+                if plan is None:
+                    plan = cls(n)
+                    cls.plans[n] = plan
+        return plan
+
+    def __init__(self, n):
+        self.n = n
+        increment = math.log10(n) / NLAG
+        positions = numpy.arange(NBLK * NLAG)
+        # Positions in the crs output of the r values fitted, and of the ones outside the fitted lags
+        fitted_positions = []
+        checked_positions = []
+        x = []
+        for i in range(0, NLAG):
+            # range_[(i - 1) * NBLK:i * NBLK] holds the r values of the lag i
+            lag_positions = positions[((i - 1) * NBLK):(i * NBLK)]
+            log10_lag = math.log10(math.floor(math.pow(10, (i * increment))))
+            if i * increment < POWER1:
+                # Above line changed 2/28/95 to make the plotting consistent
+                # with calculations.
+                checked_positions.append(lag_positions)
+            if (i * increment >= POWER1) and (log10_lag <= POWER2):
+                # Above/below line changed 2/28/95 to make plotting consistent
+                # with calculations.
+                fitted_positions.append(lag_positions)
+                x.append(numpy.full(len(lag_positions), log10_lag))
+            if i * increment > POWER2:
+                checked_positions.append(lag_positions)
+        self.fitted_positions = numpy.concatenate(fitted_positions)
+        self.fitted_adjusted_positions = NBLK * NLAG + self.fitted_positions
+        self.checked_positions = numpy.concatenate(checked_positions)
+        self.x = numpy.concatenate(x)
+        self.design = numpy.vstack([self.x, numpy.ones(len(self.x))]).T
+
+    def fit(self, ranges):
+        """
+        Fits log10(r/s) against log10(lag) for the crs output of several series.
+
+        :param ranges: 2-D array, the crs output of each series in its corresponding row
+        :return: array with the slope of each series, NaN where the series is constant
+        """
+        ranges = numpy.asarray(ranges, dtype=numpy.float64)
+        r = ranges[:, self.fitted_positions]
+        ra = ranges[:, self.fitted_adjusted_positions]
+        rc = ranges[:, self.checked_positions]
+        fittable = (r > 0.0000000001).any(axis=1) & (rc > 0.0000000001).any(axis=1)
+        estimations = numpy.full(len(ranges), numpy.nan)
+        # Only the lags with a positive r are fitted
+        positive = r > 0.0
+        for index in numpy.flatnonzero(fittable):
+            mask = positive[index]
+            # math.log10 keeps the estimations equal to the ones of the original list based fit
+            lra = list(map(math.log10, ra[index, mask].tolist()))
+            # Do the calculations for fitting a least-squares line. For R/S.
+            estimations[index] = numpy.linalg.lstsq(self.design[mask], lra)[0][0]
+        return estimations
+
+
+def _rs_fit(range_, n):
+    estimation = RSLagPlan.for_length(n).fit([range_])[0]
+    if numpy.isnan(estimation):
+        raise ValueError("Either the series is constant or no data was entered.")
+    return estimation
 
 
 def rs(data):
-    logger = logging.getLogger('plotrs')
-    logger.debug("data: {data}".format(data=data))
-    n = len(data)
-    increment = math.log10(n) / NLAG
     output = [0] * (2 * NBLK * NLAG)
     crs(data, len(data), NBLK, NLAG, OVERLAP, output)
-    range_ = output
-    logger.debug("range: {range}".format(range=str(range_)))
-    x = []
-    r = []
-    ra = []
-    xc = []
-    rc = []
-    rac = []
-    for i in range(0, NLAG):
-        if i * increment < POWER1:
-            xc += [math.log10(math.floor(math.pow(10, (i * increment))))] * NBLK
-            # Above line changed 2/28/95 to make the plotting consistent
-            # with calculations.
-            # range_[desde:hasta]
-            # desde 0 o desde 1?
-            rc += range_[((i - 1) * NBLK):(i * NBLK)]
-            rac += range_[(NBLK * NLAG + (i - 1) * NBLK):(NBLK * NLAG + i * NBLK)]
-        if (i * increment >= POWER1) and (math.log10(math.floor(math.pow(10, (i * increment)))) <= POWER2):
-            # Above/below line changed 2/28/95 to make plotting consistent
-            # with calculations.
-            x += [math.log10(math.floor(math.pow(10, (i * increment))))] * NBLK
-            r += range_[((i - 1) * NBLK):(i * NBLK)]
-            ra += range_[(NBLK * NLAG + (i - 1) * NBLK):(NBLK * NLAG + i * NBLK)]
-            logger.debug("x: {x}, r: {r}, ra: {ra}".format(x=x, r=r, ra=ra))
-        if i * increment > POWER2:
-            xc += [math.log10(math.floor(math.pow(10, (i * increment))))] * NBLK
-            # Above line changed 2/28/95 to make the plotting consistent
-            # with calculations.
-            # range_[desde:hasta]
-            # desde 0 o desde 1?
-            rc += range_[((i - 1) * NBLK):(i * NBLK)]
-            rac += range_[(NBLK * NLAG + (i - 1) * NBLK):(NBLK * NLAG + i * NBLK)]
-        logger.debug("i: {i}, x: {x}, ra: {ra}".format(i=i, x=x, ra=ra))
-    if len(list(filter((lambda x1: x1 > 0.0000000001), r))) > 0:
-        ld = [x[i] for i in range(0, len(x)) if i in [j for j in range(0, len(r)) if r[j] > 0.0]]
-        # ld contains the values of x which position in the array coincides with the position of the values in r
-        # that satisfies the condition
-        rat = [ra[i] for i in range(0, len(ra)) if i in [j for j in range(0, len(r)) if r[j] > 0.0]]
-        logger.debug("rat: {rat}".format(rat=rat))
-        lra = list(map(math.log10, rat))
-        logger.debug("ld: {ld} lra: {lra}".format(ld=ld, lra=lra))
-    else:
-        raise ValueError("Either the series is constant or no data was entered.")
-    if len(list(filter((lambda x1: x1 > 0.0000000001), rc))) > 0:
-        ratc = [rac[i] for i in range(0, len(rac)) if i in [j for j in range(0, len(rc)) if rc[j] > 0.0]]
-        lrac = []
-        for i in range(0, len(ratc)):
-            if ratc[i] > 0:
-                lrac.append(math.log10(ratc[i]))
-    else:
-        raise ValueError("Either the series is constant or no data was entered.")
-    # Do the calculations for fitting a least-squares line. For R/S.
-    a = numpy.vstack([ld, numpy.ones(len(ld))]).T
-    ba, ma = numpy.linalg.lstsq(a, lra)[0]
-    logger.debug("ld: {ld} lra: {lra}".format(ld=ld, lra=lra))
-    return ba
+    return _rs_fit(output, len(data))
+
+
+def rs_batch(series):
+    """
+    R/S estimator of H for several series of the same length at once.
+
+    :param series: 2-D array like, one series per row
+    :return: array with the estimation for each series, NaN where the series is constant
+    """
+    ranges = crs_batch(series, NBLK, NLAG, OVERLAP)
+    return RSLagPlan.for_length(numpy.shape(series)[1]).fit(ranges)
 
 
 def wavelet(data, order=2, octaves_bounds=(2, 8)):
@@ -246,68 +244,143 @@ def wavelet(data, order=2, octaves_bounds=(2, 8)):
     :param octaves_bounds
     :return:
     """
-    N = order
-    # R:	call = match.call()
-    j1 = octaves_bounds[0]
-    j2 = octaves_bounds[1]
-    # R:	if(is.null(length)) length = 2^floor(log(length(x))/log(2))
-    length = int(2 ** math.floor(math.log(len(data), 2)))
-    # R:	noctave = log(length, base = 2) - 1
-    noctave = int(math.log(length, 2)) - 1
-    # R:	bound.effect = ceiling(log(2*N, base = 2))
-    bound_effect = int(math.ceil(math.log(2 * N, 2)))
-    # R:	statistic = rep(0, noctave)
-    statistic = [0] * noctave
-    if j2 > noctave - bound_effect:
-        # R: cat("Upper bound too high, resetting to ", noctave-bound.effect, "\n")
-        # R:	j2 = noctave - bound.effect
-        # R:	octave[2] = j2
-        j2 = noctave - bound_effect
-    # R:	for (j in 1:(noctave - bound.effect)) {
-    # R:	    statistic[j] = log(mean((.waccessD(transform,
-    # R:	        lev = (noctave+1-j))[N:(2^(noctave+1-j)-N)])^2), base = 2)
-    #  db2 = Daubechies filter coefficients, phase 2
-    # ppd = periodic
-    # wdec = pywt.wavedec(data[0:(int(length))], 'db2', 'ppd', level=int(noctave) + 1)  # esto debería ser noctave - 1?
-    wdec = pywt.wavedec(data[:length], 'db2', 'ppd', level=noctave - 1)
-    # print "len wdec ", len(wdec)
-    # print wdec[8]
-    for j in range(0, (noctave - bound_effect)):
-        # wdec_level = wdec[int(noctave) + 1 - j][N:(2 ** (int(noctave) + 1 - j) - N)]
-        wdec_level = wdec[noctave - 1 - j][N - 1:(2 ** (noctave - j) - N)]
-        # print "wdec_level   ", wdec_level
-        statistic[j] = math.log(numpy.mean([wdec_level[i] ** 2 for i in range(0, len(wdec_level))]), 2)
-    # R: Fit:
-    # R:	X = 10^c(j1:j2)
-    # R:	Y = 10^statistic[j1:j2]
-    # R:	fit = lsfit(log10(X), log10(Y))
-    # R:	fitH = lsfit(log10(X), log10(Y*X)/2)
-    # R:	diag = as.data.frame(ls.print(fitH, print.it = FALSE)[[2]][[1]])
-    # R:	beta = fit$coef[[2]]
-    # R:	H = (beta+1)/2
-
-    # Fit:
-    x = [10 ** i for i in range(j1, j2 + 1)]
-    y = [10 ** i for i in statistic[j1 - 1:j2]]
-
-    # R:	fit = lsfit(log10(X), log10(Y))
-    # R:	fitH = lsfit(log10(X), log10(Y*X)/2)
-    log10_x = [math.log10(x[i]) for i in range(0, len(x))]
-    log10_y = [math.log10(y[i]) for i in range(0, len(y))]
-    log10_yx = [math.log10(y[i] * x[i]) / 2 for i in range(0, len(y))]
-
-    A = numpy.vstack([log10_x, numpy.ones(len(x))]).T
-    fit, coef1 = numpy.linalg.lstsq(A, log10_y)[0]
-
-    B = numpy.vstack([log10_x, numpy.ones(len(x))]).T
-    fitH, coef2 = numpy.linalg.lstsq(B, log10_yx)[0]
-
-    # residuals= numpy.linalg.lstsq(B, yy_)[1]
-    # residuals : {(), (1,), (K,)} ndarray
-    # Sums of residuals; squared Euclidean 2-norm for each column in b - a*x.
-    # If the rank of a is < N or > M, this is an empty array.
-    # If b is 1-dimensional, this is a (1,) shape array. Otherwise the shape is (K,).
-
-    beta = fit
-    H = (beta + 1) / 2
-    return fitH
+    return wavelet_batch([data], order, octaves_bounds)[0]
+
+
+class WaveletHurstEstimator:
+    """
+    Wavelet estimator of H for several series of the same length at once.
+
+    The octaves of the decomposition and the regression design only depend on the length of the series, so they are
+    computed once per length and kept. The decomposition of all the series is done in a single pywt call, while the
+    statistic of each level and the fit of each series are calculated one at a time. Instances can be shared between
+    threads.
+    """
+    WAVELET_NAME = 'db2'
+    WAVELET_MODE = 'ppd'
+
+    class Plan:
+        """
+        Octaves and regression design for the series of a given length.
+        """
+        def __init__(self, length, noctave, levels, octaves, x, design):
+            self.length = length
+            self.noctave = noctave
+            self.levels = levels
+            self.octaves = octaves
+            self.x = x
+            self.design = design
+
+    def __init__(self, order=2, octaves_bounds=(2, 8)):
+        self.order = order
+        self.octaves_bounds = octaves_bounds
+        #  db2 = Daubechies filter coefficients, phase 2
+        self.wavelet = pywt.Wavelet(self.WAVELET_NAME)
+        self.plans = {}
+        self.plans_lock = threading.Lock()
+
+    def plan(self, series_length):
+        plan = self.plans.get(series_length)
+        if plan is None:
+            with self.plans_lock:
+                plan = self.plans.get(series_length)
+                if plan is None:
+                    plan = self._build_plan(series_length)
+                    self.plans[series_length] = plan
+        return plan
+
+    def _build_plan(self, series_length):
+        N = self.order
+        # R:	call = match.call()
+        j1 = self.octaves_bounds[0]
+        j2 = self.octaves_bounds[1]
+        # R:	if(is.null(length)) length = 2^floor(log(length(x))/log(2))
+        length = int(2 ** math.floor(math.log(series_length, 2)))
+        # R:	noctave = log(length, base = 2) - 1
+        noctave = int(math.log(length, 2)) - 1
+        # R:	bound.effect = ceiling(log(2*N, base = 2))
+        bound_effect = int(math.ceil(math.log(2 * N, 2)))
+        if j2 > noctave - bound_effect:
+            # R: cat("Upper bound too high, resetting to ", noctave-bound.effect, "\n")
+            # R:	j2 = noctave - bound.effect
+            # R:	octave[2] = j2
+            j2 = noctave - bound_effect
+        # R:	for (j in 1:(noctave - bound.effect)) {
+        # R:	    statistic[j] = log(mean((.waccessD(transform,
+        # R:	        lev = (noctave+1-j))[N:(2^(noctave+1-j)-N)])^2), base = 2)
+        # Each level j is the (index in the decomposition, first coefficient, end coefficient) used for statistic[j]
+        levels = [(noctave - 1 - j, N - 1, 2 ** (noctave - j) - N) for j in range(0, (noctave - bound_effect))]
+        # R: Fit:
+        # R:	X = 10^c(j1:j2)
+        # R:	fitH = lsfit(log10(X), log10(Y*X)/2)
+        x = [10 ** i for i in range(j1, j2 + 1)]
+        log10_x = [math.log10(x[i]) for i in range(0, len(x))]
+        design = numpy.vstack([log10_x, numpy.ones(len(x))]).T
+        return self.Plan(length, noctave, levels, (j1, j2), x, design)
+
+    def estimate(self, series):
+        """
+        :param series: 2-D array like, one series per row
+        :return: array with the estimation for each series
+        """
+        series = numpy.asarray(series, dtype=numpy.float64)
+        plan = self.plan(series.shape[1])
+        j1, j2 = plan.octaves
+        # ppd = periodic
+        wdec = pywt.wavedec(series[:, :plan.length], self.wavelet, self.WAVELET_MODE, level=plan.noctave - 1, axis=1)
+        estimations = numpy.empty(len(series))
+        for index in range(len(series)):
+            # R:	statistic = rep(0, noctave)
+            # The statistics and the fit use the same scalar operations as the original list based estimator, so the
+            # estimations are exactly the same
+            statistic = [math.log(numpy.mean(wdec[level][index, start:end] ** 2), 2)
+                         for level, start, end in plan.levels]
+            # R:	Y = 10^statistic[j1:j2]
+            y = [10 ** value for value in statistic[j1 - 1:j2]]
+            # R:	fitH = lsfit(log10(X), log10(Y*X)/2)
+            log10_yx = [math.log10(y[i] * plan.x[i]) / 2 for i in range(0, len(y))]
+            fitH, coef2 = numpy.linalg.lstsq(plan.design, log10_yx)[0]
+            estimations[index] = fitH
+        return estimations
+
+
+wavelet_estimators = {}
+wavelet_estimators_lock = threading.Lock()
+
+
+def wavelet_estimator(order=2, octaves_bounds=(2, 8)):
+    """
+    Returns the WaveletHurstEstimator shared by every caller with the same parameters.
+    """
+    key = (order, tuple(octaves_bounds))
+    with wavelet_estimators_lock:
+        if key not in wavelet_estimators:
+            wavelet_estimators[key] = WaveletHurstEstimator(order, tuple(octaves_bounds))
+        return wavelet_estimators[key]
+
+
+def wavelet_batch(series, order=2, octaves_bounds=(2, 8)):
+    """
+    Wavelet estimator of H for several series of the same length at once.
+    The wavelet decomposition of all the series is done in a single pywt call.
+
+    :param series: 2-D array like, one series per row
+    :param order:
+    :param octaves_bounds:
+    :return: array with the estimation for each series
+    """
+    return wavelet_estimator(order, octaves_bounds).estimate(series)
+
+
+def hurst_batch(series):
+    """
+    Estimates H with both the wavelet and the R/S estimators for several series of the same length at once.
+
+    :param series: 2-D array like, one series per row
+    :return: dict with the wavelet and rs estimations arrays, one value per series
+    """
+    series = numpy.asarray(series, dtype=numpy.float64)
+    return {
+        'wavelet': wavelet_batch(series),
+        'rs': rs_batch(series)
+    }
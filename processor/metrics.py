@@ -0,0 +1,298 @@
+import bisect
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+# Port of the local HTTP endpoint serving the metrics in the Prometheus text format. With 0, they are not served.
+METRICS_PORT = int(os.environ.get('TIX_METRICS_PORT', '0'))
+# Address the metrics endpoint listens on
+METRICS_HOST = os.environ.get('TIX_METRICS_HOST', '127.0.0.1')
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+
+class Metric:
+    """
+    A metric with a value for each combination of the values of its labels.
+    """
+    TYPE = None
+
+    def __init__(self, name, help, labels_names=()):
+        self.name = name
+        self.help = help
+        self.labels_names = tuple(labels_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def check_labels(self, labels_values):
+        if len(labels_values) != len(self.labels_names):
+            raise ValueError('Metric {} expects the labels {}, got {}'.format(self.name, self.labels_names,
+                                                                              labels_values))
+        return tuple(labels_values)
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def drain(self):
+        """
+        :return: The values recorded since the last drain, which are forgotten
+        """
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.TYPE)]
+        with self.lock:
+            for labels_values in sorted(self.values):
+                lines += self.render_value(list(zip(self.labels_names, labels_values)), self.values[labels_values])
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, *labels_values, amount=1):
+        labels_values = self.check_labels(labels_values)
+        with self.lock:
+            self.values[labels_values] = self.values.get(labels_values, 0) + amount
+
+    def value(self, *labels_values):
+        return self.values.get(self.check_labels(labels_values), 0)
+
+    def merge(self, values):
+        with self.lock:
+            for labels_values, value in values.items():
+                self.values[labels_values] = self.values.get(labels_values, 0) + value
+
+    def render_value(self, labels, value):
+        return ['{}{} {}'.format(self.name, format_labels(labels), format_value(value))]
+
+
+class Histogram(Metric):
+    """
+    Counts the observed values in buckets, along with their sum and count. The count of each bucket is kept apart,
+    and only accumulated when rendered.
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels_values):
+        labels_values = self.check_labels(labels_values)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if labels_values not in self.values:
+                self.values[labels_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram = self.values[labels_values]
+            histogram[0][bucket_index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, *labels_values):
+        """
+        Observes the seconds spent in the block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels_values)
+
+    def count(self, *labels_values):
+        histogram = self.values.get(self.check_labels(labels_values))
+        return histogram[2] if histogram is not None else 0
+
+    def merge(self, values):
+        with self.lock:
+            for labels_values, (buckets_counts, values_sum, values_count) in values.items():
+                if labels_values not in self.values:
+                    self.values[labels_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                histogram = self.values[labels_values]
+                histogram[0] = [count + other_count for count, other_count in zip(histogram[0], buckets_counts)]
+                histogram[1] += values_sum
+                histogram[2] += values_count
+
+    def render_value(self, labels, value):
+        buckets_counts, values_sum, values_count = value
+        lines = []
+        cumulative_count = 0
+        for bound, count in zip(self.buckets + (float('inf'),), buckets_counts):
+            cumulative_count += count
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels + [('le', format_value(bound))]),
+                                                 cumulative_count))
+        lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), format_value(values_sum)))
+        lines.append('{}_count{} {}'.format(self.name, format_labels(labels), values_count))
+        return lines
+
+
+class CallbackMetric:
+    """
+    A metric whose value is read from a function when rendered, for values kept by other objects.
+    """
+
+    def __init__(self, name, help, function, type='gauge'):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.TYPE = type
+
+    def reset(self):
+        pass
+
+    def render(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.TYPE),
+                '{} {}'.format(self.name, format_value(self.function()))]
+
+
+class MetricsRegistry:
+    """
+    The metrics of a process.
+
+    The metrics recorded in worker processes are drained there and merged into the registry of the main process, see
+    call_measured.
+    """
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError('Metric {} is already registered'.format(metric.name))
+            self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def counter(self, name, help, labels_names=()):
+        return self.register(Counter(name, help, labels_names))
+
+    def histogram(self, name, help, labels_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels_names, buckets))
+
+    def callback(self, name, help, function, type='gauge'):
+        return self.register(CallbackMetric(name, help, function, type))
+
+    def reset(self):
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+    def drain(self):
+        return {metric.name: metric.drain() for metric in list(self.metrics.values()) if isinstance(metric, Metric)}
+
+    def merge(self, drained_values):
+        for name, values in drained_values.items():
+            self.metrics[name].merge(values)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines += metric.render()
+            except Exception:
+                logger.exception('Could not render the metric {}'.format(metric.name))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+MESSAGE_BYTES = registry.histogram('tix_processor_message_bytes', 'Size of the measures messages in bytes.',
+                                   buckets=tuple(1024 * 4 ** exponent for exponent in range(8)))
+STAGE_SECONDS = registry.histogram('tix_processor_stage_seconds', 'Seconds spent in each stage of the processing.',
+                                   ('stage',))
+MESSAGES = registry.counter('tix_processor_messages_total', 'Measures messages settled, by outcome.', ('outcome',))
+API_POSTS = registry.counter('tix_processor_api_posts_total', 'Posts to the API, by outcome.', ('outcome',))
+
+if hasattr(os, 'register_at_fork'):
+    # A forked worker only reports what it records itself
+    os.register_at_fork(after_in_child=registry.reset)
+
+
+def call_measured(function, *args):
+    """
+    Calls the function, returning its result along with the metrics recorded by the call when it runs in a worker
+    process. The result is taken with merge_measured in the main process, which merges the metrics into its registry.
+    """
+    result = function(*args)
+    if multiprocessing.current_process().name == 'MainProcess':
+        return result, None
+    return result, registry.drain()
+
+
+def merge_measured(measured):
+    result, drained_values = measured
+    if drained_values is not None:
+        registry.merge(drained_values)
+    return result
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the metrics of a registry at /metrics from a background thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT, metrics_registry=registry):
+        HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.registry = metrics_registry
+        self.thread = threading.Thread(target=self.serve_forever, name=self.__class__.__name__, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://{host}:{port}/metrics'.format(host=self.server_address[0], port=self.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        logger.info('Serving the metrics at {}'.format(self.url))
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
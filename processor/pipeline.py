@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from processor import consumer
+from processor import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPipeline:
+    """
+    Processes the measures messages in three stages joined by bounded queues: parse, analyze and post.
+
+    Parsing runs in a thread, the analysis in a pool of worker processes and the posts in a pool of threads, so the
+    three stages run concurrently and the event loop is free to move the messages between them. When a stage falls
+    behind its input queue fills up, the previous stages stop and, in the end, submit blocks until there is room again.
+
+    Once a message is done settle(delivery_tag, outcome) is called from the event loop, where outcome is True if the
+    results of all its IPs were posted, or spooled when a results_spool is given, False if they could not be posted
+    and None if the message must be discarded. Only the messages that cannot be parsed or analyzed are discarded, the
+    ones that failed because of the processor (see consumer.INFRASTRUCTURE_ERRORS) are settled with False, so they
+    are requeued, and a broken pool of worker processes is replaced by a new one. With a results_cache, a redelivered
+    message goes straight from the parse stage to the post stage. With route_installations, the messages of an
+    installation are always analyzed by the same worker process (see consumer.AnalysisExecutors).
+    """
+
+    def __init__(self, settle, workers, queue_size, posters=None, results_spool=None, results_cache=None,
+                 route_installations=consumer.ROUTE_INSTALLATIONS):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.settle = settle
+        self.results_spool = results_spool
+        self.results_cache = results_cache
+        self.workers = workers
+        self.route_installations = route_installations
+        self.posters = posters or queue_size
+        self.queue_size = queue_size
+        self.parse_queue = None
+        self.analyze_queue = None
+        self.post_queue = None
+        self.parse_executor = None
+        self.analysis_executors = None
+        self.post_executor = None
+        self.tasks = []
+
+    async def start(self):
+        self.parse_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.analyze_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.post_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.parse_executor = ThreadPoolExecutor(max_workers=1)
+        self.analysis_executors = consumer.AnalysisExecutors(self.workers, self.route_installations)
+        self.post_executor = ThreadPoolExecutor(max_workers=self.posters)
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self.parse_stage())]
+        self.tasks += [loop.create_task(self.analyze_stage()) for _ in range(self.workers)]
+        self.tasks += [loop.create_task(self.post_stage()) for _ in range(self.posters)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.parse_executor.shutdown(wait=False)
+        self.analysis_executors.shutdown(wait=False)
+        self.post_executor.shutdown(wait=False)
+
+    async def submit(self, delivery_tag, body):
+        await self.parse_queue.put((delivery_tag, body))
+
+    async def join(self):
+        await self.parse_queue.join()
+        await self.analyze_queue.join()
+        await self.post_queue.join()
+
+    def discard(self, delivery_tag):
+        self.settle(delivery_tag, None)
+
+    def requeue(self, delivery_tag):
+        self.settle(delivery_tag, False)
+
+    async def parse_stage(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            delivery_tag, body = await self.parse_queue.get()
+            try:
+                cache_key = None
+                if self.results_cache is not None:
+                    cache_key = self.results_cache.key(body)
+                    analyzed_measures = self.results_cache.get(cache_key)
+                    if analyzed_measures is not None:
+                        await self.post_queue.put((delivery_tag, analyzed_measures))
+                        continue
+                parsed_measures = await loop.run_in_executor(self.parse_executor, consumer.parse_measures, body)
+                if parsed_measures is None:
+                    self.discard(delivery_tag)
+                else:
+                    await self.analyze_queue.put((delivery_tag, cache_key, parsed_measures))
+            except consumer.INFRASTRUCTURE_ERRORS:
+                self.logger.exception('Could not parse tag {}, requeuing it'.format(delivery_tag))
+                self.requeue(delivery_tag)
+            except Exception:
+                self.logger.exception('Could not parse tag {}'.format(delivery_tag))
+                self.discard(delivery_tag)
+            finally:
+                self.parse_queue.task_done()
+
+    async def analyze_stage(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            delivery_tag, cache_key, (user_id, installation_id, observations_per_ip) = await self.analyze_queue.get()
+            analysis_executor = self.analysis_executors.executor(user_id, installation_id)
+            try:
+                # The IPs of a message are analyzed in parallel
+                analyzed_measures = await asyncio.gather(*[
+                    loop.run_in_executor(analysis_executor, metrics.call_measured,
+                                         consumer.analyze_ip_observations, ip, observations, user_id, installation_id)
+                    for ip, observations in observations_per_ip])
+                analyzed_measures = [entry for entry in map(metrics.merge_measured, analyzed_measures)
+                                     if entry is not None]
+                if len(analyzed_measures) == 0:
+                    self.discard(delivery_tag)
+                else:
+                    if cache_key is not None:
+                        self.results_cache.put(cache_key, analyzed_measures)
+                    await self.post_queue.put((delivery_tag, analyzed_measures))
+            except consumer.INFRASTRUCTURE_ERRORS as error:
+                self.logger.exception('Could not analyze tag {}, requeuing it'.format(delivery_tag))
+                if isinstance(error, BrokenProcessPool):
+                    self.analysis_executors.replace(analysis_executor)
+                self.requeue(delivery_tag)
+            except Exception:
+                self.logger.exception('Could not analyze tag {}'.format(delivery_tag))
+                self.discard(delivery_tag)
+            finally:
+                self.analyze_queue.task_done()
+
+    async def post_stage(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            delivery_tag, analyzed_measures = await self.post_queue.get()
+            try:
+                posted = await loop.run_in_executor(self.post_executor, consumer.post_analyzed_measures,
+                                                    analyzed_measures, self.results_spool)
+                self.settle(delivery_tag, posted)
+            except consumer.INFRASTRUCTURE_ERRORS:
+                self.logger.exception('Could not post tag {}, requeuing it'.format(delivery_tag))
+                self.requeue(delivery_tag)
+            except Exception:
+                self.logger.exception('Could not post tag {}'.format(delivery_tag))
+                self.discard(delivery_tag)
+            finally:
+                self.post_queue.task_done()
+
+
+class AsyncPipelineConsumer:
+    """
+    Feeds an AsyncPipeline, running in its own event loop thread, with the messages of a pika BlockingConnection.
+
+    Every channel operation is done in the thread that calls start_consuming. Deliveries are submitted to the pipeline
+    from the pika callback, which blocks while the pipeline is full, so no more messages are consumed until the slowest
+    stage catches up.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, connection, channel, queue_name, workers, prefetch_count, queue_size=None,
+                 results_spool=None, results_cache=None):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.connection = connection
+        self.channel = channel
+        self.queue_name = queue_name
+        self.prefetch_count = prefetch_count
+        self.settlements = queue.Queue()
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.pipeline = AsyncPipeline(settle=self.on_settle,
+                                      workers=workers,
+                                      queue_size=queue_size or workers,
+                                      posters=prefetch_count,
+                                      results_spool=results_spool,
+                                      results_cache=results_cache)
+
+    def on_settle(self, delivery_tag, outcome):
+        self.settlements.put((delivery_tag, outcome))
+
+    def run_in_loop(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def on_message(self, channel, method, properties, body):
+        self.run_in_loop(self.pipeline.submit(method.delivery_tag, body))
+
+    def settle_deliveries(self):
+        while not self.settlements.empty():
+            delivery_tag, outcome = self.settlements.get()
+            if outcome is None:
+                self.logger.error('Rejecting tag {} with no requeue'.format(delivery_tag))
+                self.channel.basic_reject(delivery_tag, requeue=False)
+                metrics.MESSAGES.inc('rejected')
+            elif outcome:
+                self.channel.basic_ack(delivery_tag)
+                metrics.MESSAGES.inc('acked')
+            else:
+                self.logger.error('Could not post tag {} results to API, rejecting with requeue'.format(delivery_tag))
+                self.channel.basic_reject(delivery_tag, requeue=True)
+                metrics.MESSAGES.inc('requeued')
+
+    def start_consuming(self):
+        self.loop_thread.start()
+        self.run_in_loop(self.pipeline.start())
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.channel.basic_consume(self.on_message, queue=self.queue_name)
+        try:
+            while self.channel.is_open:
+                self.connection.process_data_events(time_limit=self.POLL_INTERVAL)
+                self.settle_deliveries()
+        finally:
+            self.close()
+
+    def close(self):
+        self.run_in_loop(self.pipeline.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
@@ -2,28 +2,41 @@ import base64
 import json
 
 import logging
+import os
+import random
 
 import struct
 
 import inflection
 import jsonschema
+import numpy
 
 logger = logging.getLogger(__name__)
 
+# Report schema validation mode for the decoder: 'always', 'sample' or 'never'.
+# Only queues fed by trusted services should use 'sample' or 'never'.
+TIX_REPORT_VALIDATION_MODE = os.environ.get('TIX_REPORT_VALIDATION_MODE', 'always').lower()
+# Fraction of the reports that are validated in 'sample' mode
+TIX_REPORT_VALIDATION_SAMPLE_RATE = float(os.environ.get('TIX_REPORT_VALIDATION_SAMPLE_RATE', '0.1'))
+
 class ReportFieldTypes:
     class ReportFieldType:
-        def __init__(self, name, byte_size, struct_type):
+        def __init__(self, name, byte_size, struct_type, numpy_type):
             self.name = name
             self.byte_size = byte_size
             self.struct_type = struct_type
+            self.numpy_type = numpy_type
 
         def get_struct_representation(self):
             return ReportFieldTypes.endian_type + self.struct_type
 
+        def get_numpy_representation(self):
+            return ReportFieldTypes.endian_type + self.numpy_type
+
     endian_type = '>'
-    Integer = ReportFieldType('int', 4, 'i')
-    Char = ReportFieldType('char', 1, 'c')
-    Long = ReportFieldType('long', 8, 'q')
+    Integer = ReportFieldType('int', 4, 'i', 'i4')
+    Char = ReportFieldType('char', 1, 'c', 'S1')
+    Long = ReportFieldType('long', 8, 'q', 'i8')
 
 
 class FieldTranslation:
@@ -45,6 +58,14 @@ class FieldTranslation:
 
 
 class Observation:
+    """
+    A single observation. Observations are values: their fields are not modified once created, so their hash is
+    calculated only once.
+    """
+    __slots__ = ('day_timestamp', 'type_identifier', 'packet_size',
+                 'initial_timestamp_nanos', 'reception_timestamp_nanos', 'sent_timestamp_nanos',
+                 'final_timestamp_nanos', 'upstream_phi', 'downstream_phi', 'estimated_phi', '_hash')
+
     def __init__(self, day_timestamp, type_identifier, packet_size,
                  initial_timestamp, reception_timestamp, sent_timestamp, final_timestamp):
         self.day_timestamp = day_timestamp
@@ -57,6 +78,7 @@ class Observation:
         self.upstream_phi = 0.0
         self.downstream_phi = 0.0
         self.estimated_phi = 0.0
+        self._hash = None
 
     @property
     def initial_timestamp(self):
@@ -74,22 +96,39 @@ class Observation:
     def final_timestamp(self):
         return self.final_timestamp_nanos
 
+    def as_tuple(self):
+        return (self.day_timestamp,
+                self.type_identifier,
+                self.packet_size,
+                self.initial_timestamp_nanos,
+                self.reception_timestamp_nanos,
+                self.sent_timestamp_nanos,
+                self.final_timestamp_nanos)
+
+    def _phis(self):
+        return self.upstream_phi, self.downstream_phi, self.estimated_phi
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+            return self.as_tuple() == other.as_tuple() and self._phis() == other._phis()
         return NotImplemented
 
     def __hash__(self):
-        return hash((self.day_timestamp,
-                     self.type_identifier,
-                     self.packet_size,
-                     self.initial_timestamp_nanos,
-                     self.reception_timestamp_nanos,
-                     self.sent_timestamp_nanos,
-                     self.final_timestamp_nanos))
+        if self._hash is None:
+            self._hash = hash(self.as_tuple())
+        return self._hash
+
+    def __getstate__(self):
+        # The hash is left out, since the hash of bytes changes between processes
+        return self.as_tuple() + self._phis()
+
+    def __setstate__(self, state):
+        self.__init__(*state[:7])
+        self.upstream_phi, self.downstream_phi, self.estimated_phi = state[7:]
 
     def __repr__(self):
-        return '{0!s}({1!r})'.format(self.__class__, self.__dict__)
+        fields = dict(zip(self.__slots__[:-1], self.as_tuple() + self._phis()))
+        return '{0!s}({1!r})'.format(self.__class__, fields)
 
 
 class SerializedObservationField:
@@ -120,34 +159,171 @@ class SerializedObservation:
         SerializedObservationField('final_timestamp', ReportFieldTypes.Long),
     ]
     byte_size = sum([field.type.byte_size for field in fields])
+    struct_format = ReportFieldTypes.endian_type + ''.join([field.type.struct_type for field in fields])
+    compiled_struct = struct.Struct(struct_format)
+    # Packed big endian NumPy representation of a serialized observation, byte compatible with struct_format
+    dtype = numpy.dtype([(field.name, field.type.get_numpy_representation()) for field in fields])
+
+
+class ObservationBatch:
+    """
+    Columnar representation of a sequence of observations.
+
+    The observations are kept in a NumPy structured array with one column per SerializedObservation field,
+    so each column can be used as an array in vectorized computations. Indexing with an integer returns an
+    Observation, while any other index (slices, masks or arrays of indexes) returns an ObservationBatch.
+    The array may also have the SerializedObservation dtype, as when it is a view of a deserialized message.
+    """
+    dtype = numpy.dtype([(field.name, field.type.numpy_type) for field in SerializedObservation.fields])
+
+    @classmethod
+    def from_observations(cls, observations):
+        return cls(numpy.array([observation.as_tuple() for observation in observations], dtype=cls.dtype))
+
+    @classmethod
+    def concatenate(cls, batches):
+        return cls(numpy.concatenate([batch.array.astype(cls.dtype, copy=False) for batch in batches]))
+
+    def __init__(self, array=None):
+        if array is None:
+            array = numpy.empty(0, dtype=self.dtype)
+        self.array = array
+
+    @property
+    def day_timestamp(self):
+        return self.array['day_timestamp']
+
+    @property
+    def type_identifier(self):
+        return self.array['type_identifier']
+
+    @property
+    def packet_size(self):
+        return self.array['packet_size']
+
+    @property
+    def initial_timestamp(self):
+        return self.array['initial_timestamp']
+
+    @property
+    def reception_timestamp(self):
+        return self.array['reception_timestamp']
+
+    @property
+    def sent_timestamp(self):
+        return self.array['sent_timestamp']
+
+    @property
+    def final_timestamp(self):
+        return self.array['final_timestamp']
+
+    def sorted_by(self, keys):
+        return self[numpy.argsort(keys, kind='mergesort')]
+
+    def deduplicated(self):
+        """
+        Removes the repeated observations, keeping the first occurrence of each one in its place.
+        """
+        day_timestamps = self.day_timestamp
+        if numpy.all(day_timestamps[1:] > day_timestamps[:-1]):
+            # Time ordered observations without repeated timestamps, as in the reports, cannot be repeated
+            return self
+        # The serialized rows are compared as raw bytes, which is the same as comparing every field
+        rows = numpy.ascontiguousarray(self.array.astype(SerializedObservation.dtype, copy=False))
+        rows = rows.view(numpy.dtype((numpy.void, SerializedObservation.dtype.itemsize)))
+        first_indexes = numpy.unique(rows, return_index=True)[1]
+        if len(first_indexes) == len(self):
+            return self
+        return self[numpy.sort(first_indexes)]
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        for row in self.array.tolist():
+            yield Observation(*row)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, numpy.integer)):
+            return Observation(*self.array[item].item())
+        return self.__class__(self.array[item])
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return numpy.array_equal(self.array.astype(self.dtype, copy=False),
+                                     other.array.astype(self.dtype, copy=False))
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        if isinstance(other, (set, frozenset)):
+            # As a collection of distinct observations
+            return len(self) == len(other) and set(self) == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0!s}({1!r})'.format(self.__class__, self.array)
+
+
+def as_observation_batch(observations):
+    if isinstance(observations, ObservationBatch):
+        return observations
+    return ObservationBatch.from_observations(observations)
 
 
 def serialize_observations(observations):
-    bytes_message = bytes()
-    for observation in observations:
-        observation_bytes = bytes()
-        for field in SerializedObservation.fields:
-            field_bytes = struct.pack(field.type.get_struct_representation(), getattr(observation, field.name))
-            observation_bytes = b''.join([observation_bytes, field_bytes])
-        bytes_message = b''.join([bytes_message, observation_bytes])
+    if isinstance(observations, numpy.ndarray):
+        observations = ObservationBatch(observations)
+    if isinstance(observations, ObservationBatch):
+        bytes_message = observations.array.astype(SerializedObservation.dtype, copy=False).tobytes()
+    else:
+        observations = list(observations)
+        bytes_message = bytearray(len(observations) * SerializedObservation.byte_size)
+        for index, observation in enumerate(observations):
+            SerializedObservation.compiled_struct.pack_into(bytes_message, index * SerializedObservation.byte_size,
+                                                            *[getattr(observation, field.name)
+                                                              for field in SerializedObservation.fields])
     return base64.b64encode(bytes_message).decode()
 
 
 def deserialize_observations(message):
     bytes_message = base64.b64decode(message)
-    observations = []
-    for message_index in range(0, len(bytes_message), SerializedObservation.byte_size):
-        line = bytes_message[message_index:message_index + SerializedObservation.byte_size]
-        observation_dict = {}
-        line_struct_format = ReportFieldTypes.endian_type
-        for field in SerializedObservation.fields:
-            line_struct_format += field.type.struct_type
-        line_tuple = struct.unpack(line_struct_format, line)
-        for field_index in range(len(SerializedObservation.fields)):
-            field = SerializedObservation.fields[field_index]
-            observation_dict[field.name] = line_tuple[field_index]
-        observations.append(Observation(**observation_dict))
-    return observations
+    # The decoded bytes are used in place, as a read only array of serialized observations
+    return ObservationBatch(numpy.frombuffer(bytes_message, dtype=SerializedObservation.dtype))
+
+
+def deserialize_edge_observations(message):
+    """
+    Deserializes only the first and the last observations of the message. The amount of observations is taken from the
+    length of the message, so only the base64 of those two observations is decoded.
+
+    :return: A tuple with the amount of observations of the message and an ObservationBatch with its first and last
+    observations, empty if the message has none
+    """
+    padding = len(message) - len(message.rstrip('='))
+    observations_count = (len(message) // 4 * 3 - padding) // SerializedObservation.byte_size
+    if observations_count == 0:
+        return 0, deserialize_observations('')
+    bytes_messages = []
+    for index in (0, observations_count - 1):
+        start = index * SerializedObservation.byte_size
+        # Each 4 base64 characters decode to 3 bytes
+        first_group = start // 3
+        last_group = (start + SerializedObservation.byte_size - 1) // 3
+        bytes_message = base64.b64decode(message[first_group * 4:(last_group + 1) * 4])
+        offset = start - first_group * 3
+        bytes_messages.append(bytes_message[offset:offset + SerializedObservation.byte_size])
+    return observations_count, ObservationBatch(numpy.frombuffer(b''.join(bytes_messages),
+                                                                 dtype=SerializedObservation.dtype))
+
+
+def iter_observations(message):
+    """
+    Lazily deserializes the message, yielding each Observation only when it is requested.
+    """
+    bytes_message = base64.b64decode(message)
+    for line_tuple in SerializedObservation.compiled_struct.iter_unpack(bytes_message):
+        yield Observation(*line_tuple)
 
 
 JSON_FIELDS_TRANSLATIONS = [
@@ -196,6 +372,13 @@ JSON_REPORT_SCHEMA = {
     ]
 }
 
+# Built only once, since checking the schema and creating the validator is way more expensive than validating
+JSON_REPORT_VALIDATOR_CLASS = jsonschema.validators.validator_for(JSON_REPORT_SCHEMA)
+JSON_REPORT_VALIDATOR_CLASS.check_schema(JSON_REPORT_SCHEMA)
+JSON_REPORT_VALIDATOR = JSON_REPORT_VALIDATOR_CLASS(JSON_REPORT_SCHEMA)
+
+JSON_KEYS_TRANSLATIONS = {key: inflection.underscore(key) for key in JSON_REPORT_SCHEMA['properties']}
+
 
 class ReportJSONEncoder(json.JSONEncoder):
     @staticmethod
@@ -226,11 +409,15 @@ class ReportJSONEncoder(json.JSONEncoder):
 
 
 class ReportJSONDecoder(json.JSONDecoder):
+    VALIDATION_MODES = ('always', 'sample', 'never')
+
     @staticmethod
     def dict_to_report(json_dict):
         json_dict_keys = list(json_dict.keys())
         for key in json_dict_keys:
-            new_key = inflection.underscore(key)
+            new_key = JSON_KEYS_TRANSLATIONS.get(key)
+            if new_key is None:
+                new_key = inflection.underscore(key)
             json_dict[new_key] = json_dict.pop(key)
         for field_translation in JSON_FIELDS_TRANSLATIONS:
             if field_translation.original in json_dict.keys():
@@ -238,15 +425,37 @@ class ReportJSONDecoder(json.JSONDecoder):
                 json_dict[field_translation.translation] = field_translation.translate(field_value)
         return Report(**json_dict)
 
+    def should_validate(self):
+        if self.validation_mode == 'always':
+            return True
+        if self.validation_mode == 'sample':
+            return random.random() < self.validation_sample_rate
+        return False
+
     def dict_to_object(self, d):
-        try:
-            jsonschema.validate(d, JSON_REPORT_SCHEMA)
-            inst = self.dict_to_report(d)
-        except jsonschema.ValidationError:
-            inst = d
+        if self.should_validate():
+            if JSON_REPORT_VALIDATOR.is_valid(d):
+                inst = self.dict_to_report(d)
+            else:
+                inst = d
+        else:
+            try:
+                inst = self.dict_to_report(d.copy())
+            except TypeError:
+                # Not a report, it lacks or has extra fields
+                inst = d
         return inst
 
-    def __init__(self):
+    def __init__(self, validation_mode=None, validation_sample_rate=None):
+        if validation_mode is None:
+            validation_mode = TIX_REPORT_VALIDATION_MODE
+        if validation_mode not in self.VALIDATION_MODES:
+            raise ValueError('Unknown validation mode {}, expected one of {}'.format(validation_mode,
+                                                                                     self.VALIDATION_MODES))
+        if validation_sample_rate is None:
+            validation_sample_rate = TIX_REPORT_VALIDATION_SAMPLE_RATE
+        self.validation_mode = validation_mode
+        self.validation_sample_rate = validation_sample_rate
         json.JSONDecoder.__init__(self, object_hook=self.dict_to_object)
 
 
@@ -259,12 +468,12 @@ class Report:
         return report
 
     @staticmethod
-    def loads(report_json):
-        return json.loads(report_json, cls=ReportJSONDecoder)
+    def loads(report_json, validation_mode=None):
+        return json.loads(report_json, cls=ReportJSONDecoder, validation_mode=validation_mode)
 
     @staticmethod
     def get_gap_between_reports(second_report, first_report):
-        return second_report.observations[0].day_timestamp - first_report.observations[0].day_timestamp
+        return second_report.first_timestamp - first_report.first_timestamp
 
     def __init__(self,
                  from_dir, to_dir, packet_type,
@@ -285,8 +494,24 @@ class Report:
         self.installation_id = installation_id
         self.file_path = file_path
 
+    @property
+    def ip(self):
+        return self.from_dir.split(':')[0]
+
+    @property
+    def first_timestamp(self):
+        return self.observations[0].day_timestamp
+
+    @property
+    def last_timestamp(self):
+        return self.observations[-1].day_timestamp
+
+    @property
+    def observations_count(self):
+        return len(self.observations)
+
     def get_observations_gap(self):
-        return self.observations[-1].day_timestamp - self.observations[0].day_timestamp
+        return self.last_timestamp - self.first_timestamp
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
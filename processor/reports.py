@@ -3,7 +3,7 @@ from processor.report_parser import *
 import datetime
 import json
 import os
-from os import listdir, unlink, mkdir, rename
+from os import listdir, unlink, mkdir, rename, replace, scandir
 
 from os.path import join, exists, isfile, islink
 
@@ -14,6 +14,130 @@ logger = logging.getLogger(__name__)
 class NotEnoughObservationsError(Exception):
     pass
 
+class ReportSummary:
+    """
+    What the selection of processable reports needs to know about a report file, without its observations.
+    """
+    def __init__(self, file_path, first_timestamp, last_timestamp, observations_count, ip):
+        self.file_path = file_path
+        self.first_timestamp = first_timestamp
+        self.last_timestamp = last_timestamp
+        self.observations_count = observations_count
+        self.ip = ip
+
+    @classmethod
+    def from_report_file(cls, report_file_path):
+        """
+        Summarizes a report file without decoding the report, deserializing only its first and last observations.
+        """
+        with open(report_file_path) as report_file:
+            report_dict = json.load(report_file)
+        observations_count, edge_observations = deserialize_edge_observations(report_dict['message'])
+        day_timestamps = edge_observations.day_timestamp
+        return cls(report_file_path,
+                   int(day_timestamps[0]),
+                   int(day_timestamps[-1]),
+                   observations_count,
+                   report_dict['from'].split(':')[0])
+
+    def get_observations_gap(self):
+        return self.last_timestamp - self.first_timestamp
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.__dict__ == other.__dict__
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self.__dict__.values()))
+
+    def __repr__(self):
+        return '{0!s}({1!r})'.format(self.__class__, self.__dict__)
+
+
+def scan_reports_files(reports_dir_path):
+    """
+    Lazily yields the directory entries of the report files of a directory, in no particular order.
+    """
+    with scandir(reports_dir_path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.json') and entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+class ReportsIndex:
+    """
+    Summaries of the report files of a directory, persisted in a file of the directory.
+
+    Each report file is summarized only the first time it is seen or after it changes, as told by its size and
+    modification time. The summaries of the files that no longer exist are dropped when the index is updated.
+    """
+    FILE_NAME = '.reports-index'
+    VERSION = 1
+
+    def __init__(self, reports_dir_path, read_only=False):
+        """
+        :param read_only: If True, the index file is never written, so the directory is left untouched. The summaries
+        are still kept in memory between updates.
+        """
+        self.logger = logger.getChild('ReportsIndex')
+        self.reports_dir_path = reports_dir_path
+        self.read_only = read_only
+        self.file_path = join(reports_dir_path, self.FILE_NAME)
+        self.entries = self.load()
+
+    def load(self):
+        if not exists(self.file_path):
+            return {}
+        try:
+            with open(self.file_path) as index_file:
+                index = json.load(index_file)
+        except ValueError:
+            self.logger.warning('Discarding unreadable reports index {}'.format(self.file_path))
+            return {}
+        if index.get('version') != self.VERSION:
+            return {}
+        return index['files']
+
+    def save(self):
+        temporary_file_path = self.file_path + '.tmp'
+        try:
+            with open(temporary_file_path, 'w') as index_file:
+                json.dump({'version': self.VERSION, 'files': self.entries}, index_file)
+            replace(temporary_file_path, self.file_path)
+        except OSError:
+            # The index is only a cache, the summaries are computed again next time
+            self.logger.warning('Could not save the reports index {}'.format(self.file_path))
+
+    def update(self):
+        """
+        Brings the index up to date with the report files of the directory.
+
+        :return: The summaries of the report files sorted by file name
+        """
+        entries = {}
+        changed = False
+        for entry in scan_reports_files(self.reports_dir_path):
+            stat = entry.stat(follow_symlinks=False)
+            index_entry = self.entries.get(entry.name)
+            if index_entry is None or index_entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+                try:
+                    summary = ReportSummary.from_report_file(entry.path)
+                except (ValueError, KeyError, IndexError, OSError):
+                    self.logger.warning('Skipping unreadable report {}'.format(entry.path))
+                    continue
+                index_entry = [stat.st_size, stat.st_mtime_ns, summary.first_timestamp, summary.last_timestamp,
+                               summary.observations_count, summary.ip]
+                changed = True
+            entries[entry.name] = index_entry
+        changed = changed or len(entries) != len(self.entries)
+        self.entries = entries
+        if changed and not self.read_only:
+            self.save()
+        return [ReportSummary(join(self.reports_dir_path, file_name), *self.entries[file_name][2:])
+                for file_name in sorted(self.entries)]
+
+
 class ReportHandler:
     MINIMUM_OBSERVATIONS_QTY = 1024 + 60  # We need 1024 observation points plus a minute for analysis
     MAXIMUM_OBSERVATIONS_QTY = 1200
@@ -62,7 +186,7 @@ class ReportHandler:
 
     @staticmethod
     def calculate_observations_quantity(reports):
-        return sum([len(report.observations) for report in reports])
+        return sum([report.observations_count for report in reports])
 
     @classmethod
     def fetch_reports(cls, reports_dir_path, last_first=False):
@@ -77,67 +201,123 @@ class ReportHandler:
         return reports
 
     @classmethod
-    def collect_observations(cls, reports):
+    def group_observations_by_ip(cls, reports):
+        """
+        Partitions the observations of the reports by the IP they were sent from, in a single pass.
+
+        :return: A list of (ip, observations) tuples, in the order the IPs first appear in the reports, where the
+        observations are the distinct ones of the reports from that IP, as an ObservationBatch in the order of the
+        reports
+        """
         data_per_ip = {}
         for report in reports:
-            socket_dir = report.from_dir
-            ip = socket_dir.split(':')[0]
-            if ip not in data_per_ip:
-                data_per_ip[ip] = set()
-            data_per_ip[ip].update(report.observations)
-        for ip, observations in data_per_ip.items():
-            return ip, observations
-
-    def __init__(self, installation_dir_path):
+            if report.ip not in data_per_ip:
+                data_per_ip[report.ip] = []
+            data_per_ip[report.ip].append(as_observation_batch(report.observations))
+        return [(ip, ObservationBatch.concatenate(observations_batches).deduplicated())
+                for ip, observations_batches in data_per_ip.items()]
+
+    @classmethod
+    def collect_observations(cls, reports):
+        """
+        :return: The IP of the first report and the distinct observations of the reports from that IP, or None if
+        there are no reports
+        """
+        observations_per_ip = cls.group_observations_by_ip(reports)
+        if len(observations_per_ip) == 0:
+            return None
+        return observations_per_ip[0]
+
+    def __init__(self, installation_dir_path, read_only=False):
+        """
+        :param read_only: If True, the report files are never deleted and no file is written to the directory. The
+        reports that would be deleted are only left out of the next processable reports.
+        """
         self.logger = logger.getChild('ReportHandler')
         self.installation_dir_path = installation_dir_path
+        self.read_only = read_only
+        self.discarded_reports_files = set()
         self.failed_results_dir_path = join(self.installation_dir_path, self.FAILED_RESULTS_DIR_NAME)
-        if not exists(self.failed_results_dir_path):
+        if not exists(self.failed_results_dir_path) and not self.read_only:
             mkdir(self.failed_results_dir_path)
+        self.reports_index = ReportsIndex(self.installation_dir_path, read_only=self.read_only)
         self.reports_files = list()
         self.processable_reports = list()
         self.__update_reports_files()
 
     def __update_reports_files(self):
-        self.reports_files = [join(self.installation_dir_path, report_file_name)
-                              for report_file_name in sorted(listdir(self.installation_dir_path))
-                              if report_file_name.endswith('.json')]
-
-    def __divide_reports_by_gap_threshold(self, reports):
-        gap = self.max_gap_in_reports(reports)
-        if self.GAP_THRESHOLD < gap:
-            reports_before, reports_after = self.divide_gapped_reports(reports, gap)
+        self.reports_summaries = [summary for summary in self.reports_index.update()
+                                  if summary.file_path not in self.discarded_reports_files]
+        self.reports_files = [summary.file_path for summary in self.reports_summaries]
+
+    def discard_reports_files(self, reports):
+        if self.read_only:
+            self.discarded_reports_files.update(report.file_path for report in reports)
+        else:
+            self.delete_reports_files(reports)
+
+    @classmethod
+    def __divide_reports_by_gap_threshold(cls, reports):
+        gap = cls.max_gap_in_reports(reports)
+        if cls.GAP_THRESHOLD < gap:
+            reports_before, reports_after = cls.divide_gapped_reports(reports, gap)
         else:
             reports_before = reports
             reports_after = list()
         return reports_before, reports_after
 
     def update_processable_reports(self):
-        self.__update_reports_files()
+        """
+        Loads the reports selected by select_processable_reports, which only reads the reports index.
+        """
+        self.processable_reports = [Report.load(report.file_path) for report in self.select_processable_reports()]
+
+    @classmethod
+    def select_reports_window(cls, reports_summaries, start=0):
+        """
+        Walks the sorted reports summaries from start looking for the reports to process. The reports between start
+        and the window are the ones that will never be processed.
+
+        :return: A tuple with the index where the window starts, the summaries of the reports to process, or an empty
+        list if there are not enough observations, and the index of the first report not walked
+        """
+        window_start = start
         processable_reports = list()
-        while (self.calculate_observations_quantity(processable_reports) < self.MINIMUM_OBSERVATIONS_QTY and
-               len(self.reports_files) > 0):
-            new_report = Report.load(self.reports_files.pop(0))
+        processable_observations_qty = 0
+        next_report_index = start
+        while (processable_observations_qty < cls.MINIMUM_OBSERVATIONS_QTY and
+               next_report_index < len(reports_summaries)):
+            new_report = reports_summaries[next_report_index]
+            next_report_index += 1
             # Ensure all processable reports are from the same IP
-            if len(processable_reports) > 0:
-                processable_reports_ip = processable_reports[0].from_dir.split(':')[0]
-                new_report_ip = new_report.from_dir.split(':')[0]
-                if new_report_ip != processable_reports_ip:
-                    self.delete_reports_files(processable_reports)
-                    processable_reports.clear()
+            if len(processable_reports) > 0 and new_report.ip != processable_reports[0].ip:
+                window_start += len(processable_reports)
+                processable_reports.clear()
+                processable_observations_qty = 0
             processable_reports.append(new_report)
-            if self.calculate_observations_quantity(processable_reports) > self.MINIMUM_OBSERVATIONS_QTY:
+            processable_observations_qty += new_report.observations_count
+            if processable_observations_qty > cls.MINIMUM_OBSERVATIONS_QTY:
                 # Ensure that the reports have no irrecoverable gaps
-                reports_before_gap, reports_after_gap = self.__divide_reports_by_gap_threshold(processable_reports)
-                if self.calculate_observations_quantity(reports_before_gap) < self.MINIMUM_OBSERVATIONS_QTY:
-                    self.delete_reports_files(reports_before_gap)
+                reports_before_gap, reports_after_gap = cls.__divide_reports_by_gap_threshold(processable_reports)
+                if cls.calculate_observations_quantity(reports_before_gap) < cls.MINIMUM_OBSERVATIONS_QTY:
+                    window_start += len(reports_before_gap)
                     processable_reports = reports_after_gap
                 else:
                     processable_reports = reports_before_gap
-        if self.calculate_observations_quantity(processable_reports) < self.MINIMUM_OBSERVATIONS_QTY:
-            self.processable_reports = list()
-        else:
-            self.processable_reports = processable_reports
+                processable_observations_qty = cls.calculate_observations_quantity(processable_reports)
+        if processable_observations_qty < cls.MINIMUM_OBSERVATIONS_QTY:
+            return window_start, list(), next_report_index
+        return window_start, processable_reports, next_report_index
+
+    def select_processable_reports(self):
+        """
+        :return: The summaries of the reports to process, or an empty list if there are not enough observations
+        """
+        self.__update_reports_files()
+        window_start, processable_reports, next_report_index = self.select_reports_window(self.reports_summaries)
+        self.discard_reports_files(self.reports_summaries[:window_start])
+        self.reports_files = self.reports_files[next_report_index:]
+        return processable_reports
 
     def get_ip_and_processable_observations(self):
         self.update_processable_reports()
@@ -150,7 +330,7 @@ class ReportHandler:
     def delete_unneeded_reports(self):
         reports_to_delete_qty = len(self.processable_reports) // 2
         reports_to_delete = self.processable_reports[:reports_to_delete_qty]
-        self.delete_reports_files(reports_to_delete)
+        self.discard_reports_files(reports_to_delete)
 
     def failed_results_dir_is_empty(self):
         return not exists(self.failed_results_dir_path) or len(listdir(self.failed_results_dir_path)) == 0
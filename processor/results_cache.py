@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Maximum amount of messages whose results are kept, so a redelivered message is not analyzed again. With 0, the
+# default, no results are kept.
+RESULTS_CACHE_SIZE = int(os.environ.get('TIX_RESULTS_CACHE_SIZE', '0'))
+# Seconds the results of a message are kept since it was analyzed
+RESULTS_CACHE_TTL = float(os.environ.get('TIX_RESULTS_CACHE_TTL', '3600'))
+# SQLite database where the results are also kept, so they outlive the processor. With an empty value, they are only
+# kept in memory.
+RESULTS_CACHE_PATH = os.environ.get('TIX_RESULTS_CACHE_PATH', '')
+
+
+class ResultsCache:
+    """
+    Keeps the analyzed measures of the last messages, keyed by the digest of their body, so a redelivered message only
+    needs to be posted again.
+
+    The results are kept in memory and, when a database path is given, also written through to SQLite and loaded
+    from it when created. The least recently stored messages are dropped first, and the ones stored more than ttl
+    seconds ago are dropped when found.
+    """
+
+    def __init__(self, max_size=RESULTS_CACHE_SIZE, ttl=RESULTS_CACHE_TTL, database_path=None, clock=time.time):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.connection = None
+        if database_path:
+            self.connection = sqlite3.connect(database_path, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                    '(digest TEXT PRIMARY KEY, stored REAL NOT NULL, analyzed_measures TEXT NOT NULL)')
+            self.load()
+
+    @staticmethod
+    def key(body):
+        return hashlib.sha256(body).hexdigest()
+
+    def load(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM results WHERE stored <= ? OR digest NOT IN '
+                                    '(SELECT digest FROM results ORDER BY stored DESC LIMIT ?)',
+                                    (self.clock() - self.ttl, self.max_size))
+            rows = self.connection.execute('SELECT digest, stored, analyzed_measures FROM results '
+                                           'ORDER BY stored').fetchall()
+        for digest, stored, analyzed_measures in rows:
+            self.entries[digest] = ([tuple(entry) for entry in json.loads(analyzed_measures)], stored)
+        self.logger.info('Loaded the results of {} messages'.format(len(self.entries)))
+
+    def get(self, key):
+        """
+        :return: The analyzed measures of the message, or None if they are not kept
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= self.clock() - self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, analyzed_measures):
+        stored = self.clock()
+        with self.lock:
+            self.entries[key] = (analyzed_measures, stored)
+            self.entries.move_to_end(key)
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                            (key, stored, json.dumps([list(entry) for entry in analyzed_measures])))
+            self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        del self.entries[key]
+        if self.connection is not None:
+            with self.connection:
+                self.connection.execute('DELETE FROM results WHERE digest = ?', (key,))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'messages': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
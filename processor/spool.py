@@ -0,0 +1,348 @@
+import json
+import logging
+import os
+import threading
+import time
+from os import listdir, makedirs, remove, replace
+from os.path import exists, getsize, join
+
+from processor import api_communication
+from processor.reports import ReportHandler
+
+logger = logging.getLogger(__name__)
+
+# Directory where the results that could not be posted are spooled. With an empty value, they are requeued instead.
+RESULTS_SPOOL_PATH = os.environ.get('TIX_RESULTS_SPOOL_PATH', '')
+# Megabytes written to a segment of the spool before starting the next one
+RESULTS_SPOOL_SEGMENT_SIZE = int(float(os.environ.get('TIX_RESULTS_SPOOL_SEGMENT_SIZE', '4')) * 1024 * 1024)
+# Seconds between replays of the spool, doubled after each failed replay up to the maximum backoff
+RESULTS_SPOOL_REPLAY_INTERVAL = float(os.environ.get('TIX_RESULTS_SPOOL_REPLAY_INTERVAL', '5'))
+RESULTS_SPOOL_MAX_BACKOFF = float(os.environ.get('TIX_RESULTS_SPOOL_MAX_BACKOFF', '300'))
+
+
+class ResultsSpool:
+    """
+    Append only spool of the results that could not be posted, kept in segment files under the failed results
+    directory.
+
+    Each entry is a JSON line with the (ip, results, user_id, installation_id) of an IP. An append returns once its
+    entries are on disk, and the appends made while another one waits for the disk share the next fsync. Entries are
+    only read from the segments no longer written, oldest first, and each segment is deleted once all its entries were
+    taken. The entries the API refused are set aside, in a file of their own, so that they do not block the ones after
+    them.
+    """
+    SEGMENT_FILE_PREFIX = 'results-'
+    SEGMENT_FILE_EXTENSION = '.spool'
+    CURSOR_FILE_NAME = 'cursor'
+    REFUSED_FILE_NAME = 'refused-results.jsonl'
+
+    def __init__(self, base_path, segment_size=RESULTS_SPOOL_SEGMENT_SIZE):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.dir_path = join(base_path, ReportHandler.FAILED_RESULTS_DIR_NAME)
+        makedirs(self.dir_path, exist_ok=True)
+        self.segment_size = segment_size
+        self.condition = threading.Condition()
+        self.syncing = False
+        self.appended = 0
+        self.synced = 0
+        self.fsyncs = 0
+        self.segments = self.list_segments()
+        self.cursor = self.load_cursor()
+        self.pending_entries = self.count_pending_entries()
+        self.segment_sequence = self.segments[-1] + 1 if len(self.segments) > 0 else 1
+        self.segment_file = None
+        self.segment_file_size = 0
+
+    def segment_path(self, sequence):
+        return join(self.dir_path, '{prefix}{sequence:010d}{extension}'.format(prefix=self.SEGMENT_FILE_PREFIX,
+                                                                            sequence=sequence,
+                                                                            extension=self.SEGMENT_FILE_EXTENSION))
+
+    @property
+    def cursor_path(self):
+        return join(self.dir_path, self.CURSOR_FILE_NAME)
+
+    @property
+    def refused_path(self):
+        return join(self.dir_path, self.REFUSED_FILE_NAME)
+
+    def list_segments(self):
+        sequences = []
+        for file_name in listdir(self.dir_path):
+            if file_name.startswith(self.SEGMENT_FILE_PREFIX) and file_name.endswith(self.SEGMENT_FILE_EXTENSION):
+                sequences.append(int(file_name[len(self.SEGMENT_FILE_PREFIX):-len(self.SEGMENT_FILE_EXTENSION)]))
+        return sorted(sequences)
+
+    def load_cursor(self):
+        """
+        :return: The (sequence, offset) of the next entry to read
+        """
+        if exists(self.cursor_path):
+            try:
+                with open(self.cursor_path) as cursor_file:
+                    sequence, offset = json.load(cursor_file)
+                if sequence in self.segments:
+                    return sequence, offset
+            except (OSError, ValueError):
+                self.logger.warning('Could not load the spool cursor {}, reading from the oldest segment'
+                                    .format(self.cursor_path))
+        return (self.segments[0] if len(self.segments) > 0 else 0), 0
+
+    def save_cursor(self):
+        # The cursor is not synced, so after a crash at most the last entries taken are taken again
+        temporary_file_path = self.cursor_path + '.tmp'
+        with open(temporary_file_path, 'w') as cursor_file:
+            json.dump(list(self.cursor), cursor_file)
+        replace(temporary_file_path, self.cursor_path)
+
+    def count_pending_entries(self):
+        pending_entries = 0
+        for sequence in self.segments:
+            with open(self.segment_path(sequence), 'rb') as segment_file:
+                if sequence == self.cursor[0]:
+                    segment_file.seek(self.cursor[1])
+                pending_entries += sum(line.endswith(b'\n') for line in segment_file)
+        return pending_entries
+
+    def append(self, analyzed_measures):
+        """
+        Appends the (ip, results, user_id, installation_id) entries, returning once they are on disk.
+        """
+        lines = ''.join(json.dumps(list(entry)) + '\n' for entry in analyzed_measures).encode()
+        with self.condition:
+            if self.segment_file is None or \
+                    0 < self.segment_file_size and self.segment_size < self.segment_file_size + len(lines):
+                # The segment being synced cannot be closed
+                while self.syncing:
+                    self.condition.wait()
+                self._start_segment()
+            self.segment_file.write(lines)
+            self.segment_file_size += len(lines)
+            self.appended += len(analyzed_measures)
+            self.pending_entries += len(analyzed_measures)
+            self._wait_synced(self.appended)
+
+    def _wait_synced(self, position):
+        while self.synced < position:
+            if self.syncing:
+                self.condition.wait()
+                continue
+            # Syncs every entry appended until now, including the ones of the appends waiting for this sync
+            self.syncing = True
+            target = self.appended
+            self.segment_file.flush()
+            descriptor = self.segment_file.fileno()
+            self.condition.release()
+            error = None
+            try:
+                os.fsync(descriptor)
+            except OSError as fsync_error:
+                error = fsync_error
+            self.condition.acquire()
+            self.syncing = False
+            if error is None:
+                self.fsyncs += 1
+                self.synced = max(self.synced, target)
+            self.condition.notify_all()
+            if error is not None:
+                raise error
+
+    def _start_segment(self):
+        if self.segment_file is not None:
+            self._close_segment()
+        self.segment_file = open(self.segment_path(self.segment_sequence), 'ab')
+
+    def _close_segment(self):
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+        self.segment_file.close()
+        self.fsyncs += 1
+        self.synced = self.appended
+        self.segments.append(self.segment_sequence)
+        self.segment_sequence += 1
+        self.segment_file = None
+        self.segment_file_size = 0
+
+    def seal(self):
+        """
+        Closes the segment being written, if it has entries, so that they can be read.
+        """
+        with self.condition:
+            while self.syncing:
+                self.condition.wait()
+            if self.segment_file is not None and self.segment_file_size > 0:
+                self._close_segment()
+
+    def read(self, max_entries):
+        """
+        Reads the oldest entries, without taking them. If there are no entries in the closed segments, the segment
+        being written is closed.
+
+        :return: A list of up to max_entries (entry, position) tuples, where position is the one to commit once the
+        entry, and the ones before it, were taken
+        """
+        if len(self.segments) == 0:
+            self.seal()
+        with self.condition:
+            if len(self.segments) == 0:
+                return []
+            sequence = self.segments[0]
+            if self.cursor[0] != sequence:
+                self.cursor = sequence, 0
+            offset = self.cursor[1]
+        entries = []
+        skipped_qty = 0
+        with open(self.segment_path(sequence), 'rb') as segment_file:
+            segment_file.seek(offset)
+            for line in segment_file:
+                if len(entries) == max_entries:
+                    break
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('The entry was not completely written')
+                    entry = tuple(json.loads(line.decode()))
+                except ValueError as error:
+                    if len(entries) > 0:
+                        # Skipped by the next read, so that the positions of the entries read stay valid
+                        break
+                    self.logger.warning('Skipping an entry of the spool segment {} at {}: {}'.format(
+                        self.segment_path(sequence), offset, error))
+                    offset += len(line)
+                    skipped_qty += line.endswith(b'\n')
+                    continue
+                offset += len(line)
+                entries.append((entry, (sequence, offset)))
+        if len(entries) == 0:
+            # Every entry left in the segment was skipped
+            self.commit((sequence, offset), skipped_qty)
+            return self.read(max_entries)
+        with self.condition:
+            self.pending_entries -= skipped_qty
+        return entries
+
+    def commit(self, position, entries_qty):
+        """
+        Takes the entries read until the position, deleting the segment when all its entries were taken.
+        """
+        sequence, offset = position
+        with self.condition:
+            self.pending_entries -= entries_qty
+            self.cursor = position
+            segment_path = self.segment_path(sequence)
+            if offset >= getsize(segment_path):
+                remove(segment_path)
+                self.segments.remove(sequence)
+        self.save_cursor()
+
+    def set_aside(self, entries):
+        """
+        Appends entries read from the spool to the refused entries, returning once they are on disk. They must be
+        committed afterwards, as any other entry taken.
+        """
+        lines = ''.join(json.dumps(list(entry)) + '\n' for entry in entries).encode()
+        with open(self.refused_path, 'ab') as refused_file:
+            refused_file.write(lines)
+            refused_file.flush()
+            os.fsync(refused_file.fileno())
+
+    def close(self):
+        self.seal()
+
+    def stats(self):
+        return {
+            'segments': len(self.segments) + (1 if self.segment_file is not None else 0),
+            'pending_entries': self.pending_entries,
+            'appended': self.appended,
+            'fsyncs': self.fsyncs
+        }
+
+
+class ResultsSpoolSender(threading.Thread):
+    """
+    Posts the entries of a ResultsSpool to the API in the background, oldest first.
+
+    The spool is replayed every replay_interval seconds. The entries are posted one after the other, and a replay stops
+    at the first post that failed, so no entry after it is posted twice. The entries the API refused are set aside
+    instead. After a replay in which a post failed, the time until the next one is doubled, up to max_backoff seconds,
+    until a replay empties the spool again.
+    """
+    BATCH_SIZE = 100
+
+    def __init__(self, results_spool, replay_interval=RESULTS_SPOOL_REPLAY_INTERVAL,
+                 max_backoff=RESULTS_SPOOL_MAX_BACKOFF, report_interval=60, clock=time.monotonic):
+        threading.Thread.__init__(self, name=self.__class__.__name__, daemon=True)
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.results_spool = results_spool
+        self.replay_interval = replay_interval
+        self.max_backoff = max_backoff
+        self.report_interval = report_interval
+        self.clock = clock
+        self.delay = replay_interval
+        self.last_report = self.clock()
+        self.stopped = threading.Event()
+        self.posted = 0
+        self.refused = 0
+        self.failed_replays = 0
+
+    def replay(self):
+        """
+        Posts the spooled entries, in order, until the spool is empty or a post fails.
+
+        :return: True if the spool was emptied
+        """
+        while True:
+            entries = self.results_spool.read(self.BATCH_SIZE)
+            if len(entries) == 0:
+                return True
+            taken_qty = 0
+            refused_entries = []
+            for entry, position in entries:
+                outcome = api_communication.post_results_outcome(*entry)
+                if outcome == api_communication.FAILED:
+                    break
+                if outcome == api_communication.REFUSED:
+                    refused_entries.append(entry)
+                else:
+                    self.posted += 1
+                taken_qty += 1
+            if len(refused_entries) > 0:
+                self.logger.error('Setting aside {} results refused by the API'.format(len(refused_entries)))
+                self.results_spool.set_aside(refused_entries)
+                self.refused += len(refused_entries)
+            if taken_qty > 0:
+                self.results_spool.commit(entries[taken_qty - 1][1], taken_qty)
+            if taken_qty < len(entries):
+                return False
+
+    def run(self):
+        while not self.stopped.wait(self.delay):
+            try:
+                replayed = self.replay()
+            except Exception:
+                self.logger.exception('Could not replay the results spool')
+                replayed = False
+            if replayed:
+                self.delay = self.replay_interval
+            else:
+                self.failed_replays += 1
+                self.delay = min(2 * self.delay, self.max_backoff)
+            self.report()
+
+    def report(self):
+        now = self.clock()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            stats = self.stats()
+            self.logger.info('Results spool depth is {} entries in {} segments, next replay in {:.0f}s'.format(
+                stats['pending_entries'], stats['segments'], stats['delay']))
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        self.join(timeout)
+
+    def stats(self):
+        return dict(self.results_spool.stats(),
+                    posted=self.posted,
+                    refused=self.refused,
+                    failed_replays=self.failed_replays,
+                    delay=self.delay)
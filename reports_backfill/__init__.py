@@ -0,0 +1,23 @@
+import argparse
+
+
+def parse_args(raw_args=None):
+    parser = argparse.ArgumentParser(description='Script to analyze the archived report files of many installations. '
+                                                 'Every window of reports the tix-time-processor would take is '
+                                                 'analyzed, without deleting any report file, and its results are '
+                                                 'written as a row of a CSV file. An interrupted run resumes from its '
+                                                 'checkpoint file.')
+    parser.add_argument('source_directories', nargs='+',
+                        help='The paths to the installation directories where the reports are.')
+    parser.add_argument('--recursive', '-r', action='store_true',
+                        help='Look for installation directories inside the source directories.')
+    parser.add_argument('--output', '-o', action='store', default='backfill-results.csv', type=str,
+                        help='The name of the output CSV file. By default "backfill-results.csv".')
+    parser.add_argument('--checkpoint', '-c', action='store', default=None, type=str,
+                        help='The name of the checkpoint file. By default the output file name plus ".checkpoint".')
+    parser.add_argument('--workers', '-w', action='store', default=0, type=int,
+                        help='The amount of worker processes. By default the amount of CPUs.')
+    parser.add_argument('--progress-interval', action='store', default=10, type=float,
+                        help='Seconds between progress reports. By default 10.')
+    args = parser.parse_args(raw_args)
+    return args
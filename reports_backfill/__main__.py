@@ -0,0 +1,21 @@
+import logging
+from os import path
+
+from processor import backfill
+from reports_backfill import parse_args
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logger.debug(args)
+    abs_source_paths = [path.abspath(source_directory) for source_directory in args.source_directories]
+    abs_output_path = path.abspath(args.output)
+    abs_checkpoint_path = path.abspath(args.checkpoint) if args.checkpoint is not None else None
+    stats = backfill.run_backfill(abs_source_paths, abs_output_path,
+                                  workers=args.workers,
+                                  recursive=args.recursive,
+                                  checkpoint_path=abs_checkpoint_path,
+                                  progress_interval=args.progress_interval)
+    logger.info("Backfill finished: {}".format(stats))
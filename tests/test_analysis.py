@@ -1,51 +1,364 @@
+import random
 import unittest
 from datetime import datetime, timezone
+from math import sqrt
+from unittest import mock
 
 import dateutil.parser
+import numpy
 
 from processor import analysis
+from processor.report_parser import Observation, ObservationBatch, serialize_observations, deserialize_observations
 
 
-@unittest.skip("temporarily disabled due to errors in test_hurst.py")
 class TestAnalysis(unittest.TestCase):
+    # Results of the Analyzer of tests/test_analysis_data.txt before it analyzed ObservationBatch columns
+    BASELINE_RESULTS = {
+        'timestamp': 1376092707,
+        'upstream': {
+            'usage': 0.8093457943925234,
+            'quality': 1.0,
+            'hurst': {
+                'wavelet': 0.4693216718801289,
+                'rs': 0.4575281783596202
+            }
+        },
+        'downstream': {
+            'usage': 0.24074074074074073,
+            'quality': 0.2,
+            'hurst': {
+                'wavelet': 0.8012538826789911,
+                'rs': 0.6028489620270131
+            }
+        }
+    }
 
     def setUp(self):
-        self.reports_data = []
-        with open('tests/test_analysis_data.txt') as data_file:
-            for line in data_file:
-                datetime_string, observation_data = line.split(' ')
-                date_str, time_str = datetime_string.split('|')
-                date = dateutil.parser.parse(date_str).date()
-                time = dateutil.parser.parse(time_str).time()
-                timestamp = datetime.combine(date, time).replace(tzinfo=timezone.utc).timestamp()
-                empty, size, t1, t2, t3, t4 = observation_data.split('|')
-                observation = {
-                    'day_timestamp': int(timestamp),
-                    'type': 'S',
-                    'size': 64,
-                    'initial_timestamp': int(t1),
-                    'reception_timestamp': int(t2),
-                    'sent_timestamp': int(t3),
-                    'final_timestamp': int(t4)
-                }
-                self.reports_data.append(observation)
+        self.observations = load_test_observations()
+
+    def assert_results_almost_equal(self, results, expected_results):
+        self.assertEqual(results['timestamp'], expected_results['timestamp'])
+        for direction in ('upstream', 'downstream'):
+            for key in ('usage', 'quality'):
+                self.assertAlmostEqual(results[direction][key], expected_results[direction][key], places=12)
+            for estimator in ('wavelet', 'rs'):
+                self.assertAlmostEqual(results[direction]['hurst'][estimator],
+                                       expected_results[direction]['hurst'][estimator], places=12)
 
     def test_process_observations(self):
-        expected_results = {
-            'timestamp': 0,
-            'downstream_usage': .0,
-            'upstream_usage': .0,
-            'upstream_quality': .0,
-            'downstream_quality': .0,
-            'upstream_hurst': {
-                'wavelet': .0,
-                'rs': .0
-            },
-            'downstream_hurst': {
-                'wavelet': .0,
-                'rs': .0
-            }
-        }
-        results = analysis.process_observations(self.reports_data)
-        print(results)
-        pass
+        results = analysis.Analyzer(self.observations).get_results()
+        self.assert_results_almost_equal(results, self.BASELINE_RESULTS)
+
+
+class TestFixedSizeBinHistogram(unittest.TestCase):
+
+    @staticmethod
+    def reference_histogram(keys, alpha):
+        keys = sorted(keys)
+        bins_qty = int(sqrt(len(keys)))
+        datapoints_per_bin = len(keys) // bins_qty
+        bins = [keys[index * datapoints_per_bin:(index + 1) * datapoints_per_bin] for index in range(bins_qty)]
+        bins[-1].extend(keys[bins_qty * datapoints_per_bin:])
+        mid_values = [bin_[0] + (bin_[-1] - bin_[0]) // 2 for bin_ in bins]
+        total_width = keys[-1] - keys[0]
+        probabilities = [(len(keys) * total_width) / (len(bin_) * (bin_[-1] - bin_[0])) for bin_ in bins]
+        representative_probabilities = probabilities[:2 * int(sqrt(len(bins)))]
+        mode = max(representative_probabilities)
+        mode_value = mid_values[representative_probabilities.index(mode)]
+        if representative_probabilities[0] == mode:
+            threshold = mid_values[1]
+        else:
+            threshold = mode_value + alpha * mid_values[0]
+        return bins, probabilities, mode_value, threshold
+
+    def test_histogram(self):
+        random.seed(1)
+        for observations_qty in (100, 1030, 1084):
+            observations = [Observation(1376091120 + index, b'S', 64, 0, 0, 0, random.randint(10 ** 4, 10 ** 8))
+                            for index in range(observations_qty)]
+            histogram = analysis.FixedSizeBinHistogram(observations, analysis.observation_rtt_key_function)
+            bins, probabilities, mode, threshold = self.reference_histogram(
+                [observation.final_timestamp for observation in observations], histogram.alpha)
+            self.assertEqual([bin_.keys.tolist() for bin_ in histogram.bins], bins)
+            self.assertEqual([len(bin_.data) for bin_ in histogram.bins], [len(bin_) for bin_ in bins])
+            self.assertEqual(histogram.bins_probabilities, probabilities)
+            self.assertEqual(histogram.mode, mode)
+            self.assertEqual(histogram.threshold, threshold)
+
+    def test_zero_width_bin(self):
+        keys = [10 ** 4] * 50 + list(range(10 ** 5, 10 ** 5 + 50))
+        with self.assertRaises(ZeroDivisionError):
+            self.reference_histogram(keys, analysis.FixedSizeBinHistogram.DEFAULT_ALPHA)
+        with self.assertRaises(ZeroDivisionError):
+            analysis.FixedSizeBinHistogram(None, analysis.observation_rtt_key_function, keys=keys)
+        with self.assertRaises(ZeroDivisionError):
+            analysis.FixedSizeBinHistogram(None, analysis.observation_rtt_key_function, keys=[10 ** 4] * 100)
+
+
+class TestClockFixer(unittest.TestCase):
+
+    @staticmethod
+    def linear_scan_phi(observations, x):
+        phis = [(o.initial_timestamp - o.reception_timestamp +
+                 ((o.reception_timestamp - o.initial_timestamp) + (o.final_timestamp - o.sent_timestamp)) / 2)
+                for o in observations]
+        if x < observations[0].day_timestamp:
+            return phis[0]
+        if observations[-1].day_timestamp <= x:
+            return phis[-1]
+        for index in range(len(observations) - 1):
+            if observations[index].day_timestamp <= x < observations[index + 1].day_timestamp:
+                slope = (phis[index] - phis[index + 1]) / \
+                        (observations[index].day_timestamp - observations[index + 1].day_timestamp)
+                intercept = phis[index] - observations[index].day_timestamp * slope
+                return x * slope + intercept
+
+    def setUp(self):
+        random.seed(0)
+        self.observations = []
+        day_timestamp = 1376091120
+        for _ in range(200):
+            # Repeated day timestamps are allowed
+            day_timestamp += random.randint(0, 3)
+            initial_timestamp = random.randint(0, 10 ** 12)
+            reception_timestamp = initial_timestamp + random.randint(-10 ** 9, 10 ** 9)
+            sent_timestamp = reception_timestamp + random.randint(1, 10 ** 5)
+            final_timestamp = initial_timestamp + random.randint(10 ** 4, 10 ** 8)
+            self.observations.append(Observation(day_timestamp, b'S', 64, initial_timestamp, reception_timestamp,
+                                                 sent_timestamp, final_timestamp))
+        self.clock_fixer = analysis.ClockFixer(self.observations, tau=0)
+        self.timestamps = list(range(self.observations[0].day_timestamp - 10,
+                                     self.observations[-1].day_timestamp + 10))
+
+    def test_phi_function(self):
+        for x in self.timestamps:
+            self.assertEqual(self.clock_fixer.phi_function(x), self.linear_scan_phi(self.observations, x))
+
+    def test_vectorized_phi_function(self):
+        phis = self.clock_fixer.phi_function(numpy.array(self.timestamps))
+        expected_phis = [self.linear_scan_phi(self.observations, x) for x in self.timestamps]
+        self.assertEqual(phis.tolist(), expected_phis)
+
+
+def load_test_observations():
+    observations = []
+    with open('tests/test_analysis_data.txt') as data_file:
+        for line in data_file:
+            datetime_string, observation_data = line.split(' ')
+            date_str, time_str = datetime_string.split('|')
+            date = dateutil.parser.parse(date_str).date()
+            time = dateutil.parser.parse(time_str).time()
+            timestamp = datetime.combine(date, time).replace(tzinfo=timezone.utc).timestamp()
+            empty, size, t1, t2, t3, t4 = observation_data.split('|')
+            observations.append(Observation(int(timestamp), b'S', int(size), int(t1), int(t2), int(t3), int(t4)))
+    return observations
+
+
+class TestUsageCalculator(unittest.TestCase):
+
+    def test_usage(self):
+        observations = load_test_observations()
+        clock_fixer = analysis.ClockFixer(observations, tau=0)
+        usage_calculator = analysis.UsageCalculator(observations, clock_fixer)
+        expected_usages = []
+        for key_function, histogram in ((analysis.upstream_time_function, usage_calculator.upstream_histogram),
+                                        (analysis.downstream_time_function, usage_calculator.downstream_histogram)):
+            times = [key_function(observation, clock_fixer.phi_function) for observation in observations]
+            over_threshold = len([time for time in times if time > histogram.threshold])
+            over_mode = len([time for time in times if time > histogram.mode])
+            expected_usages.append(over_threshold / over_mode)
+        self.assertEqual([usage_calculator.upstream_usage, usage_calculator.downstream_usage], expected_usages)
+
+
+def observation_key(observation):
+    return (observation.day_timestamp, observation.packet_size,
+            observation.initial_timestamp_nanos, observation.final_timestamp_nanos)
+
+
+class TestQualityCalculator(unittest.TestCase):
+
+    def setUp(self):
+        self.observations = load_test_observations()
+
+    def test_divide_observations_into_minutes(self):
+        expected_minutes = {}
+        for observation in self.observations:
+            observation_datetime = datetime.fromtimestamp(observation.day_timestamp, timezone.utc)
+            minute = int(observation_datetime.replace(second=0, microsecond=0).timestamp())
+            expected_minutes.setdefault(minute, []).append(observation)
+        shuffled_observations = list(self.observations)
+        random.Random(0).shuffle(shuffled_observations)
+        minutes = analysis.divide_observations_into_minutes(shuffled_observations)
+        self.assertEqual(sorted(minutes.keys()), sorted(expected_minutes.keys()))
+        for minute, minute_observations in minutes.items():
+            self.assertEqual(sorted(minute_observations, key=observation_key),
+                             sorted(expected_minutes[minute], key=observation_key))
+        self.assertEqual(analysis.divide_observations_into_minutes([]), {})
+
+    @staticmethod
+    def quality_calculator(observations, minute_usage_cache=None):
+        # Without a hurst congestion threshold, the usage of every minute is needed
+        analyzer = analysis.Analyzer(observations)
+        return analysis.QualityCalculator(analyzer.meaningful_observations, analyzer.hurst_calculator,
+                                          analyzer.clock_fixer, hurst_congestion_threshold=0,
+                                          minute_usage_cache=minute_usage_cache)
+
+    def test_minute_usage_cache(self):
+        cache = analysis.MinuteUsageCache()
+        observations = sorted(self.observations, key=lambda observation: observation.day_timestamp)
+        for start in range(0, 600, 60):
+            window = observations[start:start + 1000]
+            quality_calculator = self.quality_calculator(window, minute_usage_cache=cache)
+            expected_quality_calculator = self.quality_calculator(window)
+            self.assertEqual((quality_calculator.upstream_congestion, quality_calculator.downstream_congestion),
+                             (expected_quality_calculator.upstream_congestion,
+                              expected_quality_calculator.downstream_congestion))
+            for minute, minute_start, minute_end in quality_calculator.minutes_slices:
+                key = cache.minute_key(quality_calculator.observations[minute_start:minute_end],
+                                       quality_calculator.clock_fixer)
+                self.assertEqual(cache.usages[key], (
+                    analysis.calculate_usage(quality_calculator.upstream_times[minute_start:minute_end]),
+                    analysis.calculate_usage(quality_calculator.downstream_times[minute_start:minute_end])))
+        # The windows share 9 of their 10 minutes, most of them fixed by the same phi segments
+        self.assertGreater(cache.hits, cache.misses)
+
+    def test_minute_usage_cache_hashes_each_minute_once(self):
+        cache = analysis.MinuteUsageCache()
+        with mock.patch.object(cache, 'minute_key', wraps=cache.minute_key) as minute_key:
+            quality_calculator = self.quality_calculator(self.observations, minute_usage_cache=cache)
+        self.assertEqual(minute_key.call_count, len(quality_calculator.minutes_slices))
+        self.assertEqual(len(cache), len(quality_calculator.minutes_slices))
+
+    def test_minutes_with_few_observations_are_left_out(self):
+        analyzer = analysis.Analyzer(self.observations)
+        quality_calculator = self.quality_calculator(self.observations)
+        minutes = analysis.divide_observations_into_minutes(analyzer.meaningful_observations)
+        expected_minutes = sorted(minute for minute, minute_observations in minutes.items()
+                                  if len(minute_observations) >= analysis.QualityCalculator.MINIMUM_MINUTE_OBSERVATIONS)
+        self.assertLess(len(expected_minutes), len(minutes))
+        self.assertEqual(sorted(quality_calculator.observations_per_minute), expected_minutes)
+        for direction in ('upstream', 'downstream'):
+            congested_minutes = 0
+            for minute in expected_minutes:
+                minute_times = analysis.calculate_times(minutes[minute], analyzer.clock_fixer.phi_function)
+                usage = analysis.calculate_usage(minute_times[0 if direction == 'upstream' else 1])
+                if usage < quality_calculator.congestion_threshold:
+                    congested_minutes += 1
+            self.assertEqual(getattr(quality_calculator, direction + '_quality'),
+                             (len(expected_minutes) - congested_minutes) / len(expected_minutes))
+
+    def test_usage_of_every_minute_is_calculated(self):
+        analyzer = analysis.Analyzer(self.observations)
+        # No series is self-similar enough to be congested, but a degenerate minute still raises
+        with mock.patch('processor.analysis.calculate_usage', side_effect=ZeroDivisionError):
+            with self.assertRaises(ZeroDivisionError):
+                analysis.QualityCalculator(analyzer.meaningful_observations, analyzer.hurst_calculator,
+                                           analyzer.clock_fixer, hurst_congestion_threshold=1)
+
+    def test_minute_usage_cache_eviction(self):
+        cache = analysis.MinuteUsageCache(max_size=2)
+        times = [numpy.arange(size, dtype=numpy.float64) for size in (10, 20, 30)]
+        for size, minute_times in enumerate(times):
+            self.assertEqual(cache.usage(size, minute_times, minute_times[::-1]),
+                             (analysis.calculate_usage(minute_times), analysis.calculate_usage(minute_times[::-1])))
+        self.assertEqual(len(cache.usages), 2)
+        cache.usage(0, times[0], times[0][::-1])
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+
+
+class TestAnalyzer(unittest.TestCase):
+
+    def setUp(self):
+        self.observations = load_test_observations()
+
+    def test_observation_batch_input(self):
+        batch = ObservationBatch.from_observations(self.observations)
+        results = analysis.Analyzer(batch).get_results()
+        self.assertEqual(results, analysis.Analyzer(self.observations).get_results())
+        self.assertEqual(results['timestamp'], self.observations[-1].day_timestamp)
+
+    def test_deserialized_observations_input(self):
+        message = serialize_observations(self.observations)
+        results = analysis.Analyzer(deserialize_observations(message)).get_results()
+        self.assertEqual(results, analysis.Analyzer(self.observations).get_results())
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAnalysisStateCache(unittest.TestCase):
+
+    def setUp(self):
+        observations = load_test_observations()
+        self.observations = sorted(observations, key=lambda observation: observation.day_timestamp)
+        self.window = self.observations[:1200]
+        self.clock = FakeClock()
+
+    def test_analyze(self):
+        cache = analysis.AnalysisStateCache(max_size=10, ttl=60, clock=self.clock)
+        key = (1, 1, '127.0.0.1')
+        self.assertEqual(cache.analyze(key, self.window), analysis.Analyzer(self.window).get_results())
+        self.assertEqual(cache.analyze(key, self.observations[60:1260]),
+                         analysis.Analyzer(self.observations[60:1260]).get_results())
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        minute_usage_cache = cache.entries[key][0]
+        # The windows share most of their minutes, whose usage is only calculated once
+        self.assertGreater(minute_usage_cache.hits, 0)
+        self.assertLessEqual(len(minute_usage_cache), analysis.AnalysisStateCache.MINUTE_USAGES_PER_INSTALLATION)
+        self.assertEqual(cache.memory_usage, minute_usage_cache.nbytes)
+
+    def test_analyze_observations_with_repeated_day_timestamps(self):
+        cache = analysis.AnalysisStateCache(max_size=10, ttl=60, clock=self.clock)
+        key = (1, 1, '127.0.0.1')
+        # Several observations share each day_timestamp, and the messages are not sorted by it
+        observations = [Observation(observation.day_timestamp - observation.day_timestamp % 3,
+                                    observation.type_identifier, observation.packet_size,
+                                    observation.initial_timestamp, observation.reception_timestamp,
+                                    observation.sent_timestamp, observation.final_timestamp)
+                        for observation in self.observations]
+        shuffler = random.Random(0)
+        for start, end in ((0, 1200), (0, 1300), (200, 1400), (350, 1579)):
+            message = observations[start:end]
+            shuffler.shuffle(message)
+            self.assertEqual(cache.analyze(key, message), analysis.Analyzer(message).get_results())
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_lru_eviction(self):
+        cache = analysis.AnalysisStateCache(max_size=2, ttl=60, clock=self.clock)
+        cache.analyze((1, 1, '127.0.0.1'), self.window)
+        cache.analyze((1, 2, '127.0.0.1'), self.window)
+        cache.minute_usage_cache((1, 1, '127.0.0.1'))
+        cache.analyze((1, 3, '127.0.0.1'), self.window)
+        self.assertEqual(set(cache.entries), {(1, 1, '127.0.0.1'), (1, 3, '127.0.0.1')})
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttl_expiration(self):
+        cache = analysis.AnalysisStateCache(max_size=10, ttl=60, clock=self.clock)
+        cache.analyze((1, 1, '127.0.0.1'), self.window)
+        self.clock.now = 30
+        cache.analyze((1, 2, '127.0.0.1'), self.window)
+        self.clock.now = 70
+        cache.minute_usage_cache((1, 3, '127.0.0.1'))
+        self.assertEqual(set(cache.entries), {(1, 2, '127.0.0.1'), (1, 3, '127.0.0.1')})
+        self.assertEqual(cache.expirations, 1)
+
+    def test_memory_budget(self):
+        installations = 5
+        cache = analysis.AnalysisStateCache(max_size=100, ttl=60, clock=self.clock)
+        for installation_id in range(installations):
+            cache.analyze((1, installation_id, '127.0.0.1'), self.window)
+        installation_footprint = cache.memory_usage // installations
+        self.assertEqual(cache.memory_usage, installation_footprint * installations)
+        cache = analysis.AnalysisStateCache(max_size=100, ttl=60, memory_budget=3 * installation_footprint,
+                                            clock=self.clock)
+        for installation_id in range(installations):
+            cache.analyze((1, installation_id, '127.0.0.1'), self.window)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertLessEqual(cache.memory_usage, cache.memory_budget)
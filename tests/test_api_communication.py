@@ -1,8 +1,12 @@
 import json
 import random
 import socket
+import threading
 import unittest
 from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import mock
 
 import jsonschema
 import requests
@@ -11,6 +15,38 @@ import requests_mock
 from processor import api_communication
 
 
+class StubApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posted.append(json.loads(body.decode()))
+        self.send_response(self.server.status_code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, status_code=204):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubApiHandler)
+        self.status_code = status_code
+        self.connections = 0
+        self.posted = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}/api/reports'.format(port=self.server_address[1])
+
+
 class TestApiCommunication(unittest.TestCase):
 
     TIX_API_RESULTS_SCHEMA = {
@@ -113,11 +149,11 @@ class TestApiCommunication(unittest.TestCase):
     def test_post_results(self):
         user_id = random.randint(1, 10)
         installation_id = random.randint(1, 10)
-        result = api_communication.post_results(self.ip, self.results, user_id, installation_id, None, None)
+        # The API is not running, and the connection is not retried to keep the test fast
+        with mock.patch.object(api_communication, '_session', api_communication.create_session(retries=0)):
+            result = api_communication.post_results(self.ip, self.results, user_id, installation_id)
         self.assertFalse(result)
         with requests_mock.mock() as m:
-            tix_api_user = 'test-admin-user'
-            tix_api_pass = 'test-admin-pass'
             expected_url = api_communication.prepare_url(user_id, installation_id)
             expected_results = api_communication.prepare_results_for_api(self.results, self.ip)
 
@@ -126,18 +162,74 @@ class TestApiCommunication(unittest.TestCase):
                 return request.body.decode()
 
             m.register_uri('POST', expected_url, json=_verify_request_results, status_code=200)
-            result = api_communication.post_results(self.ip, self.results, user_id, installation_id, tix_api_user,
-                                                    tix_api_pass)
+            result = api_communication.post_results(self.ip, self.results, user_id, installation_id)
             self.assertTrue(result)
             m.register_uri('POST', expected_url, json=_verify_request_results, status_code=204)
-            result = api_communication.post_results(self.ip, self.results, user_id, installation_id, tix_api_user,
-                                                    tix_api_pass)
+            result = api_communication.post_results(self.ip, self.results, user_id, installation_id)
             self.assertTrue(result)
             m.register_uri('POST', expected_url, status_code=403)
-            result = api_communication.post_results(self.ip, self.results, user_id, installation_id, tix_api_user,
-                                                    tix_api_pass)
+            result = api_communication.post_results(self.ip, self.results, user_id, installation_id)
             self.assertFalse(result)
             m.register_uri('POST', expected_url, exc=requests.RequestException)
-            result = api_communication.post_results(self.ip, self.results, user_id, installation_id, tix_api_user,
-                                                    tix_api_pass)
+            result = api_communication.post_results(self.ip, self.results, user_id, installation_id)
             self.assertFalse(result)
+
+    def test_post_results_reuses_connections(self):
+        server = StubApiServer()
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        try:
+            results_qty = 5
+            with mock.patch.object(api_communication, 'prepare_url', return_value=server.url):
+                for _ in range(results_qty):
+                    self.assertTrue(api_communication.post_results(self.ip, self.results, 1, 1))
+            self.assertEqual(len(server.posted), results_qty)
+            self.assertEqual(server.connections, 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_post_results_bulk(self):
+        server = StubApiServer()
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        entries = [(self.ip, self.results, 1, installation_id) for installation_id in (1, 2, 1)]
+        try:
+            with mock.patch.object(api_communication, 'prepare_url', return_value=server.url):
+                outcomes = api_communication.post_results_bulk(entries, bulk_post=True)
+            self.assertEqual(outcomes, [True, True, True])
+            self.assertEqual(sorted(len(posted) for posted in server.posted), [1, 2])
+            with mock.patch.object(api_communication, 'prepare_url', return_value=server.url):
+                outcomes = api_communication.post_results_bulk(entries, bulk_post=False)
+            self.assertEqual(outcomes, [True, True, True])
+            self.assertEqual(len(server.posted), 5)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_post_results_is_not_retried_once_sent(self):
+        server = StubApiServer(status_code=502)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        try:
+            with mock.patch.object(api_communication, 'prepare_url', return_value=server.url):
+                self.assertFalse(api_communication.post_results(self.ip, self.results, 1, 1))
+            # The API may have stored the results behind the gateway that answered, so they are posted only once
+            self.assertEqual(len(server.posted), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_post_results_outcome(self):
+        expected_url = api_communication.prepare_url(1, 1)
+        with requests_mock.mock() as m:
+            for status_code, expected_outcome in ((204, api_communication.POSTED),
+                                                  (404, api_communication.REFUSED),
+                                                  (429, api_communication.FAILED),
+                                                  (503, api_communication.FAILED)):
+                m.register_uri('POST', expected_url, status_code=status_code)
+                self.assertEqual(api_communication.post_results_outcome(self.ip, self.results, 1, 1),
+                                 expected_outcome)
+            m.register_uri('POST', expected_url, exc=requests.ConnectionError)
+            self.assertEqual(api_communication.post_results_outcome(self.ip, self.results, 1, 1),
+                             api_communication.FAILED)
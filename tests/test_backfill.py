@@ -0,0 +1,130 @@
+import csv
+import json
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from os import listdir, mkdir
+from os.path import join
+from unittest import mock
+
+import dateutil.parser
+
+from processor import analysis, backfill, report_parser, reports
+
+FROM_DIR = '10.0.0.1:4500'
+TO_DIR = '8.8.8.8:4500'
+
+
+def load_observations():
+    observations = []
+    with open('tests/test_analysis_data.txt') as data_file:
+        for line in data_file:
+            datetime_string, observation_data = line.split(' ')
+            date_str, time_str = datetime_string.split('|')
+            date = dateutil.parser.parse(date_str).date()
+            time = dateutil.parser.parse(time_str).time()
+            timestamp = datetime.combine(date, time).replace(tzinfo=timezone.utc).timestamp()
+            empty, size, t1, t2, t3, t4 = observation_data.split('|')
+            observations.append(report_parser.Observation(int(timestamp), b'S', int(size),
+                                                          int(t1), int(t2), int(t3), int(t4)))
+    return sorted(observations, key=lambda observation: observation.day_timestamp)
+
+
+def create_report_files(dir_path, observations, user_id, installation_id, observations_per_report=60):
+    for index in range(0, len(observations), observations_per_report):
+        report_observations = observations[index:index + observations_per_report]
+        report = report_parser.Report(from_dir=FROM_DIR, to_dir=TO_DIR, packet_type='LONG',
+                                      initial_timestamp=0, reception_timestamp=0,
+                                      sent_timestamp=0, final_timestamp=0,
+                                      public_key='a', observations=report_observations,
+                                      signature='a', user_id=user_id, installation_id=installation_id)
+        report_file_name = 'tix-report-{timestamp}.json'.format(timestamp=report_observations[0].day_timestamp)
+        with open(join(dir_path, report_file_name), 'w') as report_file:
+            json.dump(report, report_file, cls=report_parser.ReportJSONEncoder)
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.installations_dirs = []
+        observations = load_observations()
+        for installation_id in (1, 2):
+            installation_dir = join(self.working_dir.name, 'installation-{}'.format(installation_id))
+            mkdir(installation_dir)
+            create_report_files(installation_dir, observations, 1, installation_id)
+            self.installations_dirs.append(installation_dir)
+        self.output_path = join(self.working_dir.name, 'results.csv')
+
+    def tearDown(self):
+        self.working_dir.cleanup()
+
+    def read_results(self):
+        with open(self.output_path, newline='') as output_file:
+            return list(csv.DictReader(output_file))
+
+    def list_reports_files(self, dir_path):
+        return sorted(file_name for file_name in listdir(dir_path) if file_name.endswith('.json'))
+
+    def test_enumerate_windows(self):
+        reports_files = self.list_reports_files(self.installations_dirs[0])
+        installation_dir, windows = backfill.enumerate_windows(self.installations_dirs[0])
+        self.assertEqual(installation_dir, self.installations_dirs[0])
+        self.assertGreater(len(windows), 0)
+        self.assertEqual(self.list_reports_files(self.installations_dirs[0]), reports_files)
+        reports_handler = reports.ReportHandler(self.installations_dirs[0])
+        reports_handler.update_processable_reports()
+        self.assertEqual(windows[0], [report.file_path for report in reports_handler.processable_reports])
+
+    @mock.patch.object(reports.ReportHandler, 'MINIMUM_OBSERVATIONS_QTY', 300)
+    def test_enumerates_windows_scanning_the_directory_once(self):
+        reports_handler = reports.ReportHandler(self.installations_dirs[0], read_only=True)
+        expected_windows = []
+        window = reports_handler.select_processable_reports()
+        while len(window) > 0:
+            expected_windows.append([report.file_path for report in window])
+            reports_handler.discard_reports_files(window[:max(1, len(window) // 2)])
+            window = reports_handler.select_processable_reports()
+        with mock.patch('processor.reports.scan_reports_files', side_effect=reports.scan_reports_files) as scan:
+            installation_dir, windows = backfill.enumerate_windows(self.installations_dirs[0])
+        self.assertEqual(scan.call_count, 1)
+        self.assertGreater(len(windows), 1)
+        self.assertEqual(windows, expected_windows)
+
+    def test_skips_installations_that_cannot_be_enumerated(self):
+        missing_dir = join(self.working_dir.name, 'missing-installation')
+        with self.assertLogs(backfill.logger, level='ERROR'):
+            self.assertEqual(backfill.enumerate_windows(missing_dir), (missing_dir, []))
+        stats = backfill.run_backfill([missing_dir] + self.installations_dirs, self.output_path, workers=2)
+        rows = self.read_results()
+        self.assertGreater(stats['analyzed'], 0)
+        self.assertEqual({row['installation_dir'] for row in rows}, set(self.installations_dirs))
+
+    def test_find_installation_dirs(self):
+        self.assertEqual(list(backfill.find_installation_dirs([self.working_dir.name], recursive=True)),
+                         self.installations_dirs)
+
+    def test_run_backfill(self):
+        stats = backfill.run_backfill([self.working_dir.name], self.output_path, workers=2, recursive=True)
+        rows = self.read_results()
+        self.assertEqual(stats['analyzed'], len(rows))
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual({row['installation_dir'] for row in rows}, set(self.installations_dirs))
+        installation_dir, windows = backfill.enumerate_windows(self.installations_dirs[0])
+        window_reports = [reports.Report.load(report_file_path) for report_file_path in windows[0]]
+        ip, observations = reports.ReportHandler.collect_observations(window_reports)
+        results = analysis.Analyzer(observations).get_results()
+        row = rows[0]
+        self.assertEqual(row['ip'], ip)
+        self.assertEqual(int(row['timestamp']), results['timestamp'])
+        self.assertEqual(float(row['upstream_usage']), results['upstream']['usage'])
+        self.assertEqual(float(row['downstream_hurst_rs']), results['downstream']['hurst']['rs'])
+
+    def test_resumes_from_checkpoint(self):
+        backfill.run_backfill([self.installations_dirs[0]], self.output_path, workers=1)
+        first_rows = self.read_results()
+        stats = backfill.run_backfill(self.installations_dirs, self.output_path, workers=1)
+        rows = self.read_results()
+        self.assertEqual(rows[:len(first_rows)], first_rows)
+        self.assertEqual(stats['analyzed'], len(rows) - len(first_rows))
+        self.assertEqual(len({(row['installation_dir'], row['window']) for row in rows}), len(rows))
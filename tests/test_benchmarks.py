@@ -0,0 +1,52 @@
+import json
+import unittest
+
+import numpy
+
+from benchmarks import suite
+from benchmarks.synthetic import SyntheticReportsGenerator
+from processor import analysis, report_parser, reports
+
+
+class TestSyntheticReportsGenerator(unittest.TestCase):
+
+    def test_generate_message(self):
+        generator = SyntheticReportsGenerator(seed=1)
+        body = generator.generate_message(20)
+        current_reports = report_parser.Report.loads(body, validation_mode='always')
+        self.assertEqual(len(current_reports), 20)
+        self.assertTrue(all(isinstance(report, report_parser.Report) for report in current_reports))
+        ip, observations = reports.ReportHandler.collect_observations(current_reports)
+        self.assertEqual(ip, '10.0.0.1')
+        self.assertEqual(len(observations), 20 * generator.observations_per_report)
+        results = analysis.Analyzer(observations).get_results()
+        self.assertEqual(results['timestamp'], generator.next_timestamp - 1)
+        self.assertEqual(body, SyntheticReportsGenerator(seed=1).generate_message(20))
+
+    def test_gaps(self):
+        generator = SyntheticReportsGenerator(seed=1, gap_probability=1.0, gap_length=300)
+        first_report, second_report = generator.generate_reports(2)
+        gap = report_parser.Report.get_gap_between_reports(second_report, first_report)
+        self.assertEqual(gap, generator.observations_per_report + 300)
+
+    def test_rtt_distributions(self):
+        for rtt_distribution in SyntheticReportsGenerator.RTT_DISTRIBUTIONS:
+            generator = SyntheticReportsGenerator(seed=1, rtt_distribution=rtt_distribution, packet_sizes=(64,),
+                                                  serialization_time_per_byte=0, processing_time=(0, 0))
+            observations = generator.generate_observations(10000)
+            rtts = observations.final_timestamp - observations.initial_timestamp
+            self.assertAlmostEqual(numpy.median(rtts) / generator.rtt_median, 1, delta=0.05)
+        self.assertRaises(ValueError, SyntheticReportsGenerator, rtt_distribution='normal')
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        results = suite.run_benchmark(messages=2, seed=1)
+        self.assertEqual(set(results['stages']), set(suite.STAGES))
+        for stage_results in results['stages'].values():
+            self.assertEqual(stage_results['calls'], 2)
+            self.assertIn('peak_memory_bytes', stage_results)
+        self.assertGreater(results['messages_per_second'], 0)
+        comparison = suite.compare_results(json.loads(json.dumps(results)), results)
+        self.assertEqual(comparison['messages_per_second_ratio'], 1)
@@ -0,0 +1,326 @@
+import json
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from unittest import mock
+
+import dateutil.parser
+
+from processor import consumer, pipeline, report_parser
+
+FROM_DIR = '10.0.0.1:4500'
+TO_DIR = '8.8.8.8:4500'
+ROAMING_FROM_DIR = '10.0.0.2:4500'
+
+
+def load_observations():
+    observations = []
+    with open('tests/test_analysis_data.txt') as data_file:
+        for line in data_file:
+            datetime_string, observation_data = line.split(' ')
+            date_str, time_str = datetime_string.split('|')
+            date = dateutil.parser.parse(date_str).date()
+            time = dateutil.parser.parse(time_str).time()
+            timestamp = datetime.combine(date, time).replace(tzinfo=timezone.utc).timestamp()
+            empty, size, t1, t2, t3, t4 = observation_data.split('|')
+            observations.append(report_parser.Observation(int(timestamp), b'S', int(size),
+                                                          int(t1), int(t2), int(t3), int(t4)))
+    return observations
+
+
+def generate_message(observations, user_id, installation_id, observations_per_report=60, from_dir=FROM_DIR):
+    reports = []
+    for index in range(0, len(observations), observations_per_report):
+        reports.append(report_parser.Report(from_dir=from_dir, to_dir=TO_DIR, packet_type='LONG',
+                                            initial_timestamp=0, reception_timestamp=0,
+                                            sent_timestamp=0, final_timestamp=0,
+                                            public_key='a',
+                                            observations=observations[index:index + observations_per_report],
+                                            signature='a', user_id=user_id, installation_id=installation_id))
+    return json.dumps(reports, cls=report_parser.ReportJSONEncoder).encode()
+
+
+def generate_roaming_message(observations, user_id, installation_id, roaming_observations=None):
+    """
+    A message whose reports were sent from FROM_DIR and then, after the installation moved, from ROAMING_FROM_DIR.
+    """
+    if roaming_observations is None:
+        roaming_observations = observations
+    reports = json.loads(generate_message(observations, user_id, installation_id).decode())
+    reports += json.loads(generate_message(roaming_observations, user_id, installation_id,
+                                           from_dir=ROAMING_FROM_DIR).decode())
+    return json.dumps(reports).encode()
+
+
+class FakeMethod:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class FakeChannel:
+    def __init__(self):
+        self.is_open = True
+        self.prefetch_count = None
+        self.callback = None
+        self.acked = []
+        self.rejected = []
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, callback, queue):
+        self.callback = callback
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.rejected.append((delivery_tag, requeue))
+
+
+class FakeConnection:
+    def __init__(self, channel, bodies):
+        self.channel = channel
+        self.bodies = list(bodies)
+        self.delivered = 0
+
+    def process_data_events(self, time_limit):
+        if len(self.bodies) > 0:
+            self.delivered += 1
+            self.channel.callback(self.channel, FakeMethod(self.delivered), None, self.bodies.pop(0))
+        elif len(self.channel.acked) + len(self.channel.rejected) == self.delivered:
+            self.channel.is_open = False
+
+
+class TestConcurrentConsumer(unittest.TestCase):
+
+    def setUp(self):
+        self.observations = load_observations()
+
+    def test_acks_only_posted_results(self):
+        bodies = [
+            generate_message(self.observations, user_id=1, installation_id=1),
+            b'[]',
+            generate_message(self.observations, user_id=1, installation_id=2),
+        ]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        concurrent_consumer = consumer.ConcurrentConsumer(connection, channel, 'queue', workers=2, prefetch_count=3)
+
+        def fake_post_results(ip, results, user_id, installation_id):
+            return installation_id == 1
+
+        with mock.patch('processor.api_communication.post_results', side_effect=fake_post_results) as post_results:
+            concurrent_consumer.start_consuming()
+        self.assertEqual(channel.prefetch_count, 3)
+        self.assertEqual(post_results.call_count, 2)
+        self.assertEqual(channel.acked, [1])
+        self.assertEqual(sorted(channel.rejected), [(2, False), (3, True)])
+
+    def test_rejects_messages_that_could_not_be_processed(self):
+        bodies = [
+            b'not json',
+            generate_message(self.observations, user_id=1, installation_id=1),
+        ]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        concurrent_consumer = consumer.ConcurrentConsumer(connection, channel, 'queue', workers=1, prefetch_count=2)
+        with mock.patch('processor.api_communication.post_results', return_value=True):
+            concurrent_consumer.start_consuming()
+        self.assertEqual(channel.acked, [2])
+        self.assertEqual(channel.rejected, [(1, False)])
+
+    def test_requeues_messages_and_replaces_a_broken_pool(self):
+        bodies = [
+            generate_message(self.observations, user_id=1, installation_id=1),
+            generate_message(self.observations, user_id=1, installation_id=2),
+        ]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        concurrent_consumer = consumer.ConcurrentConsumer(connection, channel, 'queue', workers=1, prefetch_count=1)
+        [broken_executor] = concurrent_consumer.analysis_executors.executors
+        analyze_observations_per_ip = consumer.analyze_observations_per_ip
+
+        def fake_analyze_observations_per_ip(user_id, installation_id, observations_per_ip, executor):
+            if executor is broken_executor:
+                raise BrokenProcessPool('A worker process terminated abruptly')
+            return analyze_observations_per_ip(user_id, installation_id, observations_per_ip, executor=executor)
+
+        with mock.patch('processor.consumer.analyze_observations_per_ip',
+                        side_effect=fake_analyze_observations_per_ip), \
+                mock.patch('processor.api_communication.post_results', return_value=True):
+            concurrent_consumer.start_consuming()
+        self.assertNotIn(broken_executor, concurrent_consumer.analysis_executors.executors)
+        self.assertEqual(channel.acked, [2])
+        self.assertEqual(channel.rejected, [(1, True)])
+
+    def test_routes_installations_to_the_same_worker(self):
+        bodies = [generate_message(self.observations, user_id=1, installation_id=installation_id)
+                  for installation_id in (1, 2, 1, 3, 2, 1)]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        concurrent_consumer = consumer.ConcurrentConsumer(connection, channel, 'queue', workers=2, prefetch_count=3,
+                                                          route_installations=True)
+        analysis_executors = concurrent_consumer.analysis_executors
+        self.assertEqual(len(analysis_executors.executors), 2)
+        analyze_observations_per_ip = consumer.analyze_observations_per_ip
+        installations_executors = {}
+
+        def fake_analyze_observations_per_ip(user_id, installation_id, observations_per_ip, executor):
+            installations_executors.setdefault(installation_id, set()).add(executor)
+            return analyze_observations_per_ip(user_id, installation_id, observations_per_ip, executor=executor)
+
+        with mock.patch('processor.consumer.analyze_observations_per_ip',
+                        side_effect=fake_analyze_observations_per_ip), \
+                mock.patch('processor.api_communication.post_results', return_value=True):
+            concurrent_consumer.start_consuming()
+        self.assertEqual(sorted(channel.acked), [1, 2, 3, 4, 5, 6])
+        for installation_id, executors in installations_executors.items():
+            self.assertEqual(executors, {analysis_executors.executor(1, installation_id)})
+
+    def test_analyze_measures(self):
+        body = generate_message(self.observations, user_id=3, installation_id=4)
+        [(ip, results, user_id, installation_id)] = consumer.analyze_measures(body)
+        self.assertEqual(ip, FROM_DIR.split(':')[0])
+        self.assertEqual((user_id, installation_id), (3, 4))
+        self.assertEqual(results['timestamp'], self.observations[-1].day_timestamp)
+        self.assertIsNone(consumer.analyze_measures(b'[]'))
+        self.assertIsNone(consumer.analyze_measures(generate_message(self.observations[:100], user_id=3,
+                                                                     installation_id=4)))
+
+    def test_analyze_measures_of_every_ip(self):
+        body = generate_roaming_message(self.observations, user_id=3, installation_id=4)
+        expected_analyzed_measures = [
+            consumer.analyze_measures(generate_message(self.observations, user_id=3, installation_id=4))[0],
+            consumer.analyze_measures(generate_message(self.observations, user_id=3, installation_id=4,
+                                                       from_dir=ROAMING_FROM_DIR))[0]
+        ]
+        self.assertEqual(consumer.analyze_measures(body), expected_analyzed_measures)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(consumer.analyze_measures(body, executor=executor), expected_analyzed_measures)
+
+    def test_acks_only_if_every_ip_was_posted(self):
+        bodies = [
+            generate_roaming_message(self.observations, user_id=1, installation_id=1),
+            generate_roaming_message(self.observations, user_id=1, installation_id=2),
+        ]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        concurrent_consumer = consumer.ConcurrentConsumer(connection, channel, 'queue', workers=2, prefetch_count=2)
+
+        def fake_post_results(ip, results, user_id, installation_id):
+            return installation_id == 1 or ip == FROM_DIR.split(':')[0]
+
+        with mock.patch('processor.api_communication.post_results', side_effect=fake_post_results) as post_results:
+            concurrent_consumer.start_consuming()
+        self.assertEqual(post_results.call_count, 4)
+        self.assertEqual(channel.acked, [1])
+        self.assertEqual(channel.rejected, [(2, True)])
+
+
+class TestAsyncPipelineConsumer(unittest.TestCase):
+
+    def setUp(self):
+        self.observations = load_observations()
+
+    def test_acks_only_posted_results(self):
+        bodies = [
+            generate_message(self.observations, user_id=1, installation_id=1),
+            b'[]',
+            generate_message(self.observations, user_id=1, installation_id=2),
+            generate_message(self.observations[:100], user_id=1, installation_id=1),
+        ]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        pipeline_consumer = pipeline.AsyncPipelineConsumer(connection, channel, 'queue', workers=1, prefetch_count=2)
+
+        def fake_post_results(ip, results, user_id, installation_id):
+            return installation_id == 1
+
+        with mock.patch('processor.api_communication.post_results', side_effect=fake_post_results) as post_results:
+            pipeline_consumer.start_consuming()
+        self.assertEqual(channel.prefetch_count, 2)
+        self.assertEqual(post_results.call_count, 2)
+        self.assertEqual(channel.acked, [1])
+        # The last message does not span enough time to be analyzed
+        self.assertEqual(sorted(channel.rejected), [(2, False), (3, True), (4, False)])
+
+    def test_acks_only_if_every_ip_was_posted(self):
+        bodies = [
+            generate_roaming_message(self.observations, user_id=1, installation_id=1),
+            generate_roaming_message(self.observations, user_id=1, installation_id=2),
+            generate_roaming_message(self.observations, user_id=1, installation_id=2,
+                                     roaming_observations=self.observations[:100]),
+        ]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        pipeline_consumer = pipeline.AsyncPipelineConsumer(connection, channel, 'queue', workers=2, prefetch_count=3)
+
+        def fake_post_results(ip, results, user_id, installation_id):
+            return installation_id == 1 or ip == FROM_DIR.split(':')[0]
+
+        with mock.patch('processor.api_communication.post_results', side_effect=fake_post_results) as post_results:
+            pipeline_consumer.start_consuming()
+        self.assertEqual(post_results.call_count, 5)
+        # The roaming IP of the last message does not span enough time to be analyzed, so it is skipped
+        self.assertEqual(sorted(channel.acked), [1, 3])
+        self.assertEqual(channel.rejected, [(2, True)])
+
+    def test_requeues_messages_that_could_not_be_posted(self):
+        bodies = [
+            generate_message(self.observations, user_id=1, installation_id=1),
+            generate_message(self.observations, user_id=1, installation_id=2),
+        ]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        pipeline_consumer = pipeline.AsyncPipelineConsumer(connection, channel, 'queue', workers=1, prefetch_count=1)
+
+        def fake_post_results(ip, results, user_id, installation_id):
+            if installation_id == 1:
+                raise RuntimeError('Unexpected error')
+            return True
+
+        with mock.patch('processor.api_communication.post_results', side_effect=fake_post_results):
+            pipeline_consumer.start_consuming()
+        self.assertEqual(channel.acked, [2])
+        self.assertEqual(channel.rejected, [(1, True)])
+
+    def test_requeues_messages_and_replaces_a_broken_pool(self):
+        bodies = [
+            generate_message(self.observations, user_id=1, installation_id=1),
+            generate_message(self.observations, user_id=1, installation_id=2),
+        ]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        pipeline_consumer = pipeline.AsyncPipelineConsumer(connection, channel, 'queue', workers=1, prefetch_count=1)
+        broken_executor = mock.Mock()
+        broken_executor.submit.side_effect = BrokenProcessPool('A worker process terminated abruptly')
+        executors = [broken_executor, ThreadPoolExecutor(max_workers=1)]
+        with mock.patch('processor.consumer.ProcessPoolExecutor', side_effect=executors), \
+                mock.patch('processor.api_communication.post_results', return_value=True):
+            pipeline_consumer.start_consuming()
+        self.assertEqual(pipeline_consumer.pipeline.analysis_executors.executors, [executors[1]])
+        broken_executor.shutdown.assert_called_once_with(wait=False)
+        self.assertEqual(channel.acked, [2])
+        self.assertEqual(channel.rejected, [(1, True)])
+
+    def test_parses_outside_the_event_loop(self):
+        bodies = [generate_message(self.observations, user_id=1, installation_id=1)]
+        channel = FakeChannel()
+        connection = FakeConnection(channel, bodies)
+        pipeline_consumer = pipeline.AsyncPipelineConsumer(connection, channel, 'queue', workers=1, prefetch_count=1)
+        parsing_threads = []
+
+        def fake_parse_measures(body):
+            parsing_threads.append(threading.current_thread())
+            return parse_measures(body)
+
+        parse_measures = consumer.parse_measures
+        with mock.patch('processor.consumer.parse_measures', side_effect=fake_parse_measures), \
+                mock.patch('processor.api_communication.post_results', return_value=True):
+            pipeline_consumer.start_consuming()
+        self.assertEqual(channel.acked, [1])
+        self.assertEqual(len(parsing_threads), 1)
+        self.assertIsNot(parsing_threads[0], pipeline_consumer.loop_thread)
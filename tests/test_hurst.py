@@ -1,9 +1,34 @@
 import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 import unittest
 
+import numpy
+import pywt
+
 from processor import hurst
 
 
+def list_wavelet(data, order=2, octaves_bounds=(2, 8)):
+    # The wavelet estimator as it was written before WaveletHurstEstimator, one value at a time
+    j1, j2 = octaves_bounds
+    length = int(2 ** math.floor(math.log(len(data), 2)))
+    noctave = int(math.log(length, 2)) - 1
+    bound_effect = int(math.ceil(math.log(2 * order, 2)))
+    statistic = [0] * noctave
+    j2 = min(j2, noctave - bound_effect)
+    wdec = pywt.wavedec(data[:length], 'db2', 'ppd', level=noctave - 1)
+    for j in range(0, (noctave - bound_effect)):
+        wdec_level = wdec[noctave - 1 - j][order - 1:(2 ** (noctave - j) - order)]
+        statistic[j] = math.log(numpy.mean([wdec_level[i] ** 2 for i in range(0, len(wdec_level))]), 2)
+    x = [10 ** i for i in range(j1, j2 + 1)]
+    y = [10 ** i for i in statistic[j1 - 1:j2]]
+    log10_x = [math.log10(x[i]) for i in range(0, len(x))]
+    log10_yx = [math.log10(y[i] * x[i]) / 2 for i in range(0, len(y))]
+    design = numpy.vstack([log10_x, numpy.ones(len(x))]).T
+    return numpy.linalg.lstsq(design, log10_yx)[0][0]
+
+
 class TestHurst(unittest.TestCase):
 
     def setUp(self):
@@ -24,3 +49,59 @@ class TestHurst(unittest.TestCase):
 
     def testWavelet(self):
         self.estimatorTest(hurst.wavelet, 'wavelet')
+
+    def testCrsAcceptsArrays(self):
+        for sequence in self.sequences:
+            values = sequence['values']
+            list_output = [0] * (2 * hurst.NBLK * hurst.NLAG)
+            array_output = numpy.zeros(2 * hurst.NBLK * hurst.NLAG)
+            hurst.crs(values, len(values), hurst.NBLK, hurst.NLAG, hurst.OVERLAP, list_output)
+            hurst.crs(numpy.array(values), len(values), hurst.NBLK, hurst.NLAG, hurst.OVERLAP, array_output)
+            self.assertEqual(list_output, array_output.tolist())
+
+    def testBatch(self):
+        series = [sequence['values'] for sequence in self.sequences]
+        estimations = hurst.hurst_batch(series)
+        for index, sequence in enumerate(self.sequences):
+            self.assertAlmostEqual(estimations['rs'][index], hurst.rs(sequence['values']))
+            self.assertEqual(estimations['wavelet'][index], hurst.wavelet(sequence['values']))
+
+    def testRsBatchConstantSeries(self):
+        series = [self.sequences[0]['values'], [1.0] * len(self.sequences[0]['values'])]
+        estimations = hurst.rs_batch(series)
+        self.assertFalse(numpy.isnan(estimations[0]))
+        self.assertTrue(numpy.isnan(estimations[1]))
+        self.assertRaises(ValueError, hurst.rs, series[1])
+
+    def testWaveletEstimator(self):
+        estimator = hurst.WaveletHurstEstimator()
+        for sequence in self.sequences:
+            values = sequence['values']
+            self.assertEqual(estimator.estimate([values])[0], hurst.wavelet(values))
+            self.assertIs(estimator.plan(len(values)), estimator.plan(len(values)))
+        self.assertIs(hurst.wavelet_estimator(), hurst.wavelet_estimator(2, [2, 8]))
+
+    def testWaveletEstimatorMatchesListBasedEstimator(self):
+        random_state = numpy.random.RandomState(0)
+        series = [sequence['values'] for sequence in self.sequences]
+        series += [random_state.standard_normal(length).cumsum() for length in (256, 700, 1024, 4096)]
+        for values in series:
+            self.assertEqual(hurst.wavelet(values), list_wavelet(values))
+            self.assertEqual(hurst.wavelet_batch([values, values]).tolist(), [list_wavelet(values)] * 2)
+
+    def testWaveletEstimatorSharedBetweenThreads(self):
+        estimator = hurst.WaveletHurstEstimator()
+        series = [sequence['values'] for sequence in self.sequences]
+        expected_estimations = [hurst.wavelet(values) for values in series]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            estimations = list(executor.map(lambda values: estimator.estimate([values])[0], series * 4))
+        self.assertEqual(estimations, expected_estimations * 4)
+
+    def testRsLagPlan(self):
+        values = self.sequences[0]['values']
+        plan = hurst.RSLagPlan.for_length(len(values))
+        self.assertIs(plan, hurst.RSLagPlan.for_length(len(values)))
+        self.assertEqual(len(plan.x), len(plan.fitted_positions))
+        self.assertFalse(set(plan.fitted_positions.tolist()) & set(plan.checked_positions.tolist()))
+        ranges = hurst.crs_batch([values])
+        self.assertEqual(plan.fit(ranges)[0], hurst.rs(values))
@@ -0,0 +1,104 @@
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from processor import consumer, metrics
+from tests.test_consumer import FakeChannel, FakeConnection, generate_message, load_observations
+
+
+def record_in_worker(amount):
+    metrics.API_POSTS.inc('posted', amount=amount)
+    return amount
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_render(self):
+        counter = self.registry.counter('tix_test_total', 'A counter.', ('outcome',))
+        histogram = self.registry.histogram('tix_test_seconds', 'A histogram.', buckets=(0.1, 1))
+        self.registry.callback('tix_test_depth', 'A gauge.', lambda: 3)
+        counter.inc('ok')
+        counter.inc('ok', amount=2)
+        counter.inc('fail "quoted"')
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP tix_test_total A counter.',
+            '# TYPE tix_test_total counter',
+            'tix_test_total{outcome="fail \\"quoted\\""} 1.0',
+            'tix_test_total{outcome="ok"} 3.0',
+            '# HELP tix_test_seconds A histogram.',
+            '# TYPE tix_test_seconds histogram',
+            'tix_test_seconds_bucket{le="0.1"} 2',
+            'tix_test_seconds_bucket{le="1.0"} 3',
+            'tix_test_seconds_bucket{le="+Inf"} 4',
+            'tix_test_seconds_sum 2.65',
+            'tix_test_seconds_count 4',
+            '# HELP tix_test_depth A gauge.',
+            '# TYPE tix_test_depth gauge',
+            'tix_test_depth 3.0',
+        ]) + '\n')
+        with self.assertRaises(ValueError):
+            counter.inc()
+        with self.assertRaises(ValueError):
+            self.registry.counter('tix_test_total', 'Again.')
+
+    def test_drain_and_merge(self):
+        histogram = self.registry.histogram('tix_test_seconds', 'A histogram.', ('stage',))
+        with histogram.time('decode'):
+            pass
+        worker_registry = metrics.MetricsRegistry()
+        worker_histogram = worker_registry.histogram('tix_test_seconds', 'A histogram.', ('stage',))
+        worker_histogram.observe(0.01, 'decode')
+        worker_histogram.observe(0.01, 'hurst')
+        self.registry.merge(worker_registry.drain())
+        self.assertEqual(worker_histogram.count('decode'), 0)
+        self.assertEqual(histogram.count('decode'), 2)
+        self.assertEqual(histogram.count('hurst'), 1)
+
+    def test_server(self):
+        self.registry.counter('tix_test_total', 'A counter.').inc()
+        server = metrics.MetricsServer(port=0, metrics_registry=self.registry).start()
+        try:
+            with urlopen(server.url) as response:
+                self.assertEqual(response.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+                self.assertEqual(response.read().decode(), self.registry.render())
+            with self.assertRaises(HTTPError):
+                urlopen(server.url.replace('/metrics', '/other'))
+        finally:
+            server.stop()
+
+
+class TestWorkersMetrics(unittest.TestCase):
+
+    def test_call_measured(self):
+        posted_before = metrics.API_POSTS.value('posted')
+        metrics.API_POSTS.inc('posted', amount=5)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            measured = list(executor.map(metrics.call_measured, [record_in_worker] * 3, [1, 2, 3]))
+        self.assertEqual(list(map(metrics.merge_measured, measured)), [1, 2, 3])
+        self.assertEqual(metrics.API_POSTS.value('posted'), posted_before + 5 + 6)
+        self.assertEqual(metrics.merge_measured(metrics.call_measured(record_in_worker, 1)), 1)
+        self.assertEqual(metrics.API_POSTS.value('posted'), posted_before + 5 + 6 + 1)
+
+    def test_concurrent_consumer(self):
+        stages = ('decode', 'group', 'histogram', 'clock_fixer', 'usage', 'hurst', 'quality')
+        stages_counts = {stage: metrics.STAGE_SECONDS.count(stage) for stage in stages}
+        acked = metrics.MESSAGES.value('acked')
+        rejected = metrics.MESSAGES.value('rejected')
+        channel = FakeChannel()
+        connection = FakeConnection(channel, [generate_message(load_observations(), user_id=1, installation_id=1),
+                                              b'[]'])
+        concurrent_consumer = consumer.ConcurrentConsumer(connection, channel, 'queue', workers=2, prefetch_count=2)
+        with mock.patch('processor.api_communication.post_results', return_value=True):
+            concurrent_consumer.start_consuming()
+        for stage in stages:
+            self.assertEqual(metrics.STAGE_SECONDS.count(stage), stages_counts[stage]
+                             + (2 if stage in ('decode', 'group') else 1))
+        self.assertEqual(metrics.MESSAGES.value('acked'), acked + 1)
+        self.assertEqual(metrics.MESSAGES.value('rejected'), rejected + 1)
@@ -1,8 +1,12 @@
+import base64
 import json
+import pickle
 import random
 import socket
+import struct
 import tempfile
 import unittest
+from unittest import mock
 
 import datetime
 
@@ -42,7 +46,7 @@ def generate_observations(start_time, report_delta, observations_delta):
         sent_timestamp = (reception_timestamp + processing_time) % NANOS_IN_A_DAY
         transmission_time = random.randint(1, 10 ** 9)
         final_timestamp = (sent_timestamp + transmission_time) % NANOS_IN_A_DAY
-        observation = reports_parser.Observation(day_timestamp, type_identifier, packet_size,
+        observation = report_parser.Observation(day_timestamp, type_identifier, packet_size,
                                                  initial_timestamp, reception_timestamp, sent_timestamp, final_timestamp)
         observations.append(observation)
         current_time += observations_delta
@@ -79,21 +83,21 @@ TO_DIR = '8.8.8.8:4500'
 class TestReports(unittest.TestCase):
     def test_JSONCoDec(self):
         report = generate_report(FROM_DIR, TO_DIR, USER_ID, INSTALLATION_ID)
-        json_report_string = json.dumps(report, cls=reports_parser.ReportJSONEncoder)
-        other_report = json.loads(json_report_string, cls=reports_parser.ReportJSONDecoder)
+        json_report_string = json.dumps(report, cls=report_parser.ReportJSONEncoder)
+        other_report = json.loads(json_report_string, cls=report_parser.ReportJSONDecoder)
         self.assertEqual(report, other_report)
         naive_json_report = json.loads(json_report_string)
-        jsonschema.validate(naive_json_report, reports_parser.JSON_REPORT_SCHEMA)
+        jsonschema.validate(naive_json_report, report_parser.JSON_REPORT_SCHEMA)
 
 
 class TestReport(unittest.TestCase):
     def test_load(self):
         report_file = tempfile.NamedTemporaryFile(mode='w', delete=False)
         original_report = generate_report(FROM_DIR, TO_DIR, USER_ID, INSTALLATION_ID)
-        json.dump(original_report, report_file, cls=reports_parser.ReportJSONEncoder)
+        json.dump(original_report, report_file, cls=report_parser.ReportJSONEncoder)
         report_file_path = report_file.name
         report_file.close()
-        loaded_report = reports_parser.Report.load(report_file_path)
+        loaded_report = report_parser.Report.load(report_file_path)
         self.assertIsNotNone(loaded_report.file_path)
         self.assertNotEquals(original_report, loaded_report)
         loaded_report.file_path = None
@@ -105,8 +109,20 @@ class TestReport(unittest.TestCase):
         current_working_directory = getcwd()
         tests_path = 'tests'
         report_file_path = join(current_working_directory, tests_path, report_file_name)
-        report = reports_parser.Report.load(report_file_path)
-        self.assertTrue(isinstance(report, reports_parser.Report))
+        report = report_parser.Report.load(report_file_path)
+        self.assertTrue(isinstance(report, report_parser.Report))
+
+    def test_loads_validation_modes(self):
+        report = generate_report(FROM_DIR, TO_DIR, USER_ID, INSTALLATION_ID)
+        json_report_string = json.dumps(report, cls=report_parser.ReportJSONEncoder)
+        invalid_json_report = json.loads(json_report_string)
+        invalid_json_report.pop('signature')
+        invalid_json_report_string = json.dumps(invalid_json_report)
+        for validation_mode in report_parser.ReportJSONDecoder.VALIDATION_MODES:
+            self.assertEqual(report_parser.Report.loads(json_report_string, validation_mode), report)
+            self.assertEqual(report_parser.Report.loads(invalid_json_report_string, validation_mode),
+                             invalid_json_report)
+        self.assertRaises(ValueError, report_parser.Report.loads, json_report_string, 'sometimes')
 
     def test_get_observations_gap(self):
         report = generate_report(FROM_DIR, TO_DIR, USER_ID, INSTALLATION_ID)
@@ -119,11 +135,91 @@ class TestReport(unittest.TestCase):
         reports_gap = DEFAULT_REPORT_DELTA
         report1 = generate_report(FROM_DIR, TO_DIR, USER_ID, INSTALLATION_ID, current_time)
         report2 = generate_report(FROM_DIR, TO_DIR, USER_ID, INSTALLATION_ID, current_time + reports_gap)
-        gap = reports_parser.Report.get_gap_between_reports(report2, report1)
+        gap = report_parser.Report.get_gap_between_reports(report2, report1)
         expected_gap = reports_gap.total_seconds()
         self.assertEqual(gap, expected_gap)
 
 
+class TestObservationBatch(unittest.TestCase):
+    def setUp(self):
+        self.observations = generate_observations(datetime.datetime.now(datetime.timezone.utc),
+                                                  DEFAULT_REPORT_DELTA, DEFAULT_OBSERVATIONS_DELTA)
+        self.batch = report_parser.ObservationBatch.from_observations(self.observations)
+
+    def test_from_observations(self):
+        self.assertEqual(len(self.batch), len(self.observations))
+        self.assertEqual(list(self.batch), self.observations)
+        self.assertEqual(self.batch[0], self.observations[0])
+        self.assertEqual(self.batch[-1], self.observations[-1])
+        self.assertEqual(self.batch.day_timestamp.tolist(),
+                         [observation.day_timestamp for observation in self.observations])
+
+    def test_indexing(self):
+        self.assertIsInstance(self.batch[1:3], report_parser.ObservationBatch)
+        self.assertEqual(list(self.batch[1:3]), self.observations[1:3])
+        mask = self.batch.final_timestamp > self.batch.initial_timestamp
+        self.assertEqual(list(self.batch[mask]),
+                         [observation for observation in self.observations
+                          if observation.final_timestamp > observation.initial_timestamp])
+
+    def test_concatenate(self):
+        batch = report_parser.ObservationBatch.concatenate([self.batch[:10], self.batch[10:]])
+        self.assertEqual(batch, self.batch)
+
+    def test_deserialize_observations(self):
+        message = report_parser.serialize_observations(self.observations)
+        batch = report_parser.deserialize_observations(message)
+        self.assertIsInstance(batch, report_parser.ObservationBatch)
+        self.assertEqual(batch, self.batch)
+        self.assertEqual(batch, self.observations)
+        self.assertFalse(batch.array.flags.owndata)
+        self.assertEqual(batch.array.dtype.itemsize, report_parser.SerializedObservation.byte_size)
+
+    def test_deserialize_edge_observations(self):
+        for observations_qty in (1, 2, 3, len(self.observations)):
+            message = report_parser.serialize_observations(self.observations[:observations_qty])
+            observations_count, edge_observations = report_parser.deserialize_edge_observations(message)
+            self.assertEqual(observations_count, observations_qty)
+            self.assertEqual(edge_observations, [self.observations[0], self.observations[observations_qty - 1]])
+        observations_count, edge_observations = report_parser.deserialize_edge_observations('')
+        self.assertEqual((observations_count, len(edge_observations)), (0, 0))
+
+    def test_serialize_observations(self):
+        expected_bytes = b''.join([struct.pack(field.type.get_struct_representation(), getattr(observation, field.name))
+                                   for observation in self.observations
+                                   for field in report_parser.SerializedObservation.fields])
+        expected_message = base64.b64encode(expected_bytes).decode()
+        self.assertEqual(report_parser.serialize_observations(self.observations), expected_message)
+        self.assertEqual(report_parser.serialize_observations(self.batch), expected_message)
+        self.assertEqual(report_parser.serialize_observations(self.batch.array), expected_message)
+        deserialized_batch = report_parser.deserialize_observations(expected_message)
+        self.assertEqual(report_parser.serialize_observations(deserialized_batch), expected_message)
+
+    def test_iter_observations(self):
+        message = report_parser.serialize_observations(self.observations)
+        observations = report_parser.iter_observations(message)
+        self.assertEqual(next(observations), self.observations[0])
+        self.assertEqual(list(observations), self.observations[1:])
+
+    def test_observation_slots_and_hash(self):
+        observation = self.observations[0]
+        self.assertFalse(hasattr(observation, '__dict__'))
+        self.assertEqual(hash(observation), hash(observation.as_tuple()))
+        copy = pickle.loads(pickle.dumps(observation))
+        self.assertEqual(copy, observation)
+        self.assertEqual(hash(copy), hash(observation))
+        self.assertEqual(len({observation, copy, self.batch[0]}), 1)
+
+    def test_deduplicated(self):
+        self.assertIs(self.batch.deduplicated(), self.batch)
+        overlapping_batch = report_parser.ObservationBatch.concatenate([self.batch[:20], self.batch[10:30],
+                                                                        self.batch[:5]])
+        self.assertEqual(overlapping_batch.deduplicated(), self.batch[:30])
+        shuffled_indexes = [3, 1, 3, 0, 2, 1]
+        shuffled_batch = self.batch[shuffled_indexes]
+        self.assertEqual(shuffled_batch.deduplicated(), self.batch[[3, 1, 0, 2]])
+
+
 class TestReportsHandler(unittest.TestCase):
 
     @staticmethod
@@ -139,7 +235,7 @@ class TestReportsHandler(unittest.TestCase):
             report_file_name = 'tix-report-{timestamp}.json'.format(timestamp=report.observations[0].day_timestamp)
             report_path = join(dir_path, report_file_name)
             with open(report_path, 'w') as report_fp:
-                json.dump(report, report_fp, cls=reports_parser.ReportJSONEncoder)
+                json.dump(report, report_fp, cls=report_parser.ReportJSONEncoder)
             report.file_path = report_path
             observations_qty += len(report.observations)
             start_time += reports_delta
@@ -242,3 +338,35 @@ class TestReportsHandler(unittest.TestCase):
         ip, observations = self.reports_handler.collect_observations(created_reports)
         self.assertTrue(FROM_DIR.startswith(ip))
         self.assertEquals(observations, expected_observations)
+
+    def test_reports_index(self):
+        created_reports = self.create_report_files(dir_path=self.reports_handler.installation_dir_path,
+                                                   total_observations_qty=reports.ReportHandler.MINIMUM_OBSERVATIONS_QTY,
+                                                   start_time=datetime.datetime.now(tz=datetime.timezone.utc),
+                                                   reports_delta=DEFAULT_REPORT_DELTA,
+                                                   observations_delta=DEFAULT_OBSERVATIONS_DELTA)
+        reports_index = reports.ReportsIndex(self.reports_handler.installation_dir_path)
+        summaries = reports_index.update()
+        expected_summaries = [reports.ReportSummary(report.file_path, report.first_timestamp, report.last_timestamp,
+                                                    report.observations_count, report.ip)
+                              for report in sorted(created_reports, key=lambda report: report.file_path)]
+        self.assertEqual(summaries, expected_summaries)
+        self.assertTrue(exists(reports_index.file_path))
+        unlink(created_reports[0].file_path)
+        with mock.patch.object(reports.ReportSummary, 'from_report_file') as from_report_file:
+            summaries = reports.ReportsIndex(self.reports_handler.installation_dir_path).update()
+        from_report_file.assert_not_called()
+        self.assertEqual(summaries, [summary for summary in expected_summaries
+                                     if summary.file_path != created_reports[0].file_path])
+
+    def test_read_only_reports_index(self):
+        installation_dir_path = self.reports_handler.installation_dir_path
+        self.create_report_files(dir_path=installation_dir_path,
+                                 total_observations_qty=reports.ReportHandler.MINIMUM_OBSERVATIONS_QTY,
+                                 start_time=datetime.datetime.now(tz=datetime.timezone.utc),
+                                 reports_delta=DEFAULT_REPORT_DELTA,
+                                 observations_delta=DEFAULT_OBSERVATIONS_DELTA)
+        files_before = sorted(listdir(installation_dir_path))
+        reports_handler = reports.ReportHandler(installation_dir_path, read_only=True)
+        self.assertGreater(len(reports_handler.select_processable_reports()), 0)
+        self.assertEqual(sorted(listdir(installation_dir_path)), files_before)
@@ -0,0 +1,108 @@
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+
+from processor import consumer, pipeline
+from processor.results_cache import ResultsCache
+from tests.test_consumer import FakeChannel, FakeConnection, generate_message, load_observations
+from tests.test_spool import generate_entry
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResultsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_get_and_put(self):
+        results_cache = ResultsCache(max_size=2, ttl=60, clock=self.clock)
+        keys = [ResultsCache.key('message {}'.format(index).encode()) for index in range(3)]
+        self.assertIsNone(results_cache.get(keys[0]))
+        results_cache.put(keys[0], [generate_entry(0)])
+        self.assertEqual(results_cache.get(keys[0]), [generate_entry(0)])
+        results_cache.put(keys[1], [generate_entry(1)])
+        results_cache.put(keys[2], [generate_entry(2)])
+        self.assertIsNone(results_cache.get(keys[0]))
+        self.clock.now += 60
+        self.assertIsNone(results_cache.get(keys[1]))
+        self.assertEqual(results_cache.stats(), {
+            'messages': 1,
+            'hits': 1,
+            'misses': 3,
+            'hit_rate': 0.25,
+            'evictions': 1,
+            'expirations': 1
+        })
+
+    def test_database(self):
+        database_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(database_dir.cleanup)
+        database_path = join(database_dir.name, 'results.sqlite')
+        results_cache = ResultsCache(max_size=2, ttl=60, database_path=database_path, clock=self.clock)
+        for index in range(3):
+            results_cache.put(str(index), [generate_entry(index), generate_entry(index + 1)])
+            self.clock.now += 10
+        results_cache.close()
+        results_cache = ResultsCache(max_size=1, ttl=60, database_path=database_path, clock=self.clock)
+        self.assertIsNone(results_cache.get('1'))
+        self.assertEqual(results_cache.get('2'), [generate_entry(2), generate_entry(3)])
+        self.clock.now += 60
+        results_cache.close()
+        results_cache = ResultsCache(max_size=2, ttl=60, database_path=database_path, clock=self.clock)
+        self.assertEqual(results_cache.stats()['messages'], 0)
+
+
+class RequeueingConnection(FakeConnection):
+    """
+    Delivers again the messages rejected with requeue, as RabbitMQ does.
+    """
+    def __init__(self, channel, bodies):
+        FakeConnection.__init__(self, channel, bodies)
+        self.bodies_per_tag = {}
+        self.requeued = 0
+
+    def process_data_events(self, time_limit):
+        requeued_tags = [delivery_tag for delivery_tag, requeue in self.channel.rejected if requeue]
+        for delivery_tag in requeued_tags[self.requeued:]:
+            self.bodies.append(self.bodies_per_tag[delivery_tag])
+        self.requeued = len(requeued_tags)
+        if len(self.bodies) > 0:
+            self.bodies_per_tag[self.delivered + 1] = self.bodies[0]
+        FakeConnection.process_data_events(self, time_limit)
+
+
+class TestRedeliveries(unittest.TestCase):
+
+    def setUp(self):
+        self.body = generate_message(load_observations(), user_id=1, installation_id=1)
+
+    def test_analyze_measures(self):
+        results_cache = ResultsCache(max_size=10, ttl=60)
+        analyzed_measures = consumer.analyze_measures(self.body, results_cache=results_cache)
+        with mock.patch('processor.consumer.parse_measures') as parse_measures:
+            self.assertEqual(consumer.analyze_measures(self.body, results_cache=results_cache), analyzed_measures)
+        parse_measures.assert_not_called()
+        self.assertEqual(results_cache.stats()['hits'], 1)
+
+    def test_pipeline_only_posts_redelivered_messages(self):
+        channel = FakeChannel()
+        connection = RequeueingConnection(channel, [self.body])
+        results_cache = ResultsCache(max_size=10, ttl=60)
+        pipeline_consumer = pipeline.AsyncPipelineConsumer(connection, channel, 'queue', workers=1, prefetch_count=1,
+                                                           results_cache=results_cache)
+        with mock.patch('processor.api_communication.post_results', side_effect=[False, True]) as post_results:
+            pipeline_consumer.start_consuming()
+        self.assertEqual(post_results.call_count, 2)
+        self.assertEqual(post_results.call_args_list[0], post_results.call_args_list[1])
+        self.assertEqual(channel.acked, [2])
+        self.assertEqual(channel.rejected, [(1, True)])
+        self.assertEqual(results_cache.stats()['hits'], 1)
@@ -0,0 +1,152 @@
+import json
+import tempfile
+import threading
+import unittest
+from os import listdir
+from os.path import join
+from unittest import mock
+
+from processor import api_communication, consumer, spool
+
+
+def generate_entry(index, installation_id=1):
+    results = {
+        'timestamp': 1500000000 + index,
+        'upstream': {'usage': 0.5, 'quality': 1.0, 'hurst': {'wavelet': 0.5, 'rs': 0.5}},
+        'downstream': {'usage': 0.5, 'quality': 1.0, 'hurst': {'wavelet': 0.5, 'rs': 0.5}}
+    }
+    return '10.0.0.{}'.format(index % 256), results, 1, installation_id
+
+
+class TestResultsSpool(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.base_dir.cleanup)
+
+    def take(self, results_spool, max_entries=10):
+        entries = results_spool.read(max_entries)
+        if len(entries) > 0:
+            results_spool.commit(entries[-1][1], len(entries))
+        return [entry for entry, position in entries]
+
+    def test_append_and_read(self):
+        results_spool = spool.ResultsSpool(self.base_dir.name, segment_size=1024)
+        entries = [generate_entry(index) for index in range(20)]
+        for entry in entries:
+            results_spool.append([entry])
+        self.assertEqual(results_spool.stats()['pending_entries'], 20)
+        self.assertGreater(results_spool.stats()['segments'], 2)
+        self.assertEqual(self.take(results_spool, max_entries=3), entries[:3])
+        results_spool.close()
+        # The entries not taken are read again by the next spool
+        results_spool = spool.ResultsSpool(self.base_dir.name, segment_size=1024)
+        self.assertEqual(results_spool.stats()['pending_entries'], 17)
+        taken_entries = []
+        while results_spool.stats()['pending_entries'] > 0:
+            taken_entries += self.take(results_spool)
+        self.assertEqual(taken_entries, entries[3:])
+        self.assertEqual(self.take(results_spool), [])
+        failed_results_dir_path = join(self.base_dir.name, spool.ReportHandler.FAILED_RESULTS_DIR_NAME)
+        self.assertEqual(listdir(failed_results_dir_path), [spool.ResultsSpool.CURSOR_FILE_NAME])
+
+    def test_skips_incomplete_entries(self):
+        results_spool = spool.ResultsSpool(self.base_dir.name)
+        results_spool.append([generate_entry(0), generate_entry(1)])
+        # As if the process stopped while appending an entry
+        results_spool.segment_file.write(b'["10.0.0.2", {"timestamp"')
+        results_spool.close()
+        results_spool = spool.ResultsSpool(self.base_dir.name)
+        self.assertEqual(results_spool.stats()['pending_entries'], 2)
+        self.assertEqual(self.take(results_spool), [generate_entry(0), generate_entry(1)])
+        self.assertEqual(self.take(results_spool), [])
+        self.assertEqual(results_spool.stats()['pending_entries'], 0)
+
+    def test_concurrent_appends_share_fsyncs(self):
+        results_spool = spool.ResultsSpool(self.base_dir.name)
+        appends_qty = 40
+        start = threading.Barrier(appends_qty)
+
+        def append(index):
+            start.wait()
+            results_spool.append([generate_entry(index)])
+
+        threads = [threading.Thread(target=append, args=(index,)) for index in range(appends_qty)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = results_spool.stats()
+        self.assertEqual(stats['appended'], appends_qty)
+        self.assertLessEqual(stats['fsyncs'], appends_qty)
+        self.assertEqual(sorted(self.take(results_spool, max_entries=appends_qty)),
+                         sorted(generate_entry(index) for index in range(appends_qty)))
+
+
+class TestResultsSpoolSender(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.base_dir.cleanup)
+        self.results_spool = spool.ResultsSpool(self.base_dir.name)
+
+    def test_replay(self):
+        entries = [generate_entry(index) for index in range(5)]
+        self.results_spool.append(entries)
+        sender = spool.ResultsSpoolSender(self.results_spool, replay_interval=1, max_backoff=4)
+        outcomes = [api_communication.POSTED, api_communication.POSTED, api_communication.FAILED]
+        with mock.patch('processor.api_communication.post_results_outcome', side_effect=outcomes) \
+                as post_results_outcome:
+            self.assertFalse(sender.replay())
+        # The replay stops at the failed post, so the entries after it are not posted
+        self.assertEqual(post_results_outcome.call_args_list, [mock.call(*entry) for entry in entries[:3]])
+        self.assertEqual(sender.posted, 2)
+        self.assertEqual(self.results_spool.stats()['pending_entries'], 3)
+        with mock.patch('processor.api_communication.post_results_outcome', return_value=api_communication.POSTED) \
+                as post_results_outcome:
+            self.assertTrue(sender.replay())
+        self.assertEqual(post_results_outcome.call_args_list, [mock.call(*entry) for entry in entries[2:]])
+        self.assertEqual(sender.posted, 5)
+        self.assertEqual(self.results_spool.stats()['pending_entries'], 0)
+
+    def test_sets_aside_refused_entries(self):
+        entries = [generate_entry(index) for index in range(4)]
+        self.results_spool.append(entries)
+        sender = spool.ResultsSpoolSender(self.results_spool, replay_interval=1, max_backoff=4)
+        outcomes = [api_communication.POSTED, api_communication.REFUSED, api_communication.POSTED,
+                    api_communication.POSTED]
+        with mock.patch('processor.api_communication.post_results_outcome', side_effect=outcomes):
+            self.assertTrue(sender.replay())
+        self.assertEqual((sender.posted, sender.refused), (3, 1))
+        self.assertEqual(self.results_spool.stats()['pending_entries'], 0)
+        with open(self.results_spool.refused_path) as refused_file:
+            self.assertEqual([tuple(json.loads(line)) for line in refused_file], [entries[1]])
+
+    def test_backoff(self):
+        self.results_spool.append([generate_entry(0)])
+        sender = spool.ResultsSpoolSender(self.results_spool, replay_interval=1, max_backoff=4)
+        delays = []
+
+        def wait(delay):
+            delays.append(delay)
+            return len(delays) > 5
+
+        with mock.patch.object(sender.stopped, 'wait', side_effect=wait), \
+                mock.patch('processor.api_communication.post_results_outcome',
+                           side_effect=[api_communication.FAILED] * 3 + [api_communication.POSTED]):
+            sender.run()
+        self.assertEqual(delays, [1, 2, 4, 4, 1, 1])
+        self.assertEqual(sender.failed_replays, 3)
+        self.assertEqual(sender.stats()['pending_entries'], 0)
+
+
+class TestPostAnalyzedMeasures(unittest.TestCase):
+    def test_spools_failed_results(self):
+        base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(base_dir.cleanup)
+        results_spool = spool.ResultsSpool(base_dir.name)
+        entries = [generate_entry(index) for index in range(3)]
+        with mock.patch('processor.api_communication.post_results_bulk', return_value=[True, False, True]):
+            self.assertFalse(consumer.post_analyzed_measures(entries))
+            self.assertTrue(consumer.post_analyzed_measures(entries, results_spool))
+        self.assertEqual([entry for entry, position in results_spool.read(10)], entries[1:2])
+        with mock.patch('processor.api_communication.post_results_bulk', return_value=[True, True, True]):
+            self.assertTrue(consumer.post_analyzed_measures(entries))